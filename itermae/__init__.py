@@ -2,12 +2,28 @@
 
 import time
 import statistics
+import json
+import ast
+import copy
 import sys
-import gzip
+import zlib
+import struct
 import string
 import argparse
 import re
 import itertools
+import io
+import collections
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+import http.server
+import os
+import random
+import math
+import tempfile
+import heapq
 
 import yaml
 import regex
@@ -95,53 +111,573 @@ def phred_number_array_to_joined_string(score_array):
         converted from a numeric list to a letter string.
     :rtype: str
     """
-    return str("".join([ phred_number_to_letter(i) for i in score_array]))
+    return bytes(score_array).translate(_PHRED_NUMBERS_TO_LETTERS).decode()
+
+
+def phred_joined_string_to_number_array(score_string):
+    """Turn a letter string of PHRED scores to a list of numbers. That's it.
+    This goes through `bytes.translate` for the whole string at once, so no
+    loop per base in Python.
+
+    :param score_string: PHRED score letters
+    :type score_string: str
+    :return: Returns a list of the PHRED scores (Illumina 1.8+, I believe) 
+        converted from the letter string.
+    :rtype: list of int
+    """
+    return list(score_string.encode('ascii').translate(
+        _PHRED_LETTERS_TO_NUMBERS))
+
+
+# Translation tables for turning whole strings/arrays of PHRED scores between
+# letters and numbers at once, with the offset of 33. Letters below '!' 
+# shouldn't happen, but they go to 0 instead of wrapping around.
+_PHRED_LETTERS_TO_NUMBERS = bytes( max(i-33,0) for i in range(256) )
+_PHRED_NUMBERS_TO_LETTERS = bytes( min(i+33,255) for i in range(256) )
+
+
+# These are for using in filters, as faster versions of doing things like 
+# `statistics.median(barcode.quality)`. They take a group (or a ReadRecord, or
+# just a string of PHRED letters or sequence) and work on the letters as bytes,
+# so the loops are in C (`sum`, `sorted`, `bytes.translate`, `str.count`)
+# instead of in Python over a list of numbers. Like `statistics`, they raise
+# on an empty group, so that filter just fails.
+
+# The error probability for each PHRED letter, for `expected_errors`
+_PHRED_ERROR_PROBABILITIES = tuple( 10**(-max(i-33,0)/10) for i in range(256) )
+
+# Letters at or above each quality score, to delete for `fraction_below`
+_PHRED_LETTERS_AT_OR_ABOVE = {}
+
+
+def _quality_bytes(group):
+    """Gets the PHRED letters of a group (or ReadRecord, or list of numbers,
+    or string of letters) as bytes.
+
+    :param group: the thing with qualities
+    :type group: itermae.GroupStats or itermae.ReadRecord or list or str
+    :return: the qualities as PHRED letters
+    :rtype: bytes
+    """
+    if isinstance(group, GroupStats):
+        group = group.quality_string
+    elif isinstance(group, ReadRecord):
+        group = group.quality
+    elif isinstance(group, list):
+        group = phred_number_array_to_joined_string(group)
+    return group.encode('ascii')
+
+
+def _sequence_string(group):
+    """Gets the sequence of a group (or ReadRecord, or string) as a string.
+
+    :param group: the thing with a sequence
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the sequence
+    :rtype: str
+    """
+    if isinstance(group, GroupStats):
+        group = group.seq
+    if isinstance(group, str):
+        return group
+    return str(group.seq)
+
+
+def mean_quality(group):
+    """Mean PHRED quality of a group, for filters like 
+    `mean_quality(barcode) >= 30`.
+
+    :param group: the group (or ReadRecord, or PHRED letters)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the mean quality
+    :rtype: float
+    """
+    letters = _quality_bytes(group)
+    return ( sum(letters) - 33*len(letters) )/len(letters)
+
+
+def median_quality(group):
+    """Median PHRED quality of a group, same as `statistics.median` would give
+    on the `.quality` list (so the middle two averaged, if it's even).
+
+    :param group: the group (or ReadRecord, or PHRED letters)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the median quality
+    :rtype: float or int
+    """
+    letters = sorted(_quality_bytes(group))
+    middle = len(letters)//2
+    if len(letters) % 2 == 1:
+        return letters[middle] - 33
+    return ( letters[middle-1] + letters[middle] - 66 )/2
+
+
+def min_quality(group):
+    """Lowest PHRED quality in a group.
+
+    :param group: the group (or ReadRecord, or PHRED letters)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the lowest quality
+    :rtype: int
+    """
+    return min(_quality_bytes(group)) - 33
+
+
+def fraction_below(group, quality):
+    """Fraction of the bases in a group that have a PHRED quality below 
+    `quality`, for filters like `fraction_below(barcode,20) < 0.1`.
+
+    :param group: the group (or ReadRecord, or PHRED letters)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :param quality: the PHRED quality to count bases below
+    :type quality: int
+    :return: the fraction of bases below that quality
+    :rtype: float
+    """
+    letters = _quality_bytes(group)
+    try:
+        at_or_above = _PHRED_LETTERS_AT_OR_ABOVE[quality]
+    except KeyError:
+        at_or_above = bytes(range(min(max(quality+33,0),256),256))
+        _PHRED_LETTERS_AT_OR_ABOVE[quality] = at_or_above
+    return len(letters.translate(None, at_or_above))/len(letters)
+
+
+def expected_errors(group):
+    """Expected number of errors in a group, the sum over the bases of the
+    error probability from each PHRED quality, for filters like 
+    `expected_errors(barcode) < 1`.
+
+    :param group: the group (or ReadRecord, or PHRED letters)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the expected number of errors
+    :rtype: float
+    """
+    letters = _quality_bytes(group)
+    if len(letters) == 0:
+        raise ValueError("expected_errors of an empty group")
+    return sum(map(_PHRED_ERROR_PROBABILITIES.__getitem__, letters))
+
+
+def n_count(group):
+    """How many N's (either case) are in the sequence of a group.
+
+    :param group: the group (or ReadRecord, or sequence string)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the count of N's
+    :rtype: int
+    """
+    seq = _sequence_string(group)
+    return seq.count('N') + seq.count('n')
+
+
+def gc_fraction(group):
+    """Fraction of the sequence of a group that is G or C (either case).
+
+    :param group: the group (or ReadRecord, or sequence string)
+    :type group: itermae.GroupStats or itermae.ReadRecord or str
+    :return: the GC fraction
+    :rtype: float
+    """
+    seq = _sequence_string(group)
+    return ( seq.count('G') + seq.count('C') + seq.count('g') + 
+        seq.count('c') ) / len(seq)
+
+
+class ReadRecord:
+    """This is a light-weight sequence record, used to hold reads and the 
+    groups chopped out of them instead of BioPython SeqRecords. The qualities
+    are kept as the string of PHRED letters as read in from the input
+    (Illumina 1.8+, offset 33), or None if the input didn't have any.
+    Slicing one gives the same slice of the sequence and the qualities, and
+    adding two together concatenates them, like SeqRecords do.
+
+    :param id: the ID of the read
+    :type id: str
+    :param description: the description of the read, without the ID
+    :type description: str
+    :param seq: the sequence
+    :type seq: str
+    :param quality: the qualities, as PHRED letters, defaults to None
+    :type quality: str, optional
+    """
+    __slots__ = ['id','description','seq','quality']
+
+    def __init__(self, id, description, seq, quality=None):
+        self.id = id
+        self.description = description
+        self.seq = seq
+        self.quality = quality
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self,index):
+        return ReadRecord(self.id, self.description, self.seq[index],
+            None if self.quality is None else self.quality[index] )
+
+    def __add__(self,other):
+        if not isinstance(other, ReadRecord):
+            return NotImplemented
+        return ReadRecord(self.id, self.description, self.seq+other.seq,
+            self.quality+other.quality )
+
+    def __repr__(self):
+        return ( "ReadRecord(id="+repr(self.id)+", description="+
+            repr(self.description)+", seq="+repr(self.seq)+", quality="+
+            repr(self.quality)+")" )
+
+    @property
+    def letter_annotations(self):
+        """The qualities as a list of PHRED numbers, under 'phred_quality',
+        like a SeqRecord has them. This is converted each time!
+        """
+        if self.quality is None:
+            return {}
+        return {'phred_quality':
+            phred_joined_string_to_number_array(self.quality) }
+
+    @classmethod
+    def from_seqrecord(cls,record):
+        """Makes a ReadRecord out of a BioPython SeqRecord.
+
+        :param record: the SeqRecord to convert
+        :type record: Bio.SeqRecord.SeqRecord
+        :return: the converted record
+        :rtype: itermae.ReadRecord
+        """
+        try:
+            quality = phred_number_array_to_joined_string(
+                record.letter_annotations['phred_quality'])
+        except KeyError:
+            quality = None
+        return cls(record.id, record.description, str(record.seq), quality)
+
+    def to_seqrecord(self):
+        """Makes a BioPython SeqRecord out of this, for writing with SeqIO.
+
+        :return: the converted record
+        :rtype: Bio.SeqRecord.SeqRecord
+        """
+        record = SeqRecord.SeqRecord(Seq.Seq(self.seq), id=self.id,
+            description=self.description)
+        if self.quality is not None:
+            record.letter_annotations = self.letter_annotations
+        return record
+
+
+class ReadSpan(ReadRecord):
+    """A view of a stretch of a read, from `start` to `end` in the original
+    input read, without copying the sequence or qualities out of it. This is 
+    what matching makes for each group, so a group that no output uses 
+    never gets sliced out, and a match that uses a group (like 
+    `rest > ...`) slices the original read again instead of a copy of a copy.
+    The `seq` and `quality` are sliced out the first time they're asked for,
+    and then kept. Otherwise it's used just like a ReadRecord, and adding
+    it to something makes a ReadRecord.
+
+    :param read: the original read this is a stretch of
+    :type read: itermae.ReadRecord
+    :param start: where the stretch starts in the original read
+    :type start: int
+    :param end: where the stretch ends in the original read
+    :type end: int
+    """
+    __slots__ = ['read','start','end','_seq','_quality']
+
+    def __init__(self, read, start, end):
+        self.read = read
+        self.start = start
+        self.end = end
+        self._seq = None
+        self._quality = None
+
+    @classmethod
+    def of(cls, record, start, end):
+        """Makes a span of `start` to `end` in `record`, which can be a read 
+        or another span. For a span, the offsets are added to where it is, so
+        the new span still points into the original read.
+
+        :param record: the read or span to take a stretch of
+        :type record: itermae.ReadRecord or itermae.ReadSpan
+        :param start: start of the stretch, in `record`
+        :type start: int
+        :param end: end of the stretch, in `record`
+        :type end: int
+        :return: the span
+        :rtype: itermae.ReadSpan
+        """
+        if isinstance(record, ReadSpan):
+            return cls(record.read, record.start+start, record.start+end)
+        return cls(record, start, end)
+
+    @property
+    def id(self):
+        return self.read.id
+
+    @property
+    def description(self):
+        return self.read.description
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = self.read.seq[self.start:self.end]
+        return self._seq
+
+    @property
+    def quality(self):
+        if self._quality is None and self.read.quality is not None:
+            self._quality = self.read.quality[self.start:self.end]
+        return self._quality
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self,index):
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, end, _ = index.indices(self.end - self.start)
+            return ReadSpan(self.read, self.start+start, 
+                self.start+max(start,end) )
+        return ReadRecord.__getitem__(self,index)
+
+    def __repr__(self):
+        return ( "ReadSpan(read="+repr(self.read.id)+", start="+
+            repr(self.start)+", end="+repr(self.end)+", seq="+
+            repr(self.seq)+")" )
+
+    def __reduce__(self):
+        # Sending it somewhere else sends just the stretch, as a ReadRecord
+        return ( ReadRecord, 
+            (self.id, self.description, self.seq, self.quality) )
+
+
+def split_title(title):
+    """Splits a FASTQ/FASTA title line into the ID (up to the first 
+    whitespace) and the description (the rest).
+
+    :param title: title line, without the leading '@' or '>'
+    :type title: str
+    :return: the ID and the description
+    :rtype: tuple of str
+    """
+    parts = title.split(None,1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    elif parts:
+        return parts[0], ""
+    else:
+        return "", ""
+
+
+def iterate_lines(fh, block_size=1048576):
+    """Reads a file handle in big blocks, and yields the lines in them. This
+    is for streaming through an input with constant memory, however big it
+    is. Lines are yielded without the newline at the end.
+
+    :param fh: file handle to read
+    :type fh: file handle opened by `Configuration.open_input_fh`
+    :param block_size: how many characters to read at once, defaults to 1MB
+    :type block_size: int, optional
+    :return: yields lines
+    :rtype: str
+    """
+    remainder = ""
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            break
+        lines = (remainder+block).split("\n")
+        remainder = lines.pop() # this is the start of a line in the next block
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def read_fastq_file(fh):
+    """This is a minimal streaming FASTQ reader, yielding ReadRecords with the
+    qualities left as the letters they're written as. Most FASTQ files have 
+    four lines per record, but this also handles sequences and qualities
+    wrapped over several lines.
+    
+    :param fh: file handle to read
+    :type fh: file handle opened by `Configuration.open_input_fh`
+    :raises ValueError: if the file doesn't look like FASTQ
+    :return: yields ReadRecords
+    :rtype: itermae.ReadRecord
+    """
+    lines = iterate_lines(fh)
+    line = next(lines,None)
+    while line is not None:
+        if line[:1] != '@':
+            if line.strip() == '': # skipping blank lines between records
+                line = next(lines,None)
+                continue
+            raise ValueError("This FASTQ record doesn't start with an '@', "
+                "it starts with the line: "+repr(line))
+        title = line[1:].rstrip()
+        seq_lines = []
+        line = next(lines,None)
+        while line is not None and line[:1] != '+':
+            seq_lines.append(line.rstrip())
+            line = next(lines,None)
+        if line is None:
+            raise ValueError("This FASTQ record '"+title+"' ended before a "
+                "'+' line.")
+        seq = "".join(seq_lines)
+        # Qualities can start with '@', so read them by length instead
+        quality_lines = []
+        quality_length = 0
+        while quality_length < len(seq):
+            line = next(lines,None)
+            if line is None:
+                break
+            quality_lines.append(line.rstrip())
+            quality_length += len(quality_lines[-1])
+        if quality_length != len(seq):
+            raise ValueError("This FASTQ record '"+title+"' has a different "
+                "number of qualities than bases.")
+        record_id, description = split_title(title)
+        yield ReadRecord(record_id, description, seq, "".join(quality_lines))
+        line = next(lines,None)
+
+
+def read_fasta_file(fh):
+    """This is a minimal streaming FASTA reader, yielding ReadRecords without
+    qualities. Sequences can be wrapped over several lines.
+    
+    :param fh: file handle to read
+    :type fh: file handle opened by `Configuration.open_input_fh`
+    :return: yields ReadRecords
+    :rtype: itermae.ReadRecord
+    """
+    title = None # Anything before the first '>' is ignored
+    seq_lines = []
+    for line in iterate_lines(fh):
+        if line[:1] == '>':
+            if title is not None:
+                yield ReadRecord(*split_title(title), "".join(seq_lines))
+            title = line[1:].rstrip()
+            seq_lines = []
+        elif title is not None:
+            seq_lines.append(line.strip())
+    if title is not None:
+        yield ReadRecord(*split_title(title), "".join(seq_lines))
 
 
 def read_sam_file(fh):
-    """This is a minimal SAM reader, just for getting the fields I like and 
-    yielding SeqRecord objects, sort of like BioPython SeqIO. Here, we are
-    putting SAM tags into the description field so it should be possible to 
-    pass those through, but that's not well designed yet.
+    """This is a minimal streaming SAM reader, just for getting the fields I
+    like and yielding ReadRecord objects, sort of like BioPython SeqIO. 
+    Header lines (starting with '@') are skipped. Here, we are
+    putting any SAM tags into the description field (tab-separated) so it 
+    should be possible to pass those through, but that's not well designed 
+    yet. Qualities of '*' are taken as missing.
     
     :param fh: file handle to read
-    :type fh: file handle opened by
-    :return: yields SeqRecords
-    :rtype: Bio.SeqRecord.SeqRecord
+    :type fh: file handle opened by `Configuration.open_input_fh`
+    :raises ValueError: if a line has too few fields to be SAM
+    :return: yields ReadRecords
+    :rtype: itermae.ReadRecord
     """
-    for i in fh.readlines():
-        fields = i.rstrip('\n').split('\t')
-        yield SeqRecord.SeqRecord(
-            Seq.Seq(fields[9]),
-            id=fields[0],
-            letter_annotations={'phred_quality':
-                [phred_letter_to_number(i) for i in fields[10]]},
-            description=fields[11]
-            )
+    for line in iterate_lines(fh):
+        line = line.rstrip('\r')
+        if line == '' or line[0] == '@':
+            continue
+        fields = line.split('\t')
+        if len(fields) < 11:
+            raise ValueError("This SAM line has "+str(len(fields))+" fields, "
+                "but I need at least 11 : "+repr(line))
+        yield ReadRecord(fields[0], "\t".join(fields[11:]), 
+            "" if fields[9] == '*' else fields[9],
+            None if fields[10] == '*' else fields[10])
 
 
 def read_txt_file(fh):
-    """Reads a text file, and yields SeqRecords where the string in the line
-    is the sequence and the ID of the record.
+    """Reads a text file, and yields ReadRecords where the string in the line
+    is the sequence and the ID of the record. Blank lines are skipped.
     
-    :param fh: file handle opened by 
-    :type fh: file handle opened by 
-    :return: yields SeqRecords
-    :rtype: Bio.SeqRecord.SeqRecord
+    :param fh: file handle to read
+    :type fh: file handle opened by `Configuration.open_input_fh`
+    :return: yields ReadRecords
+    :rtype: itermae.ReadRecord
+    """
+    for line in iterate_lines(fh):
+        seq = line.strip()
+        if seq:
+            yield ReadRecord(seq, "", seq)
+
+
+def format_title(record_id, description):
+    """Puts together the ID and description of a record into a FASTQ/FASTA
+    title line, the same way that BioPython SeqIO does. So, if the
+    description already starts with the ID, it's not repeated.
+
+    :param record_id: the ID of the record
+    :type record_id: str
+    :param description: the description of the record
+    :type description: str
+    :return: the title, without the leading '@' or '>'
+    :rtype: str
     """
-    for i in fh.readlines():
-        seq = i.rstrip()
-        yield SeqRecord.SeqRecord( Seq.Seq(seq), id=seq, description="")
+    record_id = record_id.replace("\n"," ").replace("\r"," ")
+    description = description.replace("\n"," ").replace("\r"," ")
+    if description and description.split(None,1)[0] == record_id:
+        return description
+    elif description:
+        return record_id+" "+description
+    else:
+        return record_id
 
 
 # TODO consider moving the 'which' bit to something specified in the 
 # build_context, sort of like 'id' and 'description'
+def format_record(seq,format,which):
+    """This formats a record as text for one of the four formats, and for SAM
+    appends a tag with which match this is, using the IE tag. Other formats
+    are handed to BioPython SeqIO, in case it knows them.
+    
+    :param seq: The record to format
+    :type seq: itermae.ReadRecord or Bio.SeqRecord.SeqRecord
+    :param format: which format to output, one of 'sam', 'txt', 'fastq',
+        'fasta', or something that Bio.SeqIO will recognize
+    :type format: str
+    :param which: which output this is, so for SAM this appened to a tag, but
+        is ignored for the other formats
+    :type which: str
+    :return: the formatted record, ending in a newline
+    :rtype: str
+    """
+    if isinstance(seq, SeqRecord.SeqRecord):
+        seq = ReadRecord.from_seqrecord(seq)
+    if format == "sam":
+        return format_sam_record( seq.id, seq.seq, seq.quality,
+                "IE:Z:"+str(which) )+"\n"
+        # We ignore printing the description anywhere - if you need it, concat
+        # it onto the ID
+    elif format == "txt":
+        return seq.seq+"\n"
+    elif format == "fastq":
+        if len(seq.quality) != len(seq.seq):
+            raise ValueError("Record "+seq.id+" has a sequence length of "+
+                str(len(seq.seq))+" but "+str(len(seq.quality))+
+                " quality scores.")
+        return ( "@"+format_title(seq.id,seq.description)+"\n"+
+            seq.seq+"\n+\n"+seq.quality+"\n" )
+    elif format == "fasta": # wrapped at 60, like SeqIO
+        return ( ">"+format_title(seq.id,seq.description)+"\n"+
+            "".join([ seq.seq[i:i+60]+"\n" for i in range(0,len(seq.seq),60) ]) )
+    else:
+        handle = io.StringIO()
+        SeqIO.write(seq.to_seqrecord(), handle, format) 
+        return handle.getvalue()
+
+
 def write_out_seq(seq,fh,format,which):
-    """This little utility just handles which of the four formats to print out,
-    and for SAM appends a tag with which match this is, using the IE tag.
+    """This little utility just writes out one record to a file handle, 
+    formatted by `format_record`.
     
-    :param seq: The SeqRecord to write
-    :type seq: Bio.SeqRecord
+    :param seq: The record to write
+    :type seq: itermae.ReadRecord or Bio.SeqRecord.SeqRecord
     :param fh: file handle
     :type fh: file handle returned by
     :param format: which format to output, one of 'sam', 'txt', or something
@@ -153,16 +689,420 @@ def write_out_seq(seq,fh,format,which):
     :return: nothing, it writes to a file
     :rtype: None
     """
-    if format == "sam":
-        print( format_sam_record( seq.id, str(seq.seq),
-                phred_number_array_to_joined_string(seq.letter_annotations['phred_quality']),
-                "IE:Z:"+str(which) ),file=fh)
-        # We ignore printing the description anywhere - if you need it, concat
-        # it onto the ID
-    elif format == "txt":
-        print( str(seq.seq), file=fh)
+    fh.write(format_record(seq,format,which))
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """This reads a gzipped file handle, but decompresses it on a separate 
+    thread, so that the decompressing can happen while the main thread is 
+    matching. `zlib` lets go of Python's lock while it's working, so these
+    really do overlap. The decompressed blocks are passed over in a queue, 
+    which only holds a few so that a fast decompressor doesn't fill up the 
+    memory. Files of several gzip members one after the other (like BGZF)
+    are read through, like `gzip` does.
+
+    It's a raw binary stream, so wrap it in `io.BufferedReader` and 
+    `io.TextIOWrapper` to read text.
+
+    :param fh: binary file handle of the gzipped data
+    :type fh: file handle
+    :param block_size: how many compressed bytes to read at once, and the 
+        most decompressed bytes to put in each block, defaults to 1MB
+    :type block_size: int, optional
+    :param queue_size: how many decompressed blocks to hold, defaults to 8
+    :type queue_size: int, optional
+    """
+
+    def __init__(self, fh, block_size=1048576, queue_size=8):
+        super().__init__()
+        self.fh = fh
+        self.block_size = block_size
+        self.blocks = queue.Queue(queue_size)
+        self.current = memoryview(b'') # the block being read from
+        self.finished = False
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self.decompress, daemon=True)
+        self.thread.start()
+
+    def decompress(self):
+        """This is what the thread runs, putting blocks in the queue and 
+        then None at the end. Any error is saved to be raised in `readinto`.
+        """
+        try:
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            started = False # if this member has any data yet
+            while not self.stopping:
+                data = self.fh.read(self.block_size)
+                if not data:
+                    break
+                while data and not self.stopping:
+                    if not started:
+                        # gzip files can be padded with zeros at the end
+                        data = data.lstrip(b'\x00')
+                        if not data:
+                            break
+                        started = True
+                    block = decompressor.decompress(data, self.block_size)
+                    if block:
+                        self.blocks.put(block)
+                    if decompressor.eof: # on to the next member, if any
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+                        started = False
+                    else:
+                        data = decompressor.unconsumed_tail
+            if started and not self.stopping:
+                raise EOFError("The gzipped input ended before the end of "
+                    "the compressed data, is it cut short?")
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.blocks.put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.current):
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.current = memoryview(block)
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        """Stops the thread, if it's still going, and closes the file."""
+        self.stopping = True
+        while not self.finished:
+            self.finished = self.blocks.get() is None
+        self.fh.close()
+        super().close()
+
+
+class CompressedFileWriter:
+    """This is a file handle for writing compressed text, as either gzip or
+    BGZF (the block gzip format used by `samtools`/`htslib`, which can be
+    read by anything that reads gzip). The text is cut into blocks, and 
+    each block is compressed as a separate gzip member on a pool of 
+    threads, so that the compressing doesn't hold up the chopping. `zlib` 
+    lets go of Python's lock while it's working. The compressed blocks are 
+    written out in order.
+
+    :param fh: binary file handle to write the compressed data to
+    :type fh: file handle
+    :param compression: 'gzip' or 'bgzf', defaults to 'gzip'
+    :type compression: str, optional
+    :param threads: how many threads to compress on, defaults to 1
+    :type threads: int, optional
+    :param level: compression level, 1 to 9, defaults to 6
+    :type level: int, optional
+    """
+
+    # BGZF blocks hold at most this much, as htslib does, so that each 
+    # compressed block fits in 64KB
+    BGZF_BLOCK_SIZE = 65280
+    # And BGZF files end with an empty block
+    BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000"
+        "000000000000")
+
+    def __init__(self, fh, compression='gzip', threads=1, level=6):
+        if compression not in ['gzip','bgzf']:
+            raise ValueError("I can compress outputs with 'gzip' or 'bgzf', "
+                "not '"+str(compression)+"'.")
+        self.fh = fh
+        self.compression = compression
+        self.level = level
+        self.block_size = self.BGZF_BLOCK_SIZE if compression == 'bgzf' \
+            else 1048576
+        self.pending = bytearray()
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.max_in_flight = 2*threads+2
+        self.in_flight = collections.deque()
+
+    def compress_block(self, data):
+        """Compresses one block of bytes into a gzip member, or BGZF block.
+
+        :param data: the bytes
+        :type data: bytes
+        :return: the compressed bytes
+        :rtype: bytes
+        """
+        if self.compression == 'gzip':
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 
+                16+zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 
+            -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        # The header has an extra field 'BC' with the whole block size - 1
+        return ( struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 
+                6, ord('B'), ord('C'), 2, len(deflated)+25 ) +
+            deflated +
+            struct.pack('<II', zlib.crc32(data), len(data)) )
+
+    def write_done(self, wait_for=0):
+        """Writes out compressed blocks that are done, in order, waiting 
+        until there's only `wait_for` left being compressed.
+        """
+        while len(self.in_flight) > wait_for or \
+                ( self.in_flight and self.in_flight[0].done() ):
+            self.fh.write(self.in_flight.popleft().result())
+
+    def write(self, text):
+        """Adds text to be compressed, sending off each full block to be
+        compressed.
+
+        :param text: the text
+        :type text: str
+        """
+        self.pending += text.encode('utf-8')
+        while len(self.pending) >= self.block_size:
+            self.in_flight.append( self.pool.submit( self.compress_block,
+                bytes(self.pending[:self.block_size]) ) )
+            del self.pending[:self.block_size]
+        self.write_done(self.max_in_flight)
+
+    def flush(self):
+        """Compresses and writes out everything so far, as a (maybe short)
+        block.
+        """
+        if self.pending:
+            self.in_flight.append( self.pool.submit( self.compress_block,
+                bytes(self.pending) ) )
+            self.pending.clear()
+        self.write_done()
+        self.fh.flush()
+
+    def close(self):
+        """Flushes, adds the BGZF end block if it's BGZF, and closes."""
+        self.flush()
+        self.pool.shutdown()
+        if self.compression == 'bgzf':
+            self.fh.write(self.BGZF_EOF)
+        self.fh.close()
+
+
+class OutputWriter:
+    """This is for writing to one output, such as the main output, the failed
+    reads, or the report. Records are formatted straight into a buffer, which
+    is written to the file handle in big blocks, instead of with a separate
+    small write for each record.
+
+    :param fh: file handle to write to
+    :type fh: file handle returned by `Configuration.open_output_fh`
+    :param format: the format to write records in, see `format_record`,
+        or None for an output of just lines of text (like the report)
+    :type format: str or None
+    :param buffer_size: how many characters to collect before writing,
+        defaults to 1MB
+    :type buffer_size: int, optional
+    """
+
+    def __init__(self, fh, format=None, buffer_size=1048576):
+        self.fh = fh
+        self.format = format
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self,text):
+        """Adds some text to the buffer, flushing it if it's full.
+
+        :param text: text to write
+        :type text: str
+        """
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_record(self,seq,which):
+        """Formats and buffers one record.
+
+        :param seq: The record to write
+        :type seq: itermae.ReadRecord
+        :param which: which output this is, see `format_record`
+        :type which: str
+        """
+        self.write(format_record(seq,self.format,which))
+
+    def flush(self):
+        """Writes out everything in the buffer to the file handle."""
+        if self.buffer:
+            self.fh.write("".join(self.buffer))
+            self.buffer.clear()
+            self.buffered = 0
+
+
+class _NameReplacer(ast.NodeTransformer):
+    """Swaps the names read in an expression for other expressions, for
+    `compile_output_functions`. 
+
+    :param replacements: dict of each name to replace, to either the python
+        expression (as a string) or the AST node to put in its place
+    :type replacements: dict
+    """
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.replacements:
+            replacement = self.replacements[node.id]
+            if isinstance(replacement, str):
+                replacement = ast.parse(replacement, mode='eval').body
+            else:
+                replacement = copy.deepcopy(replacement)
+            return ast.copy_location(replacement, node)
+        return node
+
+
+def _replace_names(expression, replacements):
+    """Parses a python expression and swaps out names in it, see
+    `_NameReplacer`.
+
+    :return: the body of the parsed and modified expression
+    :rtype: ast.expr
+    """
+    tree = ast.parse(expression, mode='eval')
+    return _NameReplacer(replacements).visit(tree).body
+
+
+def _added_names(node):
+    """If this expression is just names added together, like 
+    `upPrime+barcode+downPrime`, this returns those names in order.
+
+    :param node: the parsed expression
+    :type node: ast.expr
+    :return: list of the names, or None if it's anything more complicated
+    :rtype: list of str or None
+    """
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _added_names(node.left)
+        right = _added_names(node.right)
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+
+def _required_names(node):
+    """Finds the names that are always looked up when evaluating an
+    expression. Names only in the later parts of an `and`/`or`, in either
+    branch of an `... if ... else ...`, or inside a `lambda` or comprehension 
+    might not be looked up, so they aren't counted.
+
+    :param node: the parsed expression
+    :type node: ast.AST
+    :return: the names
+    :rtype: set of str
+    """
+    if isinstance(node, ast.Name):
+        return {node.id}
+    if isinstance(node, ast.BoolOp):
+        return _required_names(node.values[0])
+    if isinstance(node, ast.IfExp):
+        return _required_names(node.test)
+    if isinstance(node, ast.Lambda):
+        return set()
+    if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, 
+            ast.GeneratorExp)):
+        return _required_names(node.generators[0].iter)
+    names = set()
+    for child in ast.iter_child_nodes(node):
+        names |= _required_names(child)
+    return names
+
+
+def _record_from_output(id, description, seq):
+    """Builds the output ReadRecord from what the output `seq` expression
+    evaluated to, for the generated build functions that couldn't do this 
+    more directly.
+    """
+    return ReadRecord(id, description, str(seq.seq), seq.quality)
+
+
+def compile_output_functions(output_dict, group_names, match_ids):
+    """Turns an output specification into two python functions, one to 
+    evaluate the filter and one to build the output ReadRecord. This is done
+    once when configuring, so that each read doesn't have to build up 
+    dictionaries of contexts and `eval` them.
+
+    Each function takes the `seqs`, `group_stats`, and `match_scores` 
+    dicts of a `SeqHolder`. The names in the expressions are swapped for 
+    looking up the same thing that the `eval` contexts would have had under 
+    that name (see `SeqHolder.build_context`), so a group name in a filter 
+    becomes `group_stats['name']`, while in an ID it becomes 
+    `seqs['name'].seq`. Names that aren't groups or matches are left
+    alone, to be looked up in the module globals like before (so 
+    `statistics` and `median_quality` etc. still work). If a group isn't 
+    there for a read, the lookup fails and the filter or output fails, just 
+    like `eval` does.
+    A `seq` that's just groups added together, like 
+    `upPrime+barcode+downPrime`, is built by adding up the sequence and 
+    quality strings directly instead of making a ReadRecord for each `+`.
+
+    :param output_dict: the output specification, with the expression 
+        strings at `[0]` of 'filter', 'id', 'description', and 'seq'
+    :type output_dict: dict
+    :param group_names: all the names of groups the matches can make
+    :type group_names: list of str
+    :param match_ids: all the names of the matches, for their scores
+    :type match_ids: list of str
+    :return: the filter function and the build function
+    :rtype: tuple of functions
+    """
+    seq_names = ['input','dummyspacer'] + list(group_names)
+
+    filter_names = { 
+        **{ i: 'group_stats['+repr(i)+']' for i in group_names } ,
+        **{ i: 'match_scores['+repr(i)+']' for i in match_ids } }
+    id_names = { 
+        'id': "seqs['input'].id" ,
+        'description': "seqs['input'].description" ,
+        **{ i: 'seqs['+repr(i)+'].seq' for i in seq_names } ,
+        **{ i+'_quality': 'group_stats['+repr(i)+'].quality_string' 
+                for i in group_names } ,
+        **{ i+'_correction': 'group_stats['+repr(i)+'].correction' 
+                for i in group_names } }
+
+    added_names = _added_names(
+        ast.parse(output_dict['seq'][0], mode='eval').body )
+    if added_names is not None and all( i in seq_names for i in added_names ):
+        build_template = 'ReadRecord(str(ID), str(DESCRIPTION), SEQ, QUALITY)'
+        parts = { 
+            'SEQ': '+'.join( 'seqs['+repr(i)+'].seq' for i in added_names ) ,
+            'QUALITY': '+'.join( 'seqs['+repr(i)+'].quality' 
+                for i in added_names ) }
     else:
-        SeqIO.write(seq, fh, format) 
+        build_template = '_record_from_output(str(ID), str(DESCRIPTION), SEQ)'
+        parts = { 'SEQ': _replace_names( output_dict['seq'][0],
+            { i: 'seqs['+repr(i)+']' for i in seq_names } ) }
+    parts['ID'] = _replace_names(output_dict['id'][0], id_names)
+    parts['DESCRIPTION'] = _replace_names(output_dict['description'][0], 
+        id_names)
+
+    functions = []
+    for template, template_parts in [
+            ( 'FILTER', { 'FILTER': 
+                _replace_names(output_dict['filter'][0], filter_names) } ) ,
+            ( build_template, parts ) ]:
+        tree = ast.Expression( body=_replace_names(
+            'lambda seqs, group_stats, match_scores: '+template, 
+            template_parts ) )
+        functions.append( eval( compile( ast.fix_missing_locations(tree),
+            '<output '+str(output_dict['name'])+'>', 'eval' ), globals() ) )
+
+    return tuple(functions)
 
 
 class Configuration:
@@ -189,6 +1129,42 @@ class Configuration:
         self.output_fh = None
         self.failed_fh = None
         self.report_fh = None
+        self.output_writer = None
+        self.failed_writer = None
+        self.report_writer = None
+        self.processes = 1
+        self.unordered = False
+        self.batch_size = 1000
+        self.threads = 1
+        self.thread_pool = None
+        self.match_cache_size = 0
+        self.match_cache = None
+        self.collapse = None
+        self.collapsed_matches = {}
+        self.output_compression = None
+        self.stats_json = None
+        self.run_stats = None
+        self.progress = None
+        self.metrics_file = None
+        self.metrics_port = None
+        self.progress_reporter = None
+        self.report_summary = None
+        self.report_samples = 5
+        self.summary_report = None
+        self.output_stats = None
+        self.stats_writer = None
+        self.batch_engine = False
+        self.batch_chopper = None
+        self.demultiplex_group = None
+        self.sample_sheet = None
+        self.demultiplex_mismatches = 0
+        self.sample_index = None
+        self.whitelist = None
+        self.whitelist_group = None
+        self.whitelist_distance = 1
+        self.whitelist_index = None
+        self.count = False
+        self.count_memory = 1024
 
         # IUPAC dictionary for translating codes to regex.
         # from http://www.bioinformatics.org/sms/iupac.html
@@ -202,35 +1178,45 @@ class Configuration:
 
     def open_input_fh(self):
         """Opens file-handle based on the configuration.
-        Requires `input` to be set.
-
-        :raises ValueError: Can't handle gzipped inputs on STDIN.
+        Requires `input` to be set. If the input starts like a gzip file
+        (or `gzipped` is set), then it's decompressed on another thread with
+        `ThreadedGzipReader`, either from a file or STDIN.
         """
         if self.input.upper() == 'STDIN':
-            if self.gzipped:
-                raise ValueError("I can't handle gzipped inputs on STDIN ! "
-                    "You shouldn't see this error, it shoulda been caught in "
-                    "the launcher script.") 
-            else:
-                self.input_fh = sys.stdin
+            try:
+                binary_fh = sys.stdin.buffer
+            except AttributeError: # then it's been replaced with something,
+                self.input_fh = sys.stdin # so just use that
+                return
         else:
-            if self.gzipped:
-                self.input_fh = gzip.open(self.input,'rt',encoding='ascii')
-            else:
-                self.input_fh = open(self.input,'rt')
+            binary_fh = open(self.input,'rb')
+
+        try:
+            is_gzipped = binary_fh.peek(2)[:2] == b'\x1f\x8b'
+        except AttributeError:
+            is_gzipped = False
+
+        if self.gzipped or is_gzipped:
+            self.input_fh = io.TextIOWrapper( io.BufferedReader(
+                    ThreadedGzipReader(binary_fh) ), 
+                encoding='ascii' )
+        elif self.input.upper() == 'STDIN':
+            self.input_fh = sys.stdin
+        else:
+            self.input_fh = io.TextIOWrapper(binary_fh)
 
     def open_appropriate_input_format(self):
         """Uses `input_format` and `input_fh` to set iterators
-        of SeqRecords from the appropriate inputs, in `input_seqs`.
+        of ReadRecords from the appropriate inputs, in `input_seqs`.
         Tries to handle all formats known, but will try with SeqIO
         in case there's one I didn't think about.
         """
         if   self.input_format == 'fastq':
-            self.input_seqs = SeqIO.parse(self.input_fh, self.input_format)
+            self.input_seqs = iter(read_fastq_file(self.input_fh))
         elif self.input_format == 'sam':
             self.input_seqs = iter(read_sam_file(self.input_fh))
         elif self.input_format == 'fasta':
-            self.input_seqs = SeqIO.parse(self.input_fh, self.input_format)
+            self.input_seqs = iter(read_fasta_file(self.input_fh))
         elif self.input_format == 'txt':
             self.input_seqs = iter(read_txt_file(self.input_fh))
         else:
@@ -238,12 +1224,40 @@ class Configuration:
                 "'. I will try and use the provided format name in BioPython "+
                 "SeqIO, and we will find out together if that works.",
                 file=sys.stderr) 
-            self.input_seqs = SeqIO.parse(self.input_fh, self.input_format)
+            self.input_seqs = ( 
+                ReadRecord.from_seqrecord(self.fix_description(each_seq))
+                for each_seq in SeqIO.parse(self.input_fh, self.input_format) )
+
+    def collapse_input_seqs(self):
+        """For `collapse` of 'reads', this reads all of `input_seqs` and
+        replaces it with just one record for each distinct sequence, in the
+        order they first showed up. The ID, description, and qualities are 
+        those of the first read with that sequence, and the number of reads
+        is tagged onto the ID like `;size=12` (as vsearch/usearch do), so
+        it ends up in the outputs' IDs. This needs to hold every distinct
+        sequence in memory.
+        """
+        collapsed = {}
+        total = 0
+        for record in self.input_seqs:
+            total += 1
+            try:
+                collapsed[record.seq][1] += 1
+            except KeyError:
+                collapsed[record.seq] = [record, 1]
+        if self.verbosity >= 1:
+            print("["+str(time.time())+"] : Collapsed "+str(total)+" reads "+
+                "into "+str(len(collapsed))+" distinct sequences.",
+                file=sys.stderr)
+        self.input_seqs = iter( 
+            ReadRecord(record.id+";size="+str(count), record.description,
+                record.seq, record.quality)
+            for record, count in collapsed.values() )
 
     def get_input_seqs(self):
         """This calls `open_input_fh()` to set the `input_fh` attribute,
         then calls `open_appropriate_input_format` to use this and the 
-        `input_format` attribute to save an iterator of SeqRecords
+        `input_format` attribute to save an iterator of ReadRecords
         into `input_seqs`.
 
         Note this is inconsistent with design of the output, will pick one or
@@ -254,7 +1268,9 @@ class Configuration:
 
     def open_output_fh(self,file_string):
         """Opens output file handle, which can then be written to later with 
-        a format specification.
+        a format specification. If `output_compression` is set, then files
+        and STDOUT are written through a `CompressedFileWriter`, and 
+        otherwise files ending in '.gz' are gzipped.
 
         Note this is inconsistent with design of the input, will pick one or
         the other ... later.
@@ -262,27 +1278,133 @@ class Configuration:
         :param file_string: file to wrote to, or STDOUT or STDERR
         :type file_string: str
         :return: file string for appending output
-        :rtype: file handle returned by `open()`
+        :rtype: file handle returned by `open()`, or 
+            `itermae.CompressedFileWriter`
         """
         if file_string is None:
             return None
+        compression = self.output_compression
+        if compression is None and file_string.endswith('.gz'):
+            compression = 'gzip'
         if file_string.upper() == 'STDOUT':
-            return sys.stdout
+            if compression is None:
+                return sys.stdout
+            sys.stdout.flush()
+            return CompressedFileWriter(sys.stdout.buffer, compression,
+                threads=self.threads)
         elif file_string.upper() == 'STDERR':
             return sys.stderr
-        else:
+        elif compression is None:
             return open(file_string,'a')
+        else:
+            return CompressedFileWriter(open(file_string,'ab'), compression,
+                threads=self.threads)
+
+    def open_writers(self):
+        """Opens the `output_fh`, `failed_fh`, and `report_fh` file handles,
+        and makes an `OutputWriter` for each as `output_writer`,
+        `failed_writer`, and `report_writer`. Failed reads are written in the
+        input format. When demultiplexing, the `output_writer` is instead a
+        `DemultiplexWriter`, which opens a file for each sample, and when 
+        counting it's a `CountWriter`, which writes a table at the end.
+        """
+        self.report_fh = self.open_output_fh(self.report)
+        self.failed_fh = self.open_output_fh(self.failed)
+        if self.count:
+            self.output_fh = self.open_output_fh(self.output)
+            self.output_writer = CountWriter(self.output_fh, self.count_memory)
+        elif self.sample_index is None:
+            self.output_fh = self.open_output_fh(self.output)
+            self.output_writer = OutputWriter(self.output_fh, 
+                self.output_format)
+        else:
+            self.output_writer = DemultiplexWriter(self.output, 
+                self.output_format, self.open_output_fh)
+        self.report_writer = None if self.report_fh is None else \
+            OutputWriter(self.report_fh)
+        self.failed_writer = None if self.failed_fh is None else \
+            OutputWriter(self.failed_fh, self.input_format)
 
     def close_fhs(self):
-        """This is for cleaning up, and tries to close file handles at
-        `input_seqs`, `ouput_fh`, `failed_fh`, `report_fh`.
+        """This is for cleaning up, and tries to flush and close the writers
+        and then close file handles at `input_seqs`, `ouput_fh`, `failed_fh`, 
+        `report_fh`.
         """
+        for i in [ self.output_writer, self.failed_writer, self.report_writer ]:
+            if i is not None:
+                i.flush()
+        if isinstance(self.output_writer, (DemultiplexWriter, CountWriter)):
+            self.output_writer.close()
         for i in [ self.input_seqs, self.output_fh, self.failed_fh, self.report_fh] :
             try:
                 i.close()
             except:
                 pass
 
+    def __getstate__(self):
+        """This is for sending the configuration to worker processes (with
+        `pickle`). File handles and the input iterator are left behind, and
+        the `compile`'d expressions and generated functions of the outputs
+        are dropped, because code objects don't pickle. They get re-compiled
+        in `__setstate__`.
+        """
+        state = self.__dict__.copy()
+        for each in ['input_fh','input_seqs','output_fh','failed_fh','report_fh',
+                'output_writer','failed_writer','report_writer','thread_pool',
+                'progress_reporter','batch_chopper']:
+            state[each] = None
+        state['collapsed_matches'] = {}
+        state['outputs_array'] = [
+            {   'name': each['name'],
+                **{ i: each[i][0] for i in ['filter','id','seq','description'] } }
+            for each in self.outputs_array ]
+        return state
+
+    def __setstate__(self,state):
+        """Restores a pickled configuration, re-compiling the output
+        expressions that were dropped by `__getstate__`.
+        """
+        state['outputs_array'] = [
+            {   'name': each['name'],
+                **{ i: [ each[i], compile(each[i],'<string>','eval',optimize=2) ]
+                    for i in ['filter','id','seq','description'] } }
+            for each in state['outputs_array'] ]
+        self.__dict__.update(state)
+        self.compile_outputs()
+
+    def compile_outputs(self):
+        """Generates the filter and build functions for each output (see
+        `compile_output_functions`), and stores them in each output's dict
+        as 'filter_function' and 'build_function'. This needs to know all
+        the group names the matches can make, so it's re-done at the end of
+        each of the `config_from_` methods.
+        """
+        group_names = self.list_group_names()
+        match_ids = [ 'match_'+str(i) for i in range(len(self.matches_array)) ]
+        self.plan_outputs(group_names, match_ids)
+        for each in self.outputs_array:
+            try:
+                each['filter_function'], each['build_function'] = \
+                    compile_output_functions(each, group_names, match_ids)
+            except Exception as error:
+                raise ValueError(repr(error)+" : "
+                    "I failed to turn the output '"+str(each['name'])+"' "
+                    "into python functions, do the 'filter', 'id', 'seq', "
+                    "and 'description' look like python expressions?")
+
+    def list_group_names(self):
+        """Lists the names of all the groups the matches can make, in the
+        order they're first made.
+
+        :rtype: list of str
+        """
+        group_names = []
+        for each in self.matches_array:
+            for name in each['regex'].groupindex:
+                if name not in group_names:
+                    group_names.append(name)
+        return group_names
+
     def check_reserved_name(self,name,
             reserved_names=['dummyspacer','input','id','description'] ):
         """This checks if the name is one of a reserved list, and raises error
@@ -303,6 +1425,73 @@ class Configuration:
                 (" or ".join(reserved_names[ [(i == name) for i in reserved_names]]))+
                 ", I'm using that/those! Pick a different name.")
 
+    def plan_outputs(self, group_names, match_ids):
+        """Works out which matches each output actually needs, so that 
+        `SeqHolder.write_outputs` can apply only those, and which groups the
+        filter and the building of each output can't do without, so it can 
+        skip either as soon as one of those is missing. These are stored in 
+        each output's dict as 'matches' (a sorted list of indices into 
+        `matches_array`), 'required_groups' (for the filter), and 
+        'build_groups' (for the 'id', 'seq', and 'description').
+
+        A match is needed if an output uses one of its groups or its 
+        `match_` scores (or makes the `demultiplex_group`), or if it makes 
+        the input of another needed match.
+        If the same group name is made by more than one match, then the 
+        order the matches are applied in matters, so then every output just
+        needs every match.
+
+        :param group_names: all the names of groups the matches can make
+        :type group_names: list of str
+        :param match_ids: all the names of the matches, for their scores
+        :type match_ids: list of str
+        """
+        made_by = {}
+        for index, each in enumerate(self.matches_array):
+            for name in each['regex'].groupindex:
+                made_by.setdefault(name, []).append(index)
+        lazy = all( len(i) == 1 for i in made_by.values() )
+
+        def needing(index, needed):
+            if index in needed:
+                return
+            needed.add(index)
+            for input_match in made_by.get(self.matches_array[index]['input'],[]):
+                needing(input_match, needed)
+
+        for each in self.outputs_array:
+            trees = [ ast.parse(each[i][0], mode='eval') 
+                for i in ['filter','id','seq','description'] ]
+            names = { node.id for tree in trees for node in ast.walk(tree)
+                if isinstance(node, ast.Name) }
+            # Every output needs the index group to know where to go, but can
+            # still be written (as unassigned) without it
+            if self.demultiplex_group is not None:
+                names.add(self.demultiplex_group)
+            needed = set()
+            if lazy:
+                for name in names:
+                    if name in match_ids:
+                        needing(match_ids.index(name), needed)
+                    for group in [ name ] + [ name[:-len(suffix)] 
+                            for suffix in ['_quality','_correction']
+                                if name.endswith(suffix) ]:
+                        for index in made_by.get(group,[]):
+                            needing(index, needed)
+            else:
+                needed = set(range(len(self.matches_array)))
+            each['matches'] = sorted(needed)
+            # Only what the filter needs can fail the filter, what the rest 
+            # needs can only fail the building of the output
+            for key, these_trees in [ ('required_groups', trees[:1]),
+                    ('build_groups', trees[1:]) ]:
+                required = set()
+                for tree in these_trees:
+                    required |= _required_names(tree)
+                each[key] = [ i for i in group_names 
+                    if i in required or i+'_quality' in required or 
+                        i+'_correction' in required ]
+
     def config_from_file(self,file_path):
         """Tries to parse a configuration YAML file to update this configuration
         object. Pass in the file path as an argument.
@@ -363,17 +1552,78 @@ class Configuration:
             self.output_format = config['output_format']
         except:
             pass
-
-        # Immediately use that verbostiy
-        if self.verbosity >= 1:
-            print("Reading and processing the configuration file '"+
-                str(file_path)+"'.",file=sys.stderr)
-    
-        # Building array of matches objects, so input and compiled regex
-        if self.verbosity >= 1:
-            print("Processing each match:",file=sys.stderr)
-        for each in config['matches']:
-            try:
+        try:
+            self.processes = int(config['processes'])
+        except:
+            pass
+        try:
+            self.unordered = config['unordered']
+        except:
+            pass
+        try:
+            self.batch_size = int(config['batch_size'])
+        except:
+            pass
+        try:
+            self.threads = int(config['threads'])
+        except:
+            pass
+        try:
+            self.match_cache_size = int(config['match_cache_size'])
+        except:
+            pass
+        try:
+            if config['collapse']:
+                self.collapse = str(config['collapse']).lower()
+        except:
+            pass
+        try:
+            self.batch_engine = config['batch_engine']
+        except:
+            pass
+        try:
+            self.demultiplex_group = config['demultiplex_group']
+        except:
+            pass
+        try:
+            self.sample_sheet = config['sample_sheet']
+        except:
+            pass
+        try:
+            self.demultiplex_mismatches = int(config['demultiplex_mismatches'])
+        except:
+            pass
+        try:
+            self.whitelist = config['whitelist']
+        except:
+            pass
+        try:
+            self.whitelist_group = config['whitelist_group']
+        except:
+            pass
+        try:
+            self.whitelist_distance = int(config['whitelist_distance'])
+        except:
+            pass
+        try:
+            self.count = config['count']
+        except:
+            pass
+        try:
+            self.count_memory = float(config['count_memory'])
+        except:
+            pass
+
+        # Immediately use that verbostiy
+        if self.verbosity >= 1:
+            print("Reading and processing the configuration file '"+
+                str(file_path)+"'.",file=sys.stderr)
+    
+        # Building array of matches objects, so input and compiled regex
+        if self.verbosity >= 1:
+            print("Processing each match:",file=sys.stderr)
+        for each in config['matches']:
+            try:
                 each['use']
             except:
                 each['use'] = 'input'
@@ -406,6 +1656,7 @@ class Configuration:
                     pattern_groups[mark] = character.upper()
 
             regex_string = '' # building this now
+            prefilter_groups = [] # and what each group needs, for Prefilter
             for mark in group_order:
 
                 try:
@@ -423,6 +1674,7 @@ class Configuration:
                     self.untitled_group_number += 1
 
                 pattern_string = ""
+                repeats = None # (min, max) if it gets repeated, below
                 if len(set(pattern_groups[mark])) == 1:
                     pattern_string = self.iupac_codes[pattern_groups[mark][0].upper()]
                 else:
@@ -448,6 +1700,8 @@ class Configuration:
                         '{'+str(each['marked_groups'][mark]['repeat_min'])+','+
                             str(each['marked_groups'][mark]['repeat_max'])+'}'
                         )
+                    repeats = ( int(each['marked_groups'][mark]['repeat_min']),
+                        int(each['marked_groups'][mark]['repeat_max']) )
                     if self.verbosity >= 1:
                         print(", repeated between "+
                             str(each['marked_groups'][mark]['repeat_min'])+
@@ -488,10 +1742,28 @@ class Configuration:
                 regex_string += ( "(?<"+each['marked_groups'][mark]['name']+
                     ">"+pattern_string+")"+error_string )
 
+                prefilter_groups.append( ( pattern_groups[mark], repeats,
+                    { i: each['marked_groups'][mark][i] for i in 
+                        ['allowed_errors','allowed_insertions',
+                            'allowed_deletions','allowed_substitutions']
+                        if i in each['marked_groups'][mark] } ) )
+
             # Okay, then use the built up regex_string to compile it
             compiled_regex = regex.compile( regex_string, regex.BESTMATCH )
+            # Then what a sequence must have to possibly match it
+            try:
+                prefilter = Prefilter.from_groups(prefilter_groups)
+            except (ValueError, TypeError):
+                prefilter = None # if I can't understand it, don't prefilter
+            if self.verbosity >= 1 and prefilter is not None:
+                print("        Prefiltering for at least "+
+                    str(prefilter.min_length)+" long"+
+                    "".join( ", and an exact match to one of "+"/".join(i)
+                        for i in prefilter.kmer_sets )+
+                    ".",file=sys.stderr)
             # And save it with the input source used, in array
-            self.matches_array.append( {'input':each['use'], 'regex':compiled_regex} )
+            self.matches_array.append( {'input':each['use'], 
+                'regex':compiled_regex, 'prefilter':prefilter} )
     
         if self.verbosity >= 1:
             print("Processing output specifications.",file=sys.stderr)
@@ -551,6 +1823,42 @@ class Configuration:
             self.report = config['output_report']
         except:
             pass
+        try:
+            self.report_summary = config['output_report_summary']
+        except:
+            pass
+        try:
+            self.report_samples = int(config['report_samples'])
+        except:
+            pass
+        try:
+            self.output_stats = config['output_stats']
+        except:
+            pass
+        try:
+            if config['output_compression']:
+                self.output_compression = \
+                    str(config['output_compression']).lower()
+        except:
+            pass
+        try:
+            self.stats_json = config['stats_json']
+        except:
+            pass
+        try:
+            self.progress = float(config['progress'])
+        except:
+            pass
+        try:
+            self.metrics_file = config['metrics_file']
+        except:
+            pass
+        try:
+            self.metrics_port = int(config['metrics_port'])
+        except:
+            pass
+
+        self.compile_outputs()
 
 
     def config_from_args(self,args_copy):
@@ -656,64 +1964,2350 @@ class Configuration:
             self.failed = args_copy.failed
         if args_copy.report is not None:
             self.report = args_copy.report
+        if getattr(args_copy,'report_summary',None) is not None:
+            self.report_summary = args_copy.report_summary
+        if getattr(args_copy,'report_samples',None) is not None:
+            self.report_samples = args_copy.report_samples
+        if getattr(args_copy,'output_stats',None) is not None:
+            self.output_stats = args_copy.output_stats
+        # These are looked up with a default, so that a bare arguments object
+        # (without the parallel options) still works
+        if getattr(args_copy,'processes',None) is not None:
+            self.processes = args_copy.processes
+        if getattr(args_copy,'unordered',None) is not None:
+            self.unordered = args_copy.unordered
+        if getattr(args_copy,'batch_size',None) is not None:
+            self.batch_size = args_copy.batch_size
+        if getattr(args_copy,'threads',None) is not None:
+            self.threads = args_copy.threads
+        if getattr(args_copy,'match_cache_size',None) is not None:
+            self.match_cache_size = args_copy.match_cache_size
+        if getattr(args_copy,'collapse',None) is not None:
+            self.collapse = args_copy.collapse.lower()
+        if getattr(args_copy,'batch_engine',None) is not None:
+            self.batch_engine = args_copy.batch_engine
+        if getattr(args_copy,'demultiplex_group',None) is not None:
+            self.demultiplex_group = args_copy.demultiplex_group
+        if getattr(args_copy,'sample_sheet',None) is not None:
+            self.sample_sheet = args_copy.sample_sheet
+        if getattr(args_copy,'demultiplex_mismatches',None) is not None:
+            self.demultiplex_mismatches = args_copy.demultiplex_mismatches
+        if getattr(args_copy,'whitelist',None) is not None:
+            self.whitelist = args_copy.whitelist
+        if getattr(args_copy,'whitelist_group',None) is not None:
+            self.whitelist_group = args_copy.whitelist_group
+        if getattr(args_copy,'whitelist_distance',None) is not None:
+            self.whitelist_distance = args_copy.whitelist_distance
+        if getattr(args_copy,'count',None) is not None:
+            self.count = args_copy.count
+        if getattr(args_copy,'count_memory',None) is not None:
+            self.count_memory = args_copy.count_memory
+        if getattr(args_copy,'output_compression',None) is not None:
+            self.output_compression = args_copy.output_compression.lower()
+        if getattr(args_copy,'stats_json',None) is not None:
+            self.stats_json = args_copy.stats_json
+        if getattr(args_copy,'progress',None) is not None:
+            self.progress = args_copy.progress
+        if getattr(args_copy,'metrics_file',None) is not None:
+            self.metrics_file = args_copy.metrics_file
+        if getattr(args_copy,'metrics_port',None) is not None:
+            self.metrics_port = args_copy.metrics_port
+
+        if self.processes < 1:
+            raise ValueError("I need at least one process to run with, "
+                "not "+str(self.processes)+".")
+        if self.threads < 1:
+            raise ValueError("I need at least one thread to run with, "
+                "not "+str(self.threads)+".")
+        if self.batch_size < 1:
+            raise ValueError("The batch size needs to be at least one read, "
+                "not "+str(self.batch_size)+".")
+        if self.match_cache_size < 0:
+            raise ValueError("The match cache size can't be negative, "
+                "it's "+str(self.match_cache_size)+".")
+        if self.collapse not in [None,'matches','reads']:
+            raise ValueError("I can collapse 'matches' or 'reads', "
+                "not '"+str(self.collapse)+"'.")
+        if self.output_compression not in [None,'gzip','bgzf']:
+            raise ValueError("I can compress outputs with 'gzip' or 'bgzf', "
+                "not '"+str(self.output_compression)+"'.")
+        if self.report_samples < 0:
+            raise ValueError("The number of example reads to keep for the "
+                "summary report can't be negative, it's "+
+                str(self.report_samples)+".")
+        if self.progress is not None and self.progress <= 0:
+            raise ValueError("The progress interval needs to be more than "
+                "zero seconds, not "+str(self.progress)+".")
+        if self.metrics_port is not None and \
+                not 0 <= self.metrics_port <= 65535:
+            raise ValueError("The metrics port needs to be from 0 to 65535, "
+                "not "+str(self.metrics_port)+".")
+        self.build_indexes()
+        if self.count and self.count_memory <= 0:
+            raise ValueError("The memory for counting needs to be more "
+                "than zero megabytes, not "+str(self.count_memory)+".")
+        if self.batch_engine:
+            reason = BatchChopper.unsupported(self)
+            if reason is not None:
+                if self.verbosity >= 1:
+                    print("Not using the batch engine, because "+reason+
+                        ", so chopping read by read.",file=sys.stderr)
+                self.batch_engine = False
+
+        self.compile_outputs()
+
+    def build_indexes(self):
+        """Checks the demultiplexing and whitelist options, and reads the
+        `sample_sheet` into the `sample_index` and the `whitelist` into the
+        `whitelist_index`, if that isn't done already. This is done at the 
+        end of `config_from_args`, and again by `reader`, so that a 
+        configuration made only with `config_from_file` gets them too.
+
+        :raises ValueError: if the options don't go together, or the sample
+            sheet or whitelist is no good
+        """
+        if self.sample_index is None:
+            if ( self.sample_sheet is None ) != \
+                    ( self.demultiplex_group is None ):
+                raise ValueError("To demultiplex, I need both a sample sheet "
+                    "and the name of the group with the sample index.")
+            if self.sample_sheet is not None:
+                if self.demultiplex_group not in self.list_group_names():
+                    raise ValueError("The demultiplexing group '"+
+                        str(self.demultiplex_group)+"' isn't made by any "
+                        "match.")
+                if '{sample}' not in self.output:
+                    raise ValueError("When demultiplexing, the output needs "
+                        "'{sample}' in it, to be replaced with each sample "
+                        "name, not '"+str(self.output)+"'.")
+                if self.demultiplex_mismatches < 0:
+                    raise ValueError("The number of mismatches for "
+                        "demultiplexing can't be negative, it's "+
+                        str(self.demultiplex_mismatches)+".")
+                self.sample_index = SampleIndex.from_sample_sheet(
+                    self.sample_sheet, self.demultiplex_mismatches)
+        if self.whitelist_index is None:
+            if ( self.whitelist is None ) != ( self.whitelist_group is None ):
+                raise ValueError("To correct a group, I need both a "
+                    "whitelist and the name of the group to correct.")
+            if self.whitelist is not None:
+                if self.whitelist_group not in self.list_group_names():
+                    raise ValueError("The group to correct with the "
+                        "whitelist, '"+str(self.whitelist_group)+"', isn't "
+                        "made by any match.")
+                if self.whitelist_distance < 0:
+                    raise ValueError("The distance for correcting with the "
+                        "whitelist can't be negative, it's "+
+                        str(self.whitelist_distance)+".")
+                self.whitelist_index = Whitelist.from_file(
+                    self.whitelist, self.whitelist_distance)
+        if self.count and self.sample_index is not None:
+            raise ValueError("I can't count and demultiplex at the same "
+                "time, but you can add the index group to the output "
+                "sequence to count it.")
+
+    def summary(self):
+        return_string = ('Configured as:'+
+            '\n    input from: '+self.input+
+            '\n    input format: '+self.input_format+
+            '\n    is it gzipped?: '+str(self.gzipped)+
+            '\n    output APPENDING to: '+self.output+
+            '\n    output format is: '+self.output_format+
+            '\n    failed being APPENDED to file: '+str(self.failed)+
+            '\n    report being APPENDED to file: '+str(self.report)+
+            '\n    summary report being written to: '+
+                str(self.report_summary)+
+            '\n    per-read match statistics being written to: '+
+                str(self.output_stats)+
+            '\n    compressing outputs with: '+str(self.output_compression)+
+            '\n    writing run statistics to: '+str(self.stats_json)+
+            '\n    reporting progress every (seconds): '+str(self.progress)+
+            '\n    writing metrics to file: '+str(self.metrics_file)+
+            '\n    serving metrics on port: '+str(self.metrics_port)+
+            '\n    with verbosity set at: '+str(self.verbosity)+
+            '\n    using this many processes: '+str(self.processes)+
+            '\n    with this many matching threads each: '+str(self.threads)+
+            '\n    in batches of reads of size: '+str(self.batch_size)+
+            '\n    keeping the input order?: '+str(not self.unordered)+
+            '\n    remembering this many match results: '+
+                str(self.match_cache_size)+
+            '\n    collapsing identical sequences?: '+str(self.collapse)+
+            '\n    chopping in chunks with the batch engine?: '+
+                str(self.batch_engine)+
+            '\n    demultiplexing by group: '+str(self.demultiplex_group)+
+            '\n    with the sample sheet: '+str(self.sample_sheet)+
+            '\n    allowing this many index mismatches: '+
+                str(self.demultiplex_mismatches)+
+            '\n    correcting group: '+str(self.whitelist_group)+
+            '\n    with the whitelist: '+str(self.whitelist)+
+            '\n    allowing this many edits: '+str(self.whitelist_distance)+
+            '\n    counting the output sequences?: '+str(self.count)+
+            '\n    in about this much memory (MB): '+str(self.count_memory)+
+            '\n    doing these matches:')
+        for each in self.matches_array:
+            return_string += '\n        - input: '+each['input']
+            return_string += '\n          regex: '+str(each['regex'])
+        return_string += '\n    writing these outputs:'
+        for each in self.outputs_array:
+            return_string += '\n        - id: '+str(each['id'][0])
+            return_string += '\n          description: '+str(each['description'][0])
+            return_string += '\n          seq: '+str(each['seq'][0])
+            return_string += '\n          filter: '+str(each['filter'][0])
+        return return_string
+
+    def reader(self):
+        """This reads inputs, calls the `chop` method on each one, and sorts 
+        it off to outputs. So this is called by the main function, and is 
+        mostly about handling the I/O and handing it to the `chop` function.
+        Thus, this depends on the `Configuration` class being properly 
+        configured with all the appropriate values.
+        """
+
+        self.build_indexes()
+    
+        # The progress and metrics are read from the run statistics, too
+        if self.stats_json is not None or self.progress is not None or \
+                self.metrics_file is not None or self.metrics_port is not None:
+            self.run_stats = RunStats()
+            start_time = time.perf_counter()
+
+        # Input
+        self.get_input_seqs()
+        if self.run_stats is not None:
+            self.input_seqs = self.run_stats.timed_iter(self.input_seqs)
+        if self.collapse == 'reads':
+            self.collapse_input_seqs()
+    
+        # Outputs - passed records, failed records, report file
+        self.open_writers()
+
+        if self.match_cache_size > 0:
+            self.match_cache = MatchCache(self.match_cache_size)
+
+        if self.report_summary is not None:
+            self.summary_report = SummaryReport(self.report_samples)
+
+        if self.output_stats is not None:
+            self.stats_writer = MatchStatsWriter(self.output_stats,
+                [ 'match_'+str(i) for i in range(len(self.matches_array)) ],
+                self.list_group_names(),
+                [ each['name'] for each in self.outputs_array ] )
+
+        if self.progress is not None or self.metrics_file is not None or \
+                self.metrics_port is not None:
+            self.progress_reporter = ProgressReporter(self)
+            self.progress_reporter.start()
+
+        # Do the chop-ing...
+        try:
+            if self.processes > 1:
+                self.reader_processes()
+            else:
+                self.chop_records(self.input_seqs)
+        finally:
+            if self.progress_reporter is not None:
+                self.progress_reporter.stop()
+
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown()
+        self.close_fhs()
+        if self.stats_writer is not None:
+            self.stats_writer.close()
+
+        if self.match_cache is not None and self.verbosity >= 1:
+            print(self.match_cache.summary(),file=sys.stderr)
+
+        if self.sample_index is not None and self.verbosity >= 1:
+            print("Reads demultiplexed to each sample:"+"".join( 
+                    '\n    '+name+': '+str(count) for name, count in 
+                        self.sample_index.summary().items() ),
+                file=sys.stderr)
+
+        if self.whitelist_index is not None and self.verbosity >= 1:
+            print("Reads by how the group '"+self.whitelist_group+"' was "
+                    "corrected with the whitelist:"+"".join( 
+                    '\n    '+status+': '+str(count) for status, count in 
+                        self.whitelist_index.summary().items() ),
+                file=sys.stderr)
+
+        if isinstance(self.output_writer, CountWriter) and self.verbosity >= 1:
+            summary = self.output_writer.summary()
+            print("Counted "+str(summary['records'])+" output records, with "+
+                str(summary['distinct'])+" distinct sequences, spilling "+
+                str(summary['spilled_runs'])+" sorted runs to disk.",
+                file=sys.stderr)
+
+        if self.stats_json is not None:
+            self.write_stats_json(time.perf_counter()-start_time)
+
+        if self.summary_report is not None:
+            self.summary_report.write(self.report_summary)
+
+    def write_stats_json(self, seconds):
+        """Writes the `run_stats` of this run as JSON to `stats_json`, which
+        can be a file path (overwritten) or 'STDERR'. See `RunStats.summary`
+        for what's in it.
+
+        :param seconds: how long the whole run took
+        :type seconds: float
+        """
+        summary = self.run_stats.summary(self, seconds)
+        if self.match_cache is not None:
+            summary['match_cache'] = { match_id: 
+                    { 'hits': hits, 'misses': misses } 
+                for match_id, (hits, misses) in 
+                    sorted(self.match_cache.stats.items()) }
+        if self.sample_index is not None:
+            summary['demultiplex'] = self.sample_index.summary()
+        if self.whitelist_index is not None:
+            summary['whitelist'] = self.whitelist_index.summary()
+        if isinstance(self.output_writer, CountWriter):
+            summary['counts'] = self.output_writer.summary()
+        if self.stats_json.upper() == 'STDERR':
+            print(json.dumps(summary, indent=2), file=sys.stderr)
+        else:
+            with open(self.stats_json,'w') as f:
+                json.dump(summary, f, indent=2)
+                f.write('\n')
+
+    def chop_records(self,records):
+        """This runs `chop` on each of the input records, writing to whatever
+        output file-handles are currently set.
+
+        If `threads` is more than one, then the records are taken in batches
+        of `batch_size`, and the `SeqHolder.apply_matches` of each read in a
+        batch is run on a pool of threads. `regex` lets go of the GIL while
+        it's searching (`concurrent=True`), so these threads can overlap.
+        Filtering and writing outputs is still done one read at a time, in
+        order, in this thread - while the next batch is being matched.
+
+        With `batch_engine`, the records are instead chopped a batch at a
+        time by a `BatchChopper`.
+
+        :param records: an iterable of input ReadRecords
+        :type records: iterable of itermae.ReadRecord
+        """
+        if self.batch_engine:
+            if self.batch_chopper is None:
+                self.batch_chopper = BatchChopper(self)
+            self.batch_chopper.chop_records(records)
+            return
+
+        if self.threads <= 1:
+            seq_holder = None # one holder, reset for each read
+            for each_seq in records:
+                if seq_holder is None:
+                    seq_holder = SeqHolder(each_seq,configuration=self)
+                else:
+                    seq_holder.reset(each_seq)
+                seq_holder.chop()
+            return
+
+        if self.thread_pool is None:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        records = iter(records)
+        previous = None # the batch being matched while this one is written
+        spare = [] # holders from batches that are written, to be reset
+        while True:
+            batch = [ spare.pop().reset(each_seq) if spare else 
+                    SeqHolder(each_seq,configuration=self)
+                for each_seq in itertools.islice(records,self.batch_size) ]
+            matching = self.thread_pool.map(SeqHolder.apply_matches, batch)
+            if previous is not None:
+                for seq_holder in previous:
+                    seq_holder.write_outputs()
+                spare.extend(previous)
+            if not batch:
+                break
+            previous = list(matching) # this waits for the matching to be done
+
+    def fix_description(self,each_seq):
+        """Removes the ID from the description of an input record read by
+        BioPython SeqIO. The native readers already split these apart.
+
+        :param each_seq: the input record
+        :type each_seq: Bio.SeqRecord.SeqRecord
+        :return: the same record, with description modified
+        :rtype: Bio.SeqRecord.SeqRecord
+        """
+        # CAUTION
+        # The below is a munge. 
+        # According to https://github.com/biopython/biopython/issues/398 ,
+        # BioPython mimics an old tool's weird behavior by outputting the 
+        # ID in the description field. The fix for it relies on a comparing
+        # a white-space 'split' to remove the ID if it's in the description.
+        # So that doesn't work if you modify the ID or so, so I remove right
+        # after parsing.
+        each_seq.description = re.sub(str(each_seq.id),"",
+            each_seq.description).lstrip()
+        return each_seq
+
+    def chop_batch(self,records):
+        """Chops a batch of records, but writes into in-memory writers instead
+        of the configured file-handles, and returns what was written. This is
+        what each worker process does with a batch, so that only the main
+        process writes to the actual outputs.
+
+        :param records: a batch of input ReadRecords
+        :type records: list of itermae.ReadRecord
+        :return: the text for the output, failed, and report outputs, with
+            None for those that aren't configured. When demultiplexing, the
+            output text is a dict of the text for each sample, and when 
+            counting it's the counts, see `CountWriter.getvalues`.
+        :rtype: tuple of str or dict or None
+        """
+        if self.count:
+            self.output_writer = CountWriter(None, self.count_memory)
+        elif self.sample_index is None:
+            self.output_writer = OutputWriter(io.StringIO(), self.output_format)
+        else:
+            self.output_writer = DemultiplexWriter(self.output, 
+                self.output_format, lambda path: io.StringIO())
+        self.failed_writer = None if self.failed is None else \
+            OutputWriter(io.StringIO(), self.input_format)
+        self.report_writer = None if self.report is None else \
+            OutputWriter(io.StringIO())
+        self.chop_records(records)
+        texts = []
+        for writer in [ self.output_writer, self.failed_writer, self.report_writer ]:
+            if writer is None:
+                texts.append(None)
+            elif isinstance(writer, (DemultiplexWriter, CountWriter)):
+                texts.append(writer.getvalues())
+            else:
+                writer.flush()
+                texts.append(writer.fh.getvalue())
+        return tuple(texts)
+
+    def write_batch_texts(self,texts,stats_rows=None):
+        """Writes out the text returned by `chop_batch` to the real outputs,
+        and the rows for the `stats_writer` (so they're in the same order).
+
+        :param texts: the output, failed, and report text of a batch
+        :type texts: tuple of str or None
+        :param stats_rows: rows from `MatchStatsWriter.take_rows` of the
+            worker, or None
+        :type stats_rows: list of list, optional
+        """
+        if self.run_stats is not None:
+            start = time.perf_counter()
+        for text, writer in zip(texts,
+                [ self.output_writer, self.failed_writer, self.report_writer ] ):
+            if text:
+                writer.write(text)
+        if stats_rows:
+            self.stats_writer.add_rows(stats_rows)
+        if self.run_stats is not None:
+            self.run_stats.add_time(('write','output'), 
+                time.perf_counter()-start)
+
+    def reader_processes(self):
+        """Reads `input_seqs` in batches of `batch_size` reads, and hands these
+        to a pool of `processes` worker processes to chop. Each worker gets
+        a copy of this configuration once, when it starts up. The main process
+        writes the results in input order, unless `unordered` is set, in which
+        case batches are written as soon as they are done.
+        Only a few batches per process are in flight at any one time, so that
+        a fast reader doesn't pile the whole input up in memory.
+
+        The workers are started with 'spawn', not 'fork', so each gets its
+        copy of the configuration by pickling. That way the `__getstate__`
+        and `__setstate__` of it (and of the cache, statistics, and so on)
+        are what set the worker up, and it doesn't inherit the progress or
+        compression threads of this process, or a lock one of them holds.
+        """
+        batches = iter( lambda: list(itertools.islice(self.input_seqs,
+                self.batch_size)),
+            [] )
+        max_in_flight = 4*self.processes
+        finished = queue.Queue()
+        held = {} # results that came back before their turn to be written
+        next_index = 0 # which batch is due to be written next, if ordered
+        submitted = 0
+        written = 0
+
+        def collect():
+            nonlocal next_index, written
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            index, texts, cache_stats, run_stats, summary_stats, stats_rows, \
+                sample_stats, whitelist_stats = result
+            if cache_stats:
+                self.match_cache.add_stats(cache_stats)
+            if sample_stats:
+                self.sample_index.add_stats(sample_stats)
+            if whitelist_stats:
+                self.whitelist_index.add_stats(whitelist_stats)
+            if run_stats:
+                self.run_stats.add_stats(run_stats)
+            if summary_stats:
+                self.summary_report.add_stats(summary_stats)
+            if self.unordered:
+                self.write_batch_texts(texts, stats_rows)
+                written += 1
+                return
+            held[index] = (texts, stats_rows)
+            while next_index in held:
+                self.write_batch_texts(*held.pop(next_index))
+                next_index += 1
+                written += 1
+
+        with multiprocessing.get_context('spawn').Pool(self.processes,
+                initializer=_initialize_worker, initargs=(self,)) as pool:
+            for index, batch in enumerate(batches):
+                pool.apply_async(_chop_batch_in_worker, (index, batch),
+                    callback=finished.put, error_callback=finished.put)
+                submitted += 1
+                while submitted - written >= max_in_flight:
+                    collect()
+            while written < submitted:
+                collect()
+
+
+# This is the copy of the configuration that each worker process holds, set
+# once by the pool initializer so it's not sent along with every batch.
+_worker_configuration = None
+
+def _initialize_worker(configuration):
+    """Saves the configuration in a worker process of the pool, for
+    `Configuration.reader_processes`.
+
+    :param configuration: the configuration to chop with
+    :type configuration: itermae.Configuration
+    """
+    global _worker_configuration
+    _worker_configuration = configuration
+
+def _chop_batch_in_worker(index, batch):
+    """Chops a batch in a worker process, returning the batch number with the
+    results so that they can be put back in order.
+
+    :param index: the number of this batch, counting from 0
+    :type index: int
+    :param batch: the input records
+    :type batch: list of itermae.ReadRecord
+    :return: the index, the texts from `Configuration.chop_batch`, the 
+        match cache counts for this batch (or None without a cache), the
+        `RunStats` counts for this batch (or None without `stats_json`), 
+        the `SummaryReport` numbers (or None without `report_summary`), 
+        the `MatchStatsWriter` rows (or None without `output_stats`), the
+        `SampleIndex` counts (or None without demultiplexing), and the 
+        `Whitelist` counts (or None without a whitelist)
+    :rtype: tuple
+    """
+    texts = _worker_configuration.chop_batch(batch)
+    match_cache = _worker_configuration.match_cache
+    run_stats = _worker_configuration.run_stats
+    summary_report = _worker_configuration.summary_report
+    stats_writer = _worker_configuration.stats_writer
+    sample_index = _worker_configuration.sample_index
+    whitelist_index = _worker_configuration.whitelist_index
+    return ( index, texts, 
+        None if match_cache is None else match_cache.take_stats(),
+        None if run_stats is None else run_stats.take_stats(),
+        None if summary_report is None else summary_report.take_stats(),
+        None if stats_writer is None else stats_writer.take_rows(),
+        None if sample_index is None else sample_index.take_stats(),
+        None if whitelist_index is None else whitelist_index.take_stats() )
+
+
+class MatchCache:
+    """This remembers the results of the most recent match operations, so 
+    that the same sequence going through the same match (which happens a 
+    lot with amplicon libraries) doesn't need the `regex` search done again.
+    It maps the match ID and the (uppercase) sequence to the 
+    `fuzzy_counts` and the span of each group, or None if it didn't match.
+    When it's full, the least recently used result is forgotten.
+
+    It counts the hits and misses for each match ID, for `summary`. It's 
+    used from several threads at once with `threads`, so there's a lock. 
+    When pickled for a worker process, it only takes the size along, so 
+    each worker has its own empty cache, and hands back its counts with 
+    `take_stats`.
+
+    :param size: how many results to remember
+    :type size: int
+    """
+
+    # What `get` returns if it's not in the cache, since None is a result
+    MISSING = object()
+
+    def __init__(self, size):
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def __getstate__(self):
+        return {'size': self.size}
+
+    def __setstate__(self,state):
+        self.__init__(state['size'])
+
+    def get(self, match_id, seq):
+        """Looks up a result, and counts a hit or miss.
+
+        :param match_id: the match ID, like 'match_0'
+        :type match_id: str
+        :param seq: the uppercase sequence that's being searched
+        :type seq: str
+        :return: the result, or `MatchCache.MISSING` if it's not there
+        """
+        with self.lock:
+            counts = self.stats.setdefault(match_id, [0,0])
+            try:
+                result = self.results[(match_id, seq)]
+            except KeyError:
+                counts[1] += 1
+                return MatchCache.MISSING
+            self.results.move_to_end((match_id, seq))
+            counts[0] += 1
+            return result
+
+    def put(self, match_id, seq, result):
+        """Saves a result, forgetting the oldest one if it's full.
+
+        :param match_id: the match ID, like 'match_0'
+        :type match_id: str
+        :param seq: the uppercase sequence that was searched
+        :type seq: str
+        :param result: the `fuzzy_counts` and list of (group name, span), 
+            or None for no match
+        :type result: tuple or None
+        """
+        with self.lock:
+            self.results[(match_id, seq)] = result
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def take_stats(self):
+        """Returns the hit and miss counts, and resets them to zero.
+
+        :return: dict of match ID to a list of hits and misses
+        :rtype: dict
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def add_stats(self, stats):
+        """Adds on some counts, as returned by `take_stats` of another cache.
+
+        :param stats: dict of match ID to a list of hits and misses
+        :type stats: dict
+        """
+        with self.lock:
+            for match_id, (hits, misses) in stats.items():
+                counts = self.stats.setdefault(match_id, [0,0])
+                counts[0] += hits
+                counts[1] += misses
+
+    def summary(self):
+        """A report of the hit rates for each match, for the end of a run.
+
+        :rtype: str
+        """
+        return_string = 'Match cache hits:'
+        for match_id, (hits, misses) in sorted(self.stats.items()):
+            return_string += ( '\n    '+match_id+': '+str(hits)+' of '+
+                str(hits+misses)+' ('+
+                '{:.1f}'.format(100*hits/max(1,hits+misses))+'%)' )
+        return return_string
+
+
+class RunStats:
+    """This adds up how long is spent in each stage of chopping, and counts
+    how many reads pass or fail each match and output, for `stats_json`. 
+    It's only made if `stats_json` is set, so when it's not the only cost is
+    checking for it. Times are from `time.perf_counter`, and are summed
+    across threads (so with `threads` they can add up to more than the run
+    took).
+
+    Times are kept in `seconds` and counts in `counts`, each keyed by a 
+    tuple of the stage and name, like `('match','match_0')` or 
+    `('filter','barcode_output')`. Like `MatchCache`, there's a lock for 
+    threads, and each worker process gets its own empty one, and hands 
+    back its numbers with `take_stats`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.seconds = {}
+        self.counts = {}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self,state):
+        self.__init__()
+
+    def add_time(self, key, seconds):
+        """Adds on some time for a stage.
+
+        :param key: the stage and name, like `('build','some_output')`
+        :type key: tuple
+        :param seconds: how long it took
+        :type seconds: float
+        """
+        with self.lock:
+            self.seconds[key] = self.seconds.get(key,0) + seconds
+
+    def count(self, key, passed):
+        """Counts one read passing or failing a match or output.
+
+        :param key: the stage and name, like `('match','match_0')`
+        :type key: tuple
+        :param passed: did it match, or pass the filter?
+        :type passed: bool
+        """
+        with self.lock:
+            counts = self.counts.setdefault(key, [0,0])
+            counts[0 if passed else 1] += 1
+
+    def count_many(self, key, passed, failed):
+        """Counts a number of reads passing and failing a match or output at
+        once, for `BatchChopper`.
+
+        :param key: the stage and name, like `('match','match_0')`
+        :type key: tuple
+        :param passed: how many matched, or passed the filter
+        :type passed: int
+        :param failed: how many didn't
+        :type failed: int
+        """
+        with self.lock:
+            counts = self.counts.setdefault(key, [0,0])
+            counts[0] += passed
+            counts[1] += failed
+
+    def count_read(self, reads=1):
+        with self.lock:
+            self.reads += reads
+
+    def timed_iter(self, iterable, key=('parse','input')):
+        """Wraps an iterator of input records, adding the time spent getting
+        each record (reading, decompressing, parsing) to `key`.
+
+        :param iterable: the input records
+        :type iterable: iterable
+        :param key: what to add the time to
+        :type key: tuple
+        :return: the same records
+        :rtype: generator
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(iterator)
+            except StopIteration:
+                self.add_time(key, time.perf_counter()-start)
+                return
+            self.add_time(key, time.perf_counter()-start)
+            yield record
+
+    def snapshot(self):
+        """A copy of the read count and the counts so far, for reporting
+        progress from another thread.
+
+        :return: the reads, and the counts
+        :rtype: tuple
+        """
+        with self.lock:
+            return self.reads, { key: list(value) 
+                for key, value in self.counts.items() }
+
+    def take_stats(self):
+        """Returns the numbers so far, and resets them.
+
+        :return: the reads, seconds, and counts
+        :rtype: tuple
+        """
+        with self.lock:
+            stats = (self.reads, self.seconds, self.counts)
+            self.reads, self.seconds, self.counts = 0, {}, {}
+        return stats
+
+    def add_stats(self, stats):
+        """Adds on the numbers returned by `take_stats` of another one.
+
+        :param stats: the reads, seconds, and counts
+        :type stats: tuple
+        """
+        reads, seconds, counts = stats
+        with self.lock:
+            self.reads += reads
+            for key, value in seconds.items():
+                self.seconds[key] = self.seconds.get(key,0) + value
+            for key, (passed, failed) in counts.items():
+                these_counts = self.counts.setdefault(key, [0,0])
+                these_counts[0] += passed
+                these_counts[1] += failed
+
+    def summary(self, configuration, seconds):
+        """Puts the numbers together in a dict, for writing as JSON. There's
+        the total `reads` and `seconds`, the `parse_seconds` and 
+        `write_seconds`, and then for each match its input group, the reads
+        `matched` and `failed` and `seconds`, and for each output the reads 
+        that `passed` or `failed` the filter, those of the passed that then
+        couldn't be built (`build_failed`), and the `filter_seconds` and
+        `build_seconds`.
+
+        :param configuration: the configuration that was run, for the names
+            of matches and outputs
+        :type configuration: itermae.Configuration
+        :param seconds: how long the whole run took
+        :type seconds: float
+        :rtype: dict
+        """
+        def rounded(key):
+            return round(self.seconds.get(key,0),6)
+        summary = {
+            'reads': self.reads,
+            'seconds': round(seconds,6),
+            'reads_per_second': round(self.reads/seconds,1) if seconds else None,
+            'processes': configuration.processes,
+            'threads': configuration.threads,
+            'parse_seconds': rounded(('parse','input')),
+            'write_seconds': rounded(('write','output')),
+            'matches': {},
+            'outputs': {},
+            }
+        for i, each in enumerate(configuration.matches_array):
+            match_id = 'match_'+str(i)
+            matched, failed = self.counts.get(('match',match_id),[0,0])
+            summary['matches'][match_id] = { 'input': each['input'],
+                'matched': matched, 'failed': failed,
+                'seconds': rounded(('match',match_id)) }
+        for each in configuration.outputs_array:
+            passed, failed = self.counts.get(('filter',each['name']),[0,0])
+            summary['outputs'][each['name']] = { 
+                'passed': passed, 'failed': failed,
+                'build_failed': self.counts.get(('build',each['name']),
+                    [0,0])[1],
+                'filter_seconds': rounded(('filter',each['name'])), 
+                'build_seconds': rounded(('build',each['name'])) }
+        return summary
+
+
+def _resident_memory(pids=()):
+    """The current resident memory (RSS) of this process and the processes
+    in `pids` added up, read from `/proc`. 
+
+    :param pids: process IDs of other processes to add on, like workers
+    :type pids: iterable of int
+    :return: bytes, or None if there's no `/proc` to read (not Linux)
+    :rtype: int or None
+    """
+    total = 0
+    for pid in ['self',*pids]:
+        try:
+            with open('/proc/'+str(pid)+'/statm') as f:
+                total += int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            if pid == 'self':
+                return None
+    return total
+
+def _prometheus_label(value):
+    return '"'+str(value).replace('\\','\\\\').replace('"','\\"').replace(
+        '\n','\\n')+'"'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the latest metrics of the `ProgressReporter` that's set as
+    `reporter` on the server, at `/metrics`.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.reporter.metrics_text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProgressReporter:
+    """This reports how a run is going, from a thread on the side, so the
+    per-read loop doesn't do anything more than the counting `RunStats`
+    already does. Every `progress` seconds (or 10, if that's not set) it
+    takes a `RunStats.snapshot`, and:
+
+    - if `progress` is set, prints a line to STDERR of the reads so far, 
+      the reads per second (overall, and since the last line), the percent
+      passing each output's filter, and the current RSS (of this process 
+      and any worker processes)
+    - if `metrics_file` is set, writes the same numbers there in the
+      Prometheus text format, replacing the file each time so that it's
+      never half-written (for the node exporter's textfile collector)
+    - if `metrics_port` is set, serves them at `http://127.0.0.1:port/metrics`
+
+    With `processes`, reads are counted when their batch comes back, so 
+    it goes up in steps of `batch_size`.
+
+    :param configuration: the configuration that's running, with 
+        `run_stats` set
+    :type configuration: itermae.Configuration
+    """
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.interval = configuration.progress or 10
+        self.stopping = threading.Event()
+        self.thread = None
+        self.server = None
+        self.metrics_text = ''
+        self.start_time = None
+        self.last_time = None
+        self.last_reads = 0
+
+    def start(self):
+        """Starts the thread, and the HTTP server if there's a port."""
+        self.start_time = self.last_time = time.perf_counter()
+        self.update(report=False)
+        if self.configuration.metrics_port is not None:
+            self.server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1',self.configuration.metrics_port), _MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.reporter = self
+            threading.Thread(target=self.server.serve_forever,
+                daemon=True).start()
+            if self.configuration.verbosity >= 1:
+                print("["+str(time.time())+"] : Serving metrics at "+
+                    "http://127.0.0.1:"+str(self.server.server_address[1])+
+                    "/metrics", file=sys.stderr)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.update()
+
+    def stop(self):
+        """Stops the thread, and does one last update for the end of the
+        run. Then stops the HTTP server.
+        """
+        self.stopping.set()
+        self.thread.join()
+        self.update()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def update(self, report=True):
+        """Takes a snapshot of the run statistics, updates `metrics_text`
+        and the `metrics_file`, and prints a progress line.
+
+        :param report: print the progress line (if `progress` is set)?
+        :type report: bool
+        """
+        now = time.perf_counter()
+        reads, counts = self.configuration.run_stats.snapshot()
+        elapsed = now - self.start_time
+        rate = reads/elapsed if elapsed > 0 else 0.0
+        recent_rate = (reads-self.last_reads)/(now-self.last_time) \
+            if now > self.last_time else 0.0
+        self.last_time, self.last_reads = now, reads
+        rss = _resident_memory( i.pid 
+            for i in multiprocessing.active_children() )
+        matches = [ ( 'match_'+str(i), 
+                counts.get(('match','match_'+str(i)),[0,0]) )
+            for i in range(len(self.configuration.matches_array)) ]
+        outputs = [ (each['name'], counts.get(('filter',each['name']),[0,0]))
+            for each in self.configuration.outputs_array ]
+
+        lines = [
+            '# HELP itermae_reads_total Reads chopped so far.',
+            '# TYPE itermae_reads_total counter',
+            'itermae_reads_total '+str(reads),
+            '# HELP itermae_elapsed_seconds Seconds since chopping started.',
+            '# TYPE itermae_elapsed_seconds gauge',
+            'itermae_elapsed_seconds '+str(round(elapsed,3)),
+            '# HELP itermae_reads_per_second Reads chopped per second, '
+                'since the last update.',
+            '# TYPE itermae_reads_per_second gauge',
+            'itermae_reads_per_second '+str(round(recent_rate,3)),
+            '# HELP itermae_match_reads_total Reads that matched or failed '
+                'each match.',
+            '# TYPE itermae_match_reads_total counter' ]
+        for match_id, (matched, failed) in matches:
+            lines.append('itermae_match_reads_total{match='+
+                _prometheus_label(match_id)+',result="matched"} '+str(matched))
+            lines.append('itermae_match_reads_total{match='+
+                _prometheus_label(match_id)+',result="failed"} '+str(failed))
+        lines += [ '# HELP itermae_output_reads_total Reads that passed or '
+                'failed the filter of each output.',
+            '# TYPE itermae_output_reads_total counter' ]
+        for name, (passed, failed) in outputs:
+            lines.append('itermae_output_reads_total{output='+
+                _prometheus_label(name)+',result="passed"} '+str(passed))
+            lines.append('itermae_output_reads_total{output='+
+                _prometheus_label(name)+',result="failed"} '+str(failed))
+        if rss is not None:
+            lines += [ '# HELP itermae_resident_memory_bytes Resident memory '
+                    'of itermae and its worker processes.',
+                '# TYPE itermae_resident_memory_bytes gauge',
+                'itermae_resident_memory_bytes '+str(rss) ]
+        self.metrics_text = '\n'.join(lines)+'\n'
+
+        if self.configuration.metrics_file is not None:
+            partial = self.configuration.metrics_file+'.partial'
+            with open(partial,'w') as f:
+                f.write(self.metrics_text)
+            os.replace(partial, self.configuration.metrics_file)
+
+        if report and self.configuration.progress is not None:
+            print("["+str(time.time())+"] : Chopped "+str(reads)+" reads, "+
+                '{:.1f}'.format(rate)+" reads/s ("+
+                '{:.1f}'.format(recent_rate)+" lately), passed: "+
+                ", ".join( name+" "+'{:.1f}'.format(
+                        100*passed/max(1,passed+failed))+"%"
+                    for name, (passed, failed) in outputs )+
+                ", RSS "+( "NA" if rss is None else 
+                    '{:.1f}'.format(rss/1048576)+" MB" ),
+                file=sys.stderr)
+
+
+class SummaryReport:
+    """This is a summary of how the reads did, for tuning a configuration on
+    a whole run, instead of the `report` of a line for each output of each
+    read (which is only useful on a few thousand reads). It's added up as 
+    the run goes, and takes the same memory no matter how many reads:
+
+    - for each output, how many reads passed or failed its filter, and how
+      many of those that passed then couldn't be built
+    - for each match, how many reads matched or failed, and histograms of
+      the substitutions, insertions, and deletions (from the `MatchScores`)
+    - for each group, histograms of the length and the mean quality (from
+      the `GroupStats`)
+    - for each output passing and failing, a few example reads, picked 
+      at random from all of them (a reservoir sample). Each has the input
+      ID and sequence, the sequence of each group, and the output (if it 
+      was built).
+
+    All the matches are applied to each read, so that the histograms are of
+    everything, but outputs are only built if they pass. Like `RunStats`, 
+    there's a lock for threads, and each worker process gets its own empty 
+    one and hands back its numbers with `take_stats`.
+
+    :param samples: how many example reads to keep for each output passing
+        and failing
+    :type samples: int
+    """
+
+    def __init__(self, samples=5):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.reads = 0
+        self.outputs = {}
+        self.matches = {}
+        self.groups = {}
+        self.reservoirs = {}
+
+    def __getstate__(self):
+        return {'samples': self.samples}
+
+    def __setstate__(self,state):
+        self.__init__(state['samples'])
+        self.random = random.Random() # so workers don't all pick the same
+
+    def add_read(self, seq_holder, output_records):
+        """Adds on a read that's been through `SeqHolder.write_outputs`.
+
+        :param seq_holder: the read, with matches applied
+        :type seq_holder: itermae.SeqHolder
+        :param output_records: the name, filter result, and output (or None)
+            of each output
+        :type output_records: list of dict
+        """
+        with self.lock:
+            self.reads += 1
+            for match_id, scores in seq_holder.match_scores.items():
+                match = self.matches.setdefault(match_id, {
+                    'matched': 0, 'failed': 0, 'substitutions': {},
+                    'insertions': {}, 'deletions': {} })
+                if scores.substitutions is None:
+                    match['failed'] += 1
+                    continue
+                match['matched'] += 1
+                for kind in ['substitutions','insertions','deletions']:
+                    histogram = match[kind]
+                    value = getattr(scores,kind)
+                    histogram[value] = histogram.get(value,0) + 1
+            for name, stats in seq_holder.group_stats.items():
+                group = self.groups.setdefault(name, 
+                    {'lengths': {}, 'mean_quality': {}} )
+                group['lengths'][stats.length] = \
+                    group['lengths'].get(stats.length,0) + 1
+                if stats.length > 0:
+                    # Summing the letters' bytes skips making a list
+                    mean_quality = ( sum(stats.quality_string.encode('ascii'))
+                        //stats.length ) - 33
+                    group['mean_quality'][mean_quality] = \
+                        group['mean_quality'].get(mean_quality,0) + 1
+            for output_record in output_records:
+                passed = bool(output_record['filter_result'])
+                counts = self.outputs.setdefault(output_record['name'], 
+                    [0,0,0])
+                counts[0 if passed else 1] += 1
+                if passed and output_record['output'] is None:
+                    counts[2] += 1
+                # Reservoir sampling, so each read has the same chance of 
+                # being kept, and the example is only made if it is
+                category = ( 'PassedFilterFor_' if passed else 
+                    'FailedFilterFor_' ) + output_record['name']
+                reservoir = self.reservoirs.setdefault(category, [0,[]])
+                reservoir[0] += 1
+                if len(reservoir[1]) < self.samples:
+                    reservoir[1].append(
+                        self.example(seq_holder, output_record['output']) )
+                else:
+                    index = self.random.randrange(reservoir[0])
+                    if index < self.samples:
+                        reservoir[1][index] = \
+                            self.example(seq_holder, output_record['output'])
+
+    def example(self, seq_holder, output):
+        """An example read for the reservoir samples.
+
+        :rtype: dict
+        """
+        return { 'id': seq_holder.seqs['input'].id,
+            'seq': seq_holder.seqs['input'].seq,
+            'groups': { name: seq_holder.seqs[name].seq 
+                for name in seq_holder.group_stats if name in seq_holder.seqs },
+            'output': None if output is None else 
+                { 'id': output.id, 'seq': output.seq } }
+
+    def take_stats(self):
+        """Returns the numbers so far, and resets them.
+
+        :rtype: dict
+        """
+        with self.lock:
+            stats = { 'reads': self.reads, 'outputs': self.outputs,
+                'matches': self.matches, 'groups': self.groups,
+                'reservoirs': self.reservoirs }
+            self.reads = 0
+            self.outputs, self.matches, self.groups, self.reservoirs = \
+                {}, {}, {}, {}
+        return stats
+
+    def add_stats(self, stats):
+        """Adds on the numbers returned by `take_stats` of another one.
+        The example reads are merged so that each read of both still has the
+        same chance of being kept, by weighting each example by how many 
+        reads it stands for.
+
+        :param stats: as returned by `take_stats`
+        :type stats: dict
+        """
+        def add_histogram(histogram, other):
+            for value, count in other.items():
+                histogram[value] = histogram.get(value,0) + count
+        with self.lock:
+            self.reads += stats['reads']
+            for name, other in stats['outputs'].items():
+                counts = self.outputs.setdefault(name, [0,0,0])
+                for i, count in enumerate(other):
+                    counts[i] += count
+            for match_id, other in stats['matches'].items():
+                match = self.matches.setdefault(match_id, {
+                    'matched': 0, 'failed': 0, 'substitutions': {},
+                    'insertions': {}, 'deletions': {} })
+                match['matched'] += other['matched']
+                match['failed'] += other['failed']
+                for kind in ['substitutions','insertions','deletions']:
+                    add_histogram(match[kind], other[kind])
+            for name, other in stats['groups'].items():
+                group = self.groups.setdefault(name, 
+                    {'lengths': {}, 'mean_quality': {}} )
+                add_histogram(group['lengths'], other['lengths'])
+                add_histogram(group['mean_quality'], other['mean_quality'])
+            for category, (seen, examples) in stats['reservoirs'].items():
+                reservoir = self.reservoirs.setdefault(category, [0,[]])
+                # Weighted sampling without replacement, with a key of
+                # u^(1/weight) for each example (Efraimidis and Spirakis)
+                keyed = [ ( self.random.random()**(len(these)/total), example )
+                    for total, these in [ reservoir, (seen, examples) ] 
+                    if these
+                    for example in these ]
+                keyed.sort(key=lambda i: i[0], reverse=True)
+                reservoir[0] += seen
+                reservoir[1] = [ i[1] for i in keyed[:self.samples] ]
+
+    def summary(self):
+        """Puts the numbers together in a dict, for writing as JSON. The 
+        histograms are sorted by value.
+
+        :rtype: dict
+        """
+        def sorted_histogram(histogram):
+            return { str(value): histogram[value] 
+                for value in sorted(histogram) }
+        with self.lock:
+            return {
+                'reads': self.reads,
+                'outputs': { name: {'passed': passed, 'failed': failed,
+                        'build_failed': build_failed}
+                    for name, (passed, failed, build_failed) in 
+                        self.outputs.items() },
+                'matches': { match_id: { 'matched': match['matched'],
+                        'failed': match['failed'], 
+                        **{ kind: sorted_histogram(match[kind]) for kind in 
+                            ['substitutions','insertions','deletions'] } }
+                    for match_id, match in sorted(self.matches.items()) },
+                'groups': { name: { 
+                        'lengths': sorted_histogram(group['lengths']),
+                        'mean_quality': sorted_histogram(group['mean_quality'])
+                        }
+                    for name, group in self.groups.items() },
+                'examples': { category: examples for category, (seen, examples)
+                    in sorted(self.reservoirs.items()) } }
+
+    def write(self, file_string):
+        """Writes the `summary` as JSON to a file (overwritten), or 'STDERR'.
+
+        :param file_string: file path, or 'STDERR'
+        :type file_string: str
+        """
+        if file_string.upper() == 'STDERR':
+            print(json.dumps(self.summary(), indent=2), file=sys.stderr)
+        else:
+            with open(file_string,'w') as f:
+                json.dump(self.summary(), f, indent=2)
+                f.write('\n')
+
+
+class MatchStatsWriter:
+    """This writes statistics for every read to a columnar binary file, for
+    tuning on a whole run (loading into `pandas` or so), instead of parsing
+    the CSV of `report` back. There's a column for:
+
+    - `id`, the input ID
+    - `<match>_substitutions`, `_insertions`, and `_deletions` of each match
+      (like `match_0_substitutions`), -1 if it didn't match
+    - `<group>_start`, `_end`, and `_length` of each group (like 
+      `barcode_length`), -1 if it wasn't matched
+    - `passed_<output>`, if each output passed its filter
+
+    Rows are kept in lists until there's `chunk_size` of them, then written
+    as a chunk. What's written depends on the path:
+
+    - ending in '.arrow' (or '.feather'), an Arrow IPC file, with a record
+      batch for each chunk (needs `pyarrow`)
+    - ending in '.parquet', a Parquet file with a row group for each chunk
+      (needs `pyarrow`)
+    - otherwise, a directory of NumPy '.npz' files, one for each chunk 
+      (needs `numpy`). Chunks left in the directory from an earlier run are
+      removed first, so they don't get read back with this run's.
+
+    `read_match_stats` reads any of these back. When pickled for a worker 
+    process, it leaves the path behind, and the worker hands back its rows 
+    with `take_rows`.
+
+    :param path: where to write to
+    :type path: str
+    :param match_ids: the match IDs, like 'match_0'
+    :type match_ids: list of str
+    :param group_names: the names of the groups the matches can make
+    :type group_names: list of str
+    :param output_names: the names of the outputs
+    :type output_names: list of str
+    :param chunk_size: how many rows to write at once
+    :type chunk_size: int
+    :raises ImportError: if `numpy` or `pyarrow` (as needed) isn't there
+    """
+
+    def __init__(self, path, match_ids, group_names, output_names,
+            chunk_size=65536):
+        self.path = path
+        self.match_ids = match_ids
+        self.group_names = group_names
+        self.output_names = output_names
+        self.chunk_size = chunk_size
+        self.columns = ( ['id'] + 
+            [ match_id+'_'+kind for match_id in match_ids 
+                for kind in ['substitutions','insertions','deletions'] ] +
+            [ name+'_'+kind for name in group_names 
+                for kind in ['start','end','length'] ] +
+            [ 'passed_'+name for name in output_names ] )
+        self.rows = [ [] for i in self.columns ]
+        self.chunks = 0
+        self.writer = None
+        self.format = None
+        if path is None: # then it's in a worker, just collecting rows
+            return
+        if path.endswith('.parquet'):
+            self.format = 'parquet'
+        elif path.endswith('.arrow') or path.endswith('.feather'):
+            self.format = 'arrow'
+        else:
+            self.format = 'npz'
+        try:
+            import numpy
+            if self.format != 'npz':
+                import pyarrow
+                import pyarrow.ipc
+                import pyarrow.parquet
+        except ImportError as error:
+            raise ImportError(repr(error)+" : Writing the match statistics "
+                "as '"+self.format+"' needs "+
+                ("numpy" if self.format == 'npz' else "pyarrow")+
+                " to be installed.")
+        if self.format == 'npz':
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith('chunk_') and name.endswith('.npz'):
+                    os.remove(os.path.join(path, name))
+
+    def __getstate__(self):
+        return { 'match_ids': self.match_ids, 'group_names': self.group_names,
+            'output_names': self.output_names, 'chunk_size': self.chunk_size }
+
+    def __setstate__(self,state):
+        self.__init__(None, **state)
+
+    def add_read(self, seq_holder, output_records):
+        """Adds a row for a read that's been through 
+        `SeqHolder.write_outputs`, and writes a chunk if there's enough.
+
+        :param seq_holder: the read, with matches applied
+        :type seq_holder: itermae.SeqHolder
+        :param output_records: the name, filter result, and output (or None)
+            of each output
+        :type output_records: list of dict
+        """
+        row = [ seq_holder.seqs['input'].id ]
+        for match_id in self.match_ids:
+            scores = seq_holder.match_scores.get(match_id)
+            if scores is None or scores.substitutions is None:
+                row += [-1,-1,-1]
+            else:
+                row += [ scores.substitutions, scores.insertions, 
+                    scores.deletions ]
+        for name in self.group_names:
+            stats = seq_holder.group_stats.get(name)
+            if stats is None:
+                row += [-1,-1,-1]
+            else:
+                row += [ stats.start, stats.end, stats.length ]
+        row += [ bool(i['filter_result']) for i in output_records ]
+        for column, value in zip(self.rows, row):
+            column.append(value)
+        if self.path is not None and len(self.rows[0]) >= self.chunk_size:
+            self.write_chunk()
+
+    def take_rows(self):
+        """Returns the rows so far (as a list for each column), and forgets
+        them.
+
+        :rtype: list of list
+        """
+        rows, self.rows = self.rows, [ [] for i in self.columns ]
+        return rows
+
+    def add_rows(self, rows):
+        """Adds on rows returned by `take_rows` of another one, and writes a
+        chunk if there's enough.
+
+        :param rows: a list for each column
+        :type rows: list of list
+        """
+        for column, values in zip(self.rows, rows):
+            column.extend(values)
+        if len(self.rows[0]) >= self.chunk_size:
+            self.write_chunk()
+
+    def arrays(self, rows):
+        import numpy
+        arrays = {}
+        for name, values in zip(self.columns, rows):
+            if name == 'id':
+                arrays[name] = numpy.array(values, dtype=str)
+            elif name.startswith('passed_'):
+                arrays[name] = numpy.array(values, dtype=bool)
+            elif name.endswith(('_substitutions','_insertions','_deletions')):
+                arrays[name] = numpy.array(values, dtype=numpy.int16)
+            else:
+                arrays[name] = numpy.array(values, dtype=numpy.int32)
+        return arrays
+
+    def write_chunk(self):
+        """Writes the rows so far as a chunk."""
+        if not self.rows[0]:
+            return
+        arrays = self.arrays(self.take_rows())
+        if self.format == 'npz':
+            import numpy
+            numpy.savez(os.path.join(self.path,
+                    'chunk_'+'{:06d}'.format(self.chunks)+'.npz'),
+                **arrays)
+        else:
+            import pyarrow
+            batch = pyarrow.record_batch(list(arrays.values()), 
+                names=list(arrays.keys()))
+            if self.writer is None:
+                if self.format == 'arrow':
+                    import pyarrow.ipc
+                    self.writer = pyarrow.ipc.new_file(self.path, batch.schema)
+                else:
+                    import pyarrow.parquet
+                    self.writer = pyarrow.parquet.ParquetWriter(self.path,
+                        batch.schema)
+            if self.format == 'arrow':
+                self.writer.write_batch(batch)
+            else:
+                self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        self.chunks += 1
+
+    def close(self):
+        """Writes any rows left, and closes the file."""
+        self.write_chunk()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def read_match_stats(path):
+    """Reads back what a `MatchStatsWriter` wrote, as a dict of column name
+    to a NumPy array, so a `pandas.DataFrame(read_match_stats(path))` 
+    away from a table.
+
+    :param path: the directory of '.npz' chunks, or the '.arrow' or 
+        '.parquet' file
+    :type path: str
+    :return: dict of column name to array
+    :rtype: dict
+    """
+    import numpy
+    if os.path.isdir(path):
+        chunks = []
+        for file_name in sorted(os.listdir(path)):
+            if file_name.startswith('chunk_') and file_name.endswith('.npz'):
+                with numpy.load(os.path.join(path,file_name)) as chunk:
+                    chunks.append({ i: chunk[i] for i in chunk.files })
+        if not chunks:
+            return {}
+        return { i: numpy.concatenate([ chunk[i] for chunk in chunks ])
+            for i in chunks[0] }
+    import pyarrow
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+    else:
+        import pyarrow.ipc
+        with pyarrow.ipc.open_file(path) as reader:
+            table = reader.read_all()
+    return { name: table.column(name).to_numpy() 
+        for name in table.column_names }
+
+
+def hamming_neighbours(seq, mismatches, alphabet='ACGTN'):
+    """Lists every sequence that's within some number of substitutions of
+    `seq`, with how many substitutions away it is (not including `seq`).
+
+    :param seq: the sequence
+    :type seq: str
+    :param mismatches: up to how many substitutions
+    :type mismatches: int
+    :param alphabet: the letters to substitute in, defaults to 'ACGTN'
+    :type alphabet: str, optional
+    :return: tuples of the neighbour and its distance
+    :rtype: generator of tuple
+    """
+    for distance in range(1, mismatches+1):
+        for positions in itertools.combinations(range(len(seq)), distance):
+            choices = [ [ i for i in alphabet if i != seq[position] ]
+                for position in positions ]
+            for letters in itertools.product(*choices):
+                neighbour = list(seq)
+                for position, letter in zip(positions, letters):
+                    neighbour[position] = letter
+                yield "".join(neighbour), distance
+
+
+class SampleIndex:
+    """This assigns reads to samples by the sequence of an index group (like
+    `sampleIndex`), for `sample_sheet`. Each index sequence, and every 
+    sequence within `mismatches` substitutions of it, is put in a dict ahead
+    of time, so looking up a read is just one dict lookup. A sequence that's
+    closer to one index than any other goes to that index's sample, and one 
+    that's as close to indices of two different samples is ambiguous. 
+
+    It counts how many reads go to each sample, and how many are unassigned
+    (no index group, or not close to any index) or ambiguous. Reads that 
+    aren't assigned to a sample are given the sample name 'unassigned'. Like
+    `MatchCache`, each worker process gets its own copy with zero counts, 
+    and hands back its counts with `take_stats`.
+
+    :param samples: dict of each index sequence to the sample name
+    :type samples: dict
+    :param mismatches: how many substitutions an index can have and still 
+        be assigned, defaults to 0
+    :type mismatches: int, optional
+    :raises ValueError: if the neighbourhoods would be too big to hold
+    """
+
+    UNASSIGNED = 'unassigned'
+    # What's in the lookup for a sequence that's ambiguous
+    AMBIGUOUS = None
+    # The most sequences to put in the lookup
+    max_size = 20000000
+
+    def __init__(self, samples, mismatches=0):
+        self.samples = { seq.upper(): name for seq, name in samples.items() }
+        self.mismatches = mismatches
+        size = sum( sum( math.factorial(len(seq))*4**i // 
+                    ( math.factorial(i)*math.factorial(max(len(seq)-i,0)) )
+                for i in range(min(mismatches,len(seq))+1) ) 
+            for seq in self.samples )
+        if size > self.max_size:
+            raise ValueError("Allowing "+str(mismatches)+" mismatches "
+                "would need "+str(size)+" sequences in the sample index, "
+                "which is too many, so try fewer mismatches.")
+        self.lookup = dict(self.samples)
+        distances = { seq: 0 for seq in self.samples }
+        for seq, name in self.samples.items():
+            for neighbour, distance in hamming_neighbours(seq, mismatches):
+                if distances.get(neighbour, distance+1) > distance:
+                    self.lookup[neighbour] = name
+                    distances[neighbour] = distance
+                elif distances[neighbour] == distance and \
+                        self.lookup[neighbour] != name:
+                    self.lookup[neighbour] = self.AMBIGUOUS
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    @classmethod
+    def from_sample_sheet(cls, path, mismatches=0):
+        """Reads a sample sheet, of lines of the index sequence and the sample
+        name, separated by a tab or comma. Blank lines, lines starting with 
+        '#', and a header line (where the index isn't a DNA sequence) are 
+        skipped. A sample can have more than one index.
+
+        :param path: the sample sheet file
+        :type path: str
+        :param mismatches: see `SampleIndex`
+        :type mismatches: int, optional
+        :return: the index
+        :rtype: itermae.SampleIndex
+        :raises ValueError: if the sheet doesn't make sense
+        """
+        samples = {}
+        with open(path) as f:
+            for line_number, line in enumerate(f):
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                fields = [ i.strip() for i in re.split('[\t,]', line) ]
+                if len(fields) < 2 or fields[0] == '' or fields[1] == '':
+                    raise ValueError("Line "+str(line_number+1)+" of the "
+                        "sample sheet '"+str(path)+"' should be an index "
+                        "sequence and a sample name, separated by a tab or "
+                        "comma, not '"+line+"'.")
+                seq, name = fields[0].upper(), fields[1]
+                if not re.fullmatch('[ACGTN]+', seq):
+                    if not samples:
+                        continue # a header
+                    raise ValueError("The index '"+fields[0]+"' on line "+
+                        str(line_number+1)+" of the sample sheet '"+
+                        str(path)+"' isn't a DNA sequence.")
+                if name == cls.UNASSIGNED:
+                    raise ValueError("'"+cls.UNASSIGNED+"' is used for "
+                        "reads that aren't assigned, so it can't be the "
+                        "name of a sample in '"+str(path)+"'.")
+                if samples.get(seq, name) != name:
+                    raise ValueError("The index '"+seq+"' is given for both "
+                        "'"+samples[seq]+"' and '"+name+"' in the sample "
+                        "sheet '"+str(path)+"'.")
+                samples[seq] = name
+        if not samples:
+            raise ValueError("There aren't any samples in the sample sheet "
+                "'"+str(path)+"'.")
+        return cls(samples, mismatches)
+
+    def __getstate__(self):
+        return { 'samples': self.samples, 'mismatches': self.mismatches,
+            'lookup': self.lookup }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def assign(self, seq, reads=1):
+        """Works out which sample a read goes to, and counts it.
+
+        :param seq: the sequence of the index group, or None if the read 
+            doesn't have it
+        :type seq: str or None
+        :param reads: how many reads to count it as, more than one for a 
+            record from `collapse` of 'reads', defaults to 1
+        :type reads: int, optional
+        :return: the sample name, or 'unassigned'
+        :rtype: str
+        """
+        if seq is None:
+            name, key = self.UNASSIGNED, self.UNASSIGNED
+        else:
+            name = self.lookup.get(seq.upper(), self.UNASSIGNED)
+            if name is self.AMBIGUOUS:
+                name, key = self.UNASSIGNED, 'ambiguous'
+            else:
+                key = name
+        with self.lock:
+            self.counts[key] = self.counts.get(key,0) + reads
+        return name
+
+    def take_stats(self):
+        """Returns the counts, and resets them to zero.
+
+        :return: dict of sample name (or 'unassigned' or 'ambiguous') to 
+            the number of reads
+        :rtype: dict
+        """
+        with self.lock:
+            stats, self.counts = self.counts, {}
+        return stats
+
+    def add_stats(self, stats):
+        """Adds on some counts, as returned by `take_stats` of another index.
+
+        :param stats: dict of sample name to the number of reads
+        :type stats: dict
+        """
+        with self.lock:
+            for key, count in stats.items():
+                self.counts[key] = self.counts.get(key,0) + count
+
+    def summary(self):
+        """The number of reads for each sample, in the order of the sample 
+        sheet, then the unassigned and ambiguous reads.
+
+        :rtype: dict
+        """
+        with self.lock:
+            names = list(dict.fromkeys(self.samples.values())) + \
+                [ self.UNASSIGNED, 'ambiguous' ]
+            return { name: self.counts.get(name,0) for name in names }
+
+
+class DemultiplexWriter:
+    """This is used as the `output_writer` when demultiplexing, and writes 
+    each read's outputs to a file for its sample, instead of to one output.
+    The file path is the `output` with '{sample}' replaced by the sample 
+    name, and each file is opened (with `opener`) the first time something
+    is written to it. Call `select` with the sample of a read before writing
+    its outputs with `write_record`.
+
+    :param path: the output path, with '{sample}' in it
+    :type path: str
+    :param format: the format to write records in, see `format_record`
+    :type format: str
+    :param opener: function that opens a file handle for a path, like
+        `Configuration.open_output_fh`
+    :type opener: function
+    """
+
+    def __init__(self, path, format, opener):
+        self.path = path
+        self.format = format
+        self.opener = opener
+        self.writers = {}
+        self.sample = SampleIndex.UNASSIGNED
+
+    def writer(self, sample):
+        """Gets the `OutputWriter` for a sample, opening it if it's new.
+
+        :rtype: itermae.OutputWriter
+        """
+        try:
+            return self.writers[sample]
+        except KeyError:
+            writer = OutputWriter( self.opener(
+                self.path.replace('{sample}', sample) ), self.format )
+            self.writers[sample] = writer
+            return writer
+
+    def select(self, sample):
+        """Sets which sample's file `write_record` writes to."""
+        self.sample = sample
+
+    def write_record(self, seq, which):
+        """Formats and buffers one record for the selected sample.
+
+        :param seq: The record to write
+        :type seq: itermae.ReadRecord
+        :param which: which output this is, see `format_record`
+        :type which: str
+        """
+        self.writer(self.sample).write(format_record(seq,self.format,which))
+
+    def write(self, texts):
+        """Writes text that's already formatted for each sample, like what
+        `getvalues` returns in a worker process.
+
+        :param texts: dict of sample name to the text for it
+        :type texts: dict
+        """
+        for sample, text in texts.items():
+            if text:
+                self.writer(sample).write(text)
+
+    def getvalues(self):
+        """For a writer of `io.StringIO`s, gets the text for each sample.
+
+        :rtype: dict
+        """
+        self.flush()
+        return { sample: writer.fh.getvalue() 
+            for sample, writer in self.writers.items() }
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        """Flushes and closes all the sample files."""
+        for writer in self.writers.values():
+            writer.flush()
+            try:
+                writer.fh.close()
+            except:
+                pass
+
+
+# For packing sequences of just ACGT into a number, two bits per base
+_PACK_BASES = str.maketrans('ACGT','0123')
+_PACKABLE = re.compile('[ACGT]*')
+# Each byte of a packed number, back to its four bases
+_UNPACK_BYTES = [ "".join( 'ACGT'[(i >> shift) & 3] for shift in (6,4,2,0) )
+    for i in range(256) ]
+
+def pack_sequence(seq):
+    """Packs a sequence of just A, C, G, and T into a number, with two bits
+    per base after a leading 1 bit (so that leading A's aren't lost). A 
+    30 base sequence is then a number that takes 36 bytes, instead of a 
+    string that takes 79. Anything else (like an N, or lowercase) is left 
+    as the string.
+
+    :param seq: the sequence
+    :type seq: str
+    :return: the packed number, or `seq` if it can't be packed
+    :rtype: int or str
+    """
+    if _PACKABLE.fullmatch(seq):
+        return int('1'+seq.translate(_PACK_BASES), 4)
+    return seq
+
+
+def unpack_sequence(key):
+    """Unpacks a sequence packed by `pack_sequence`.
+
+    :param key: the packed number, or a string that wasn't packed
+    :type key: int or str
+    :return: the sequence
+    :rtype: str
+    """
+    if isinstance(key, str):
+        return key
+    length = (key.bit_length()-1) // 2
+    if length == 0:
+        return ''
+    key ^= 1 << (2*length)
+    letters = "".join( _UNPACK_BYTES[i] 
+        for i in key.to_bytes((length+3)//4, 'big') )
+    return letters[len(letters)-length:]
+
+
+def collapsed_read_count(record_id):
+    """How many reads a record stands for, from the `;size=12` tag that 
+    `collapse` of 'reads' puts on the end of its ID, or 1 without one.
+
+    :param record_id: the ID of the input record
+    :type record_id: str
+    :rtype: int
+    """
+    try:
+        return int(record_id.rsplit(';size=',1)[1])
+    except (IndexError, ValueError):
+        return 1
+
+
+class CountWriter:
+    """This is used as the `output_writer` when counting (`count`), and 
+    instead of writing each output record it counts how many times each 
+    output sequence is seen, for each output. So an output with a `seq` of
+    `sampleIndex+barcode` counts each combination, like piping the outputs 
+    through `sort | uniq -c`, but in one pass. At the end `close` writes a 
+    tab-separated table of the output name, sequence, and count, sorted by 
+    output name then sequence.
+
+    Sequences are kept packed (see `pack_sequence`). When the tables get 
+    bigger than about `memory` megabytes, they're written out to a sorted
+    file in a temporary directory (a run) and emptied, and at the end the 
+    runs are merged together, so the whole table never needs to fit in 
+    memory. The sizes are estimated as the key's size and `entry_size` bytes
+    for each entry in the dict.
+
+    In a worker process (with no `fh`), it never spills, since there's
+    nowhere for the runs to go: the counts of each batch are handed back 
+    with `getvalues` and added on in the main process with `write`, like 
+    `DemultiplexWriter`, and the main process spills if it needs to.
+
+    :param fh: the file handle to write the table to, or None in a worker
+    :type fh: file handle
+    :param memory: about how many megabytes to count in before spilling to
+        disk, defaults to 1024
+    :type memory: float, optional
+    """
+
+    # The rough size of an entry in the dict, besides the key
+    entry_size = 72
+
+    def __init__(self, fh, memory=1024):
+        self.fh = fh
+        self.format = 'counts'
+        self.memory = memory
+        self.tables = {}
+        self.size = 0
+        self.records = 0
+        self.distinct = 0
+        self.runs = []
+        self.spill_dir = None
+
+    def write_record(self, seq, which, reads=1):
+        """Counts one output record.
+
+        :param seq: The output record
+        :type seq: itermae.ReadRecord
+        :param which: the name of the output
+        :type which: str
+        :param reads: how many reads the record stands for, more than one
+            with `collapse` of 'reads', defaults to 1
+        :type reads: int, optional
+        """
+        try:
+            table = self.tables[which]
+        except KeyError:
+            table = self.tables[which] = {}
+        key = pack_sequence(str(seq.seq))
+        count = table.get(key)
+        if count is None:
+            table[key] = reads
+            self.size += sys.getsizeof(key) + self.entry_size
+            if self.fh is not None and self.size > self.memory*1048576:
+                self.spill()
+        else:
+            table[key] = count + reads
+        self.records += reads
+
+    def write(self, tables):
+        """Adds on counts from another writer, like what `getvalues` 
+        returns in a worker process.
+
+        :param tables: dict of output name to a dict of packed sequence to
+            count
+        :type tables: dict
+        """
+        for which, other in tables.items():
+            try:
+                table = self.tables[which]
+            except KeyError:
+                table = self.tables[which] = {}
+            for key, count in other.items():
+                existing = table.get(key)
+                if existing is None:
+                    table[key] = count
+                    self.size += sys.getsizeof(key) + self.entry_size
+                else:
+                    table[key] = existing + count
+                self.records += count
+        if self.size > self.memory*1048576:
+            self.spill()
+
+    def getvalues(self):
+        """Gets the counts so far, and empties them out.
+
+        :rtype: dict
+        """
+        tables, self.tables, self.size = self.tables, {}, 0
+        return tables
+
+    def sorted_lines(self):
+        """The lines of the table in memory, sorted."""
+        return ( which+"\t"+seq+"\t"+str(count)+"\n" 
+            for which in sorted(self.tables)
+                for seq, count in sorted( ( unpack_sequence(key), count ) 
+                    for key, count in self.tables[which].items() ) )
+
+    def spill(self):
+        """Writes the table in memory to a sorted run on disk, and empties
+        it."""
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(prefix='itermae_')
+        path = os.path.join(self.spill_dir.name, 
+            'run_'+str(len(self.runs))+'.tsv')
+        with open(path, 'w') as f:
+            f.writelines(self.sorted_lines())
+        self.runs.append(path)
+        self.tables, self.size = {}, 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Writes out the table, merging together any runs that were spilled
+        to disk, and cleans those up."""
+        writer = OutputWriter(self.fh)
+        writer.write("output\tsequence\tcount\n")
+        if not self.runs:
+            for line in self.sorted_lines():
+                writer.write(line)
+                self.distinct += 1
+        else:
+            if self.tables:
+                self.spill()
+            run_fhs = [ open(path) for path in self.runs ]
+            last_key, total = None, 0
+            for line in heapq.merge( *run_fhs, 
+                    key=lambda line: line.rsplit("\t",1)[0] ):
+                key, count = line.rsplit("\t",1)
+                if key != last_key:
+                    if last_key is not None:
+                        writer.write(last_key+"\t"+str(total)+"\n")
+                        self.distinct += 1
+                    last_key, total = key, 0
+                total += int(count)
+            if last_key is not None:
+                writer.write(last_key+"\t"+str(total)+"\n")
+                self.distinct += 1
+            for run_fh in run_fhs:
+                run_fh.close()
+            self.spill_dir.cleanup()
+        writer.flush()
+        self.tables, self.size = {}, 0
+
+    def summary(self):
+        """How many records were counted (as reads, so a collapsed record 
+        counts for each of its reads), how many distinct sequences there
+        were (once it's closed), and how many runs were spilled to disk.
+
+        :rtype: dict
+        """
+        return { 'records': self.records, 'distinct': self.distinct,
+            'spilled_runs': len(self.runs) }
+
+
+def deletion_neighbours(seq, deletions):
+    """Lists every distinct sequence made by deleting up to some number of 
+    letters from `seq`, including `seq` itself. Two sequences within 
+    `deletions` edits (substitutions, insertions, or deletions) of each other
+    always share at least one of these, which is what `Whitelist` looks up.
+
+    :param seq: the sequence
+    :type seq: str
+    :param deletions: up to how many letters to delete
+    :type deletions: int
+    :return: the sequences
+    :rtype: set of str
+    """
+    neighbours = {seq}
+    last = {seq}
+    for _ in range(deletions):
+        last = { i[:position]+i[position+1:] for i in last 
+            for position in range(len(i)) }
+        neighbours |= last
+    return neighbours
+
+
+def edit_distance(first, second, limit):
+    """The edit (Levenshtein) distance between two sequences, but giving up
+    as soon as it's sure to be more than `limit`.
+
+    :param first: a sequence
+    :type first: str
+    :param second: another sequence
+    :type second: str
+    :param limit: the most edits that are of interest
+    :type limit: int
+    :return: the distance, or `limit+1` if it's more than `limit`
+    :rtype: int
+    """
+    if abs(len(first)-len(second)) > limit:
+        return limit+1
+    previous = list(range(len(second)+1))
+    for i, letter in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append( min( previous[j]+1, current[j-1]+1, 
+                previous[j-1]+(letter != other) ) )
+        if min(current) > limit:
+            return limit+1
+        previous = current
+    return min(previous[-1], limit+1)
+
+
+def _corrected_quality(observed, quality, corrected):
+    """Works out qualities for a corrected sequence from the qualities of 
+    the observed one. If they're the same length, each letter keeps its 
+    quality. Otherwise they're aligned, bases lined up with an observed base
+    get its quality, and bases that weren't read at all get the lower of the 
+    qualities either side of where they'd be.
+
+    :param observed: the sequence that was read
+    :type observed: str
+    :param quality: the PHRED letters of that, or None
+    :type quality: str or None
+    :param corrected: the sequence it's corrected to
+    :type corrected: str
+    :return: PHRED letters for `corrected`, or None
+    :rtype: str or None
+    """
+    if quality is None or len(observed) == len(corrected):
+        return quality
+    rows = [ list(range(len(corrected)+1)) ]
+    for i, letter in enumerate(observed, 1):
+        row = [i]
+        for j, other in enumerate(corrected, 1):
+            row.append( min( rows[-1][j]+1, row[j-1]+1, 
+                rows[-1][j-1]+(letter != other) ) )
+        rows.append(row)
+    # Trace back, noting which observed base each corrected base lines up with
+    aligned = [None]*len(corrected)
+    i, j = len(observed), len(corrected)
+    while i > 0 and j > 0:
+        if rows[i][j] == rows[i-1][j-1]+(observed[i-1] != corrected[j-1]):
+            aligned[j-1] = i-1
+            i, j = i-1, j-1
+        elif rows[i][j] == rows[i-1][j]+1:
+            i -= 1
+        else:
+            j -= 1
+    letters = []
+    for j, i in enumerate(aligned):
+        if i is not None:
+            letters.append(quality[i])
+            continue
+        before = next( ( quality[k] for k in reversed(aligned[:j]) 
+            if k is not None ), None )
+        after = next( ( quality[k] for k in aligned[j+1:] 
+            if k is not None ), None )
+        letters.append( min( [ k for k in (before, after) if k is not None ],
+            default=min(quality, default='!') ) )
+    return "".join(letters)
+
+
+class Whitelist:
+    """This corrects the sequence of a group (like `barcode`) to the nearest
+    sequence on a list of known ones, for `whitelist`. Every sequence made 
+    by deleting up to `distance` letters from each whitelist sequence is put
+    in a dict ahead of time (a deletion neighbourhood), pointing back to the
+    whitelist sequences it came from. A read's group then only needs the same
+    deletions done to it and looked up, and the few whitelist sequences that
+    turn up have their actual edit distance checked. That's much smaller than
+    keeping every possible error of every whitelist sequence.
+
+    Each sequence comes out as 'exact' (it's on the whitelist), 'corrected'
+    (one whitelist sequence is closest, within `distance` edits), 
+    'ambiguous' (two or more are equally close), or 'unmatched' (none are 
+    close enough). Only a 'corrected' sequence is changed. Results are 
+    remembered for the `memo_size` most recently used distinct sequences 
+    (like `MatchCache`), since the same barcode is read over and over.
+
+    It counts how many reads come out each way. Like `SampleIndex`, each 
+    worker process gets its own copy with zero counts, and hands back its 
+    counts with `take_stats`.
+
+    :param barcodes: the whitelist sequences
+    :type barcodes: iterable of str
+    :param distance: how many edits a sequence can have and still be 
+        corrected, defaults to 1
+    :type distance: int, optional
+    :raises ValueError: if the index would be too big to hold
+    """
+
+    STATUSES = ['exact','corrected','ambiguous','unmatched']
+    # The most sequences to put in the index
+    max_size = 20000000
+    # How many distinct sequences to remember the result for
+    memo_size = 100000
+
+    def __init__(self, barcodes, distance=1):
+        self.barcodes = list(dict.fromkeys( i.upper() for i in barcodes ))
+        self.distance = distance
+        size = sum( sum( math.factorial(len(seq)) // 
+                    ( math.factorial(i)*math.factorial(max(len(seq)-i,0)) )
+                for i in range(min(distance,len(seq))+1) ) 
+            for seq in self.barcodes )
+        if size > self.max_size:
+            raise ValueError("Allowing a distance of "+str(distance)+" for "+
+                str(len(self.barcodes))+" whitelist sequences would need "
+                "up to "+str(size)+" sequences in the index, which is too "
+                "many, so try a smaller distance.")
+        # Each key points to the number of the whitelist sequence it came 
+        # from, or a tuple of them if it came from more than one
+        self.index = {}
+        for number, seq in enumerate(self.barcodes):
+            for neighbour in deletion_neighbours(seq, distance):
+                existing = self.index.get(neighbour)
+                if existing is None:
+                    self.index[neighbour] = number
+                elif isinstance(existing, tuple):
+                    self.index[neighbour] = existing + (number,)
+                else:
+                    self.index[neighbour] = (existing, number)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.memo = collections.OrderedDict()
+
+    @classmethod
+    def from_file(cls, path, distance=1):
+        """Reads a whitelist file, with one sequence per line (anything 
+        after a tab or comma is ignored). It can be gzipped. Blank lines, 
+        lines starting with '#', and a header line (where the first line 
+        isn't a DNA sequence) are skipped.
+
+        :param path: the whitelist file
+        :type path: str
+        :param distance: see `Whitelist`
+        :type distance: int, optional
+        :return: the whitelist
+        :rtype: itermae.Whitelist
+        :raises ValueError: if the file doesn't make sense
+        """
+        barcodes = []
+        binary_fh = open(path,'rb')
+        if binary_fh.peek(2)[:2] == b'\x1f\x8b':
+            binary_fh = io.BufferedReader(ThreadedGzipReader(binary_fh))
+        with io.TextIOWrapper(binary_fh, encoding='ascii') as f:
+            for line_number, line in enumerate(f):
+                seq = re.split('[\t,]', line.strip())[0].strip().upper()
+                if seq == '' or seq.startswith('#'):
+                    continue
+                if not re.fullmatch('[ACGTN]+', seq):
+                    if not barcodes and line_number == 0:
+                        continue # a header
+                    raise ValueError("The sequence '"+seq+"' on line "+
+                        str(line_number+1)+" of the whitelist '"+str(path)+
+                        "' isn't a DNA sequence.")
+                barcodes.append(seq)
+        if not barcodes:
+            raise ValueError("There aren't any sequences in the whitelist "
+                "'"+str(path)+"'.")
+        return cls(barcodes, distance)
+
+    def __getstate__(self):
+        return { 'barcodes': self.barcodes, 'distance': self.distance,
+            'index': self.index }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.memo = collections.OrderedDict()
+
+    def lookup(self, seq):
+        """Finds the nearest whitelist sequence, without counting it.
+
+        :param seq: the sequence
+        :type seq: str
+        :return: the whitelist sequence (or None if it's not 'exact' or 
+            'corrected'), the edit distance to it (or None), and the status
+        :rtype: tuple
+        """
+        seq = seq.upper()
+        number = self.index.get(seq)
+        if number is not None:
+            for i in ( number if isinstance(number, tuple) else (number,) ):
+                if self.barcodes[i] == seq:
+                    return seq, 0, 'exact'
+        candidates = set()
+        for neighbour in deletion_neighbours(seq, self.distance):
+            number = self.index.get(neighbour)
+            if number is None:
+                continue
+            elif isinstance(number, tuple):
+                candidates.update(number)
+            else:
+                candidates.add(number)
+        best, best_distance, tied = None, self.distance+1, False
+        for number in candidates:
+            distance = edit_distance(seq, self.barcodes[number], 
+                best_distance)
+            if distance < best_distance:
+                best, best_distance, tied = number, distance, False
+            elif distance == best_distance and best is not None:
+                tied = True
+        if best is None:
+            return None, None, 'unmatched'
+        if tied:
+            return None, best_distance, 'ambiguous'
+        return self.barcodes[best], best_distance, 'corrected'
+
+    def correct(self, seq, reads=1):
+        """Finds the nearest whitelist sequence, like `lookup`, and counts
+        it. The results are remembered, and when there's `memo_size` of them
+        the least recently used one is forgotten.
+
+        :param seq: the sequence
+        :type seq: str
+        :param reads: how many reads to count it as, more than one for a 
+            record from `collapse` of 'reads', defaults to 1
+        :type reads: int, optional
+        :return: see `lookup`
+        :rtype: tuple
+        """
+        with self.lock:
+            result = self.memo.get(seq)
+            if result is not None:
+                self.memo.move_to_end(seq)
+        if result is None:
+            result = self.lookup(seq)
+            with self.lock:
+                self.memo[seq] = result
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        with self.lock:
+            self.counts[result[2]] = self.counts.get(result[2],0) + reads
+        return result
+
+    def take_stats(self):
+        """Returns the counts, and resets them to zero.
+
+        :return: dict of status to the number of reads
+        :rtype: dict
+        """
+        with self.lock:
+            stats, self.counts = self.counts, {}
+        return stats
+
+    def add_stats(self, stats):
+        """Adds on some counts, as returned by `take_stats` of another 
+        whitelist.
+
+        :param stats: dict of status to the number of reads
+        :type stats: dict
+        """
+        with self.lock:
+            for key, count in stats.items():
+                self.counts[key] = self.counts.get(key,0) + count
 
     def summary(self):
-        return_string = ('Configured as:'+
-            '\n    input from: '+self.input+
-            '\n    input format: '+self.input_format+
-            '\n    is it gzipped?: '+str(self.gzipped)+
-            '\n    output APPENDING to: '+self.output+
-            '\n    output format is: '+self.output_format+
-            '\n    failed being APPENDED to file: '+str(self.failed)+
-            '\n    report being APPENDED to file: '+str(self.report)+
-            '\n    with verbosity set at: '+str(self.verbosity)+
-            '\n    doing these matches:')
-        for each in self.matches_array:
-            return_string += '\n        - input: '+each['input']
-            return_string += '\n          regex: '+str(each['regex'])
-        return_string += '\n    writing these outputs:'
-        for each in self.outputs_array:
-            return_string += '\n        - id: '+str(each['id'][0])
-            return_string += '\n          description: '+str(each['description'][0])
-            return_string += '\n          seq: '+str(each['seq'][0])
-            return_string += '\n          filter: '+str(each['filter'][0])
-        return return_string
+        """The number of reads that came out each way, see `STATUSES`.
 
-    def reader(self):
-        """This reads inputs, calls the `chop` method on each one, and sorts 
-        it off to outputs. So this is called by the main function, and is 
-        mostly about handling the I/O and handing it to the `chop` function.
-        Thus, this depends on the `Configuration` class being properly 
-        configured with all the appropriate values.
+        :rtype: dict
         """
-    
-        # Input
-        self.get_input_seqs()
-    
-        # Outputs - passed records, failed records, report file
-        self.output_fh = self.open_output_fh(self.output)
-        self.report_fh = self.open_output_fh(self.report)
-        self.failed_fh = self.open_output_fh(self.failed)
-    
-        # Do the chop-ing...
-        for each_seq in self.input_seqs:
-    
-            # CAUTION
-            # The below is a munge. 
-            # According to https://github.com/biopython/biopython/issues/398 ,
-            # BioPython mimics an old tool's weird behavior by outputting the 
-            # ID in the description field. The fix for it relies on a comparing
-            # a white-space 'split' to remove the ID if it's in the description.
-            # So that doesn't work if you modify the ID or so, so I remove right
-            # after parsing.
-            each_seq.description = re.sub(str(each_seq.id),"",
-                each_seq.description).lstrip()
-
-            seq_holder = SeqHolder(each_seq,configuration=self)
-            seq_holder.chop()
-    
-        self.close_fhs()
-    
+        with self.lock:
+            return { i: self.counts.get(i,0) for i in self.STATUSES }
+
+
+class Prefilter:
+    """This is a quick check of whether a sequence could possibly match a
+    pattern from the YAML config, before trying the (slow) fuzzy `regex`
+    search. It checks two things:
+
+    - that the sequence is at least as long as the shortest thing the 
+      pattern can match, `min_length`, counting any deletions allowed
+    - that for each constant group (like `GTCCTCGAGGTCTCT`), at least one 
+      piece of it is found exactly in the sequence. If a group allows `k`
+      errors, then it's cut into `k+1` pieces, and `k` errors can't touch 
+      all of them (this is the pigeonhole principle). These pieces are in
+      `kmer_sets`, one list for each group. Groups with pieces that are too
+      short to be worth looking for are left out.
+
+    If either check fails then the regex can't match, so it doesn't need 
+    to be tried. If both pass, it still might not match.
+
+    :param min_length: the shortest sequence that could match
+    :type min_length: int
+    :param kmer_sets: for each constant group, the pieces to look for
+    :type kmer_sets: list of list of str
+    """
+
+    def __init__(self, min_length, kmer_sets):
+        self.min_length = min_length
+        self.kmer_sets = kmer_sets
+
+    @classmethod
+    def from_groups(cls, groups, min_kmer_length=4):
+        """Works out the prefilter from the groups of a YAML pattern, as 
+        `Configuration.config_from_file` parses them.
+
+        :param groups: for each group in order, a tuple of the pattern 
+            characters, the (min, max) repeats or None if not repeated,
+            and a dict of the 'allowed_' error keys that were given
+        :type groups: list of tuple
+        :param min_kmer_length: shortest piece worth looking for, defaults 
+            to 4
+        :type min_kmer_length: int, optional
+        :return: the prefilter, or None if it wouldn't filter anything
+        :rtype: itermae.Prefilter or None
+        """
+        min_length = 0
+        kmer_sets = []
+        for characters, repeats, allowed in groups:
+            # The same as building the regex, a single repeated character
+            # is collapsed down to just one
+            if len(set(characters)) == 1:
+                characters = characters[0]
+            # Deletions are limited by 'allowed_errors' or 
+            # 'allowed_deletions', and if only other types are limited then
+            # deletions aren't allowed
+            deletions = min( [ int(allowed[i]) for i in 
+                ['allowed_errors','allowed_deletions'] if i in allowed ] ,
+                default=0 )
+            if 'allowed_errors' in allowed:
+                errors = int(allowed['allowed_errors'])
+            else:
+                errors = sum( int(i) for i in allowed.values() )
+            group_length = sum( 0 if i == '*' else 1 for i in characters )
+            if repeats is not None:
+                group_length *= repeats[0]
+            min_length += max( 0, group_length - deletions )
+            if not set(characters) <= set('ACGT'):
+                continue
+            if repeats is not None:
+                if repeats[0] != repeats[1]:
+                    continue
+                characters = characters * repeats[0]
+            piece_length = len(characters) // (errors+1)
+            if piece_length < min_kmer_length:
+                continue
+            kmer_sets.append( [ characters[i*piece_length:(i+1)*piece_length]
+                for i in range(errors+1) ] )
+        if min_length == 0 and not kmer_sets:
+            return None
+        return cls(min_length, kmer_sets)
+
+    def could_match(self, seq):
+        """Checks if the sequence could match.
+
+        :param seq: the sequence, uppercase like it's given to `regex`
+        :type seq: str
+        :return: False if it can't possibly match, otherwise True
+        :rtype: bool
+        """
+        if len(seq) < self.min_length:
+            return False
+        for kmers in self.kmer_sets:
+            for kmer in kmers:
+                if kmer in seq:
+                    break
+            else:
+                return False
+        return True
+
 
 class MatchScores:
     """This is a little class just to hold the three scores under attributes,
@@ -752,19 +4346,83 @@ class GroupStats:
     :type end: int
     :param length: number to store under `.length` attribute
     :type length: int
-    :param quality: list of numbers to store under `.quality` attribute
-    :type quality: list of int
-    :param quality_string: string of the quality array under PHRED encodings
-    :type quality_string: string
+    :param quality: list of numbers to store under `.quality` attribute,
+        defaults to None
+    :type quality: list of int, optional
+    :param quality_string: string of the quality array under PHRED encodings,
+        defaults to None
+    :type quality_string: string, optional
+
+    Only one of `quality` or `quality_string` needs to be given, the other is
+    converted from it (in bulk) only if something asks for it. If neither is
+    given, the `quality_string` is taken from `seq` (if that's a ReadRecord)
+    when it's first asked for. Matching hands over a ReadSpan of the read, 
+    so that the qualities stay as letters from parsing to writing unless a 
+    filter wants numbers, and aren't even sliced out unless something wants
+    them. 
+
+    The `start` and `end` are where the group is in whatever the match was 
+    used on, and `absolute_start` and `absolute_end` are where it is in the 
+    original input read (these are the same if the match used the `input`).
+
+    For the `whitelist_group`, `correction` is how it went ('exact', 
+    'corrected', 'ambiguous', or 'unmatched', see `Whitelist`), 
+    `correction_distance` is the edits to the whitelist sequence, and 
+    `original` is the group as it was read. The `seq` is then the corrected
+    sequence, but the positions are still where it was found in the read.
+    These are None for other groups.
     """
 
-    def __init__(self, start, end, seq, quality):
+    correction = None
+    correction_distance = None
+    original = None
+
+    def __init__(self, start, end, seq, quality=None, quality_string=None):
         self.start = start 
         self.end = end 
         self.length = self.end - self.start
         self.seq = seq
-        self.quality = quality
-        self.quality_string = phred_number_array_to_joined_string(quality)
+        self._quality = quality
+        self._quality_string = quality_string
+
+    @property
+    def quality(self):
+        """The qualities as a list of PHRED numbers, converted from the letters
+        the first time it's asked for.
+        """
+        if self._quality is None and self.quality_string is not None:
+            self._quality = phred_joined_string_to_number_array(
+                self._quality_string)
+        return self._quality
+
+    @property
+    def quality_string(self):
+        """The qualities as a string of PHRED letters, converted from the
+        numbers the first time it's asked for.
+        """
+        if self._quality_string is None:
+            if self._quality is not None:
+                self._quality_string = phred_number_array_to_joined_string(
+                    self._quality)
+            else:
+                self._quality_string = getattr(self.seq,'quality',None)
+        return self._quality_string
+
+    @property
+    def absolute_start(self):
+        """Where the group starts in the original input read."""
+        seq = self.seq if self.original is None else self.original
+        if isinstance(seq, ReadSpan):
+            return seq.start
+        return self.start
+
+    @property
+    def absolute_end(self):
+        """Where the group ends in the original input read."""
+        seq = self.seq if self.original is None else self.original
+        if isinstance(seq, ReadSpan):
+            return seq.end
+        return self.end
 
     def flatten(self):
         """Flatten this object for printing debug reports, but just for
@@ -782,6 +4440,11 @@ class GroupStats:
         return str(self.seq.seq) == other
 
 
+# The separator that outputs can use as `dummyspacer`, just the one of it for
+# every read. Nothing changes it, so it's safe to share.
+DUMMYSPACER = ReadRecord("dummyspacer","","X","I")
+
+
 class SeqHolder: 
     """This is the main holder of sequences, and has methods for doing matching,
     building contexts, filtering, etcetra. Basically there is one of these
@@ -790,11 +4453,12 @@ class SeqHolder:
     Used in `chop`.
 
     The `.seqs` attribute holds the sequences accessed by the matching,
-    initialized with the `input_record` SeqRecord and a `dummyspacer` for
-    output formatting with a separator.
+    initialized with the `input_record` ReadRecord and a `dummyspacer` for
+    output formatting with a separator. A SeqRecord is converted to a
+    ReadRecord first.
     
-    :param input_record: an input SeqRecord object
-    :type input_record: Bio.SeqRecord.SeqRecord
+    :param input_record: an input ReadRecord (or SeqRecord) object
+    :type input_record: itermae.ReadRecord or Bio.SeqRecord.SeqRecord
     :param configuration: the whole program's Configuration object, with
         appropriate file-handles opened up and defaults set
     :type configuration: itermae.Configuration
@@ -803,17 +4467,48 @@ class SeqHolder:
 #    :rtype: [ReturnType]
     """
     def __init__(self, input_record, configuration):
-        self.seqs = {
-            'dummyspacer': SeqRecord.SeqRecord(Seq.Seq("X"),id="dummyspacer"),
-            'input': input_record }
-        self.seqs['dummyspacer'].letter_annotations['phred_quality'] = [40]
         self.configuration = configuration
+        self.seqs = {}
         # These two dicts hold the scores for each match operation (in order),
         # and the start end length statistics for each matched group.
         self.match_scores = {}
         self.group_stats = {}
+        # And the raw results of each match, see `record_match`
+        self.match_results = {}
+        # And the contexts for `eval`, filled by `build_context` if needed
+        self.context_filter = {}
+        self.context_seq = {}
+        self.context_id = {}
+        self.reset(input_record)
 
-    def apply_operation(self, match_id, input_group, regex):
+    def reset(self, input_record):
+        """Empties this holder out and sets it up for another input read, 
+        so that one holder can be reused for read after read instead of 
+        making new dicts for each one. The dicts are cleared in place.
+
+        :param input_record: an input ReadRecord (or SeqRecord) object
+        :type input_record: itermae.ReadRecord or Bio.SeqRecord.SeqRecord
+        :return: self
+        :rtype: itermae.SeqHolder
+        """
+        if not isinstance(input_record, ReadRecord):
+            input_record = ReadRecord.from_seqrecord(input_record)
+        self.seqs.clear()
+        self.seqs['dummyspacer'] = DUMMYSPACER
+        self.seqs['input'] = input_record
+        # How many reads this stands for, when they're collapsed
+        self.reads = collapsed_read_count(input_record.id) \
+            if self.configuration.collapse == 'reads' else 1
+        self.match_scores.clear()
+        self.group_stats.clear()
+        self.match_results.clear()
+        self.context_built = False
+        # And this is the set of which matches have been applied, or None
+        # before `apply_matches` has set it up
+        self.matches_applied = None
+        return self
+
+    def apply_operation(self, match_id, input_group, regex, prefilter=None):
         """This applies the given match to the `SeqHolder` object, and saves 
         how it did internally.
 
@@ -825,6 +4520,9 @@ class SeqHolder:
         :param regex: the regular expression to apply, complete with named 
             groups to save for subsequent match operations
         :type regex: regex compiled regular expression object
+        :param prefilter: quick check of whether it's worth trying the regex,
+            defaults to None for always trying it
+        :type prefilter: itermae.Prefilter, optional
         :return: self, this is just done so it can exit early if no valid input
         :rtype: itermae.SeqHolder
         """
@@ -833,7 +4531,7 @@ class SeqHolder:
         try: 
             self.seqs[input_group]
         except:
-            self.match_scores[match_id] = MatchScores(None,None,None)
+            self.record_match(match_id, input_group, None)
             return self
 
         if self.configuration.verbosity >= 3:
@@ -841,26 +4539,89 @@ class SeqHolder:
                 str(regex)+" against "+self.seqs[input_group].seq,
                 file=sys.stderr)
 
-        # Here we execute the actual meat of the business.
         # Note that the input is made uppercase!
-        fuzzy_match = regex.search( str(self.seqs[input_group].seq).upper() )
+        input_seq = str(self.seqs[input_group].seq).upper()
 
-        if self.configuration.verbosity >= 3:
-            print("\n["+str(time.time())+"] : match is : "+str(fuzzy_match),
+        # If it can't possibly match, don't bother with the regex
+        if prefilter is not None and not prefilter.could_match(input_seq):
+            if self.configuration.verbosity >= 3:
+                print("\n["+str(time.time())+"] : prefilter says it can't "+
+                    "match, so skipping", file=sys.stderr)
+            self.record_match(match_id, input_group, None)
+            return self
+
+        # Here we execute the actual meat of the business, unless the result
+        # is already in the cache. It's saved as the fuzzy_counts and the span
+        # of each group, or None if it didn't match.
+        match_cache = self.configuration.match_cache
+        if match_cache is None:
+            result = MatchCache.MISSING
+        else:
+            result = match_cache.get(match_id, input_seq)
+        if result is MatchCache.MISSING:
+            # With multiple threads, `concurrent` lets go of the GIL while 
+            # searching
+            fuzzy_match = regex.search( input_seq,
+                concurrent=self.configuration.threads > 1 )
+            if self.configuration.verbosity >= 3:
+                print("\n["+str(time.time())+"] : match is : "+str(fuzzy_match),
+                    file=sys.stderr)
+            if fuzzy_match is None:
+                result = None
+            else:
+                result = ( fuzzy_match.fuzzy_counts, 
+                    [ ( match_name, fuzzy_match.span(match_name) ) 
+                        for match_name in fuzzy_match.groupdict() ] )
+            if match_cache is not None:
+                match_cache.put(match_id, input_seq, result)
+        elif self.configuration.verbosity >= 3:
+            print("\n["+str(time.time())+"] : cached match is : "+str(result),
                 file=sys.stderr)
 
+        self.record_match(match_id, input_group, result)
+
+        return self
+
+    def record_match(self, match_id, input_group, result):
+        """Saves the result of a match operation into this `SeqHolder`, so
+        the scores in `match_scores`, and for each group matched the slice 
+        of the input group in `seqs`, and the `GroupStats` in `group_stats`.
+        This is split out of `apply_operation` so that a result from the
+        match cache or a read with the same sequence can be reused. The 
+        result is also kept in `match_results`.
+
+        :param match_id: the name of the match
+        :type match_id: str
+        :param input_group: which group the match was done on
+        :type input_group: str
+        :param result: the `fuzzy_counts` and list of (group name, span), 
+            or None if it didn't match
+        :type result: tuple or None
+        """
+
+        self.match_results[match_id] = result
+
+        if self.configuration.run_stats is not None:
+            self.configuration.run_stats.count(('match',match_id),
+                result is not None)
+
+        if result is None:
+            self.match_scores[match_id] = MatchScores(None,None,None)
+            return
+
         try:
             # This is making and storing an object for just accessing these
             # numbers nicely in the arguments for forming outputs and filtering.
-            self.match_scores[match_id] = MatchScores(*fuzzy_match.fuzzy_counts)
+            self.match_scores[match_id] = MatchScores(*result[0])
 
             # Then for each of the groups matched by the regex
-            for match_name in fuzzy_match.groupdict():
+            for match_name, span in result[1]:
     
                 # We stick into the holder a slice of the input seq, that is 
                 # the matched # span of this matching group. So, extract.
-                self.seqs[match_name] = \
-                    self.seqs[input_group][slice(*fuzzy_match.span(match_name))]
+                # This is a ReadSpan, so nothing is copied until it's used.
+                self.seqs[match_name] = ReadSpan.of(
+                    self.seqs[input_group], *span)
 
                 #self.seqs[match_name].description = "" 
                 # This is to fix a bug where the ID is stuck into the 
@@ -868,42 +4629,91 @@ class SeqHolder:
 
                 # Then we record the start, end, and length of the matched span
                 self.group_stats[match_name] = \
-                    GroupStats(*fuzzy_match.span(match_name),
-                        seq=self.seqs[match_name],
-                        quality=self.seqs[match_name].letter_annotations['phred_quality']
-                        )
+                    GroupStats(*span, seq=self.seqs[match_name])
+
+                if match_name == self.configuration.whitelist_group and \
+                        self.configuration.whitelist_index is not None:
+                    self.correct_group(match_name)
 
         except:
             self.match_scores[match_id] = MatchScores(None,None,None)
 
+    def correct_group(self, name):
+        """Corrects a matched group to the nearest sequence on the 
+        whitelist, see `Whitelist`. If it's 'corrected', the group in `seqs` 
+        is swapped for the whitelist sequence (with qualities from the read,
+        see `_corrected_quality`), and either way how it went is put on its
+        `GroupStats`.
+
+        :param name: the name of the group
+        :type name: str
+        """
+        original = self.seqs[name]
+        stats = self.group_stats[name]
+        corrected, distance, status = \
+            self.configuration.whitelist_index.correct(original.seq, 
+                self.reads)
+        stats.correction = status
+        stats.correction_distance = distance
+        stats.original = original
+        if status == 'corrected':
+            corrected_record = ReadRecord(original.id, original.description,
+                corrected, _corrected_quality(original.seq.upper(), 
+                    original.quality, corrected) )
+            self.seqs[name] = corrected_record
+            stats.seq = corrected_record
+            stats._quality = None
+            stats._quality_string = None
+        if self.configuration.verbosity >= 3:
+            print("\n["+str(time.time())+"] : group "+name+" "+
+                original.seq+" is "+status+
+                ("" if corrected is None else " as "+corrected),
+                file=sys.stderr)
+
     def build_context(self):
         """This unpacks group match stats/scores into an environment that
-        the filter can then use to ... well ... filter. 
+        the filter can then use to ... well ... filter. This is only needed
+        for outputs that don't have generated functions (see
+        `compile_output_functions`), so `eval` has something to look in.
         """
 
+        # These dicts are kept on the holder and filled in place, so a reused
+        # holder (see `reset`) doesn't make new ones for every read.
+
         # This is context for the filters, so is operating more as values,
-        # as opposed to the context_seq which is operating with SeqRecords
-        self.context_filter = { **self.group_stats , **self.match_scores }
+        # as opposed to the context_seq which is operating with ReadRecords
+        self.context_filter.clear()
+        self.context_filter.update(self.group_stats)
+        self.context_filter.update(self.match_scores)
 
         # Then unpack the sequences as a context for building the output 
         # sequences, this is different so that the qualities get stuck with
         # the bases of the groups
-        self.context_seq = { **self.seqs }
+        self.context_seq.clear()
+        self.context_seq.update(self.seqs)
 
         # Then one for the IDs, so we're setting the input ID as 'id', and then
         # each group name just refers to the sequence. And I finally put seq 
         # qualities in the ID. We do make 'description' available if needed
-        self.context_id = { 
-            'id': self.seqs['input'].id , 
-            'description': self.seqs['input'].description , 
-            **{ i: str(self.seqs[i].seq) for i in self.seqs } ,
-            **{ i+'_quality': self.group_stats[i].quality_string 
-                    for i in self.group_stats } }
+        context_id = self.context_id
+        context_id.clear()
+        context_id['id'] = self.seqs['input'].id 
+        context_id['description'] = self.seqs['input'].description 
+        for i in self.seqs:
+            context_id[i] = str(self.seqs[i].seq)
+        for i in self.group_stats:
+            context_id[i+'_quality'] = self.group_stats[i].quality_string
+            if self.group_stats[i].correction is not None:
+                context_id[i+'_correction'] = self.group_stats[i].correction
+
+        self.context_built = True
 
     def evaluate_filter_of_output(self,output_dict):
         """This tests a user-defined filter on the 'seq_holder' object.
-        This has already been `compile`'d, and here we just attempt to
-        evaluate these to `True`, where `True` is passing the filter.
+        This has already been turned into a function by `Configuration`, 
+        and here we just attempt to evaluate these to `True`, where `True` is
+        passing the filter. If the `output_dict` doesn't have the function, 
+        then the `compile`'d expression is `eval`'d.
         Exceptions are blocked by using `try`/`except` so that it can fail on 
         a single match and move onto the next match/read.
 
@@ -915,7 +4725,14 @@ class SeqHolder:
         """
 
         try:
-            filter_result = eval(output_dict['filter'][1],globals(),self.context_filter)
+            if 'filter_function' in output_dict:
+                filter_result = output_dict['filter_function'](
+                    self.seqs, self.group_stats, self.match_scores)
+            else:
+                if not self.context_built:
+                    self.build_context()
+                filter_result = eval(output_dict['filter'][1],globals(),
+                    self.context_filter)
             if self.configuration.verbosity >= 3:
                 print("\n["+str(time.time())+"] : This read "+
                     self.seqs['input'].id+" successfully evaluated the filter "+
@@ -937,18 +4754,24 @@ class SeqHolder:
         :param output_dict: a dictionary of outputs to form, as generated from
             the configuration initialization
         :type output_dict: dict
-        :return: the successfully built SeqRecord, or None if it fails
-        :rtype: Bio.SeqRecord.SeqRecord or None
+        :return: the successfully built ReadRecord, or None if it fails
+        :rtype: itermae.ReadRecord or None
         """
 
         try:
-            output_seq = eval(output_dict['seq'][1],globals(),self.context_seq)
-            out_seq = SeqRecord.SeqRecord(
-                seq = Seq.Seq(str(output_seq.seq)) ,
-                id = str(eval(output_dict['id'][1],globals(),self.context_id)) ,
-                description = str(eval(output_dict['description'][1],globals(),self.context_id)) ,
-                letter_annotations = {'phred_quality':output_seq.letter_annotations['phred_quality']}
-            )
+            if 'build_function' in output_dict:
+                out_seq = output_dict['build_function'](
+                    self.seqs, self.group_stats, self.match_scores)
+            else:
+                if not self.context_built:
+                    self.build_context()
+                output_seq = eval(output_dict['seq'][1],globals(),self.context_seq)
+                out_seq = ReadRecord(
+                    id = str(eval(output_dict['id'][1],globals(),self.context_id)) ,
+                    description = str(eval(output_dict['description'][1],globals(),self.context_id)) ,
+                    seq = str(output_seq.seq) ,
+                    quality = output_seq.quality
+                )
             if self.configuration.verbosity >= 3:
                 print("\n["+str(time.time())+"] : This read "+
                     self.seqs['input'].id+" successfully built the output of "+
@@ -972,114 +4795,973 @@ class SeqHolder:
         :param label: what type of report line this is, so a string describing
             how it went - passed? Failed?
         :type label: str
-        :param label: the attempt at generating an output SeqRecord, so either
+        :param label: the attempt at generating an output ReadRecord, so either
             one that was formed or None
-        :type label: Bio.SeqRecord.SeqRecord or None
+        :type label: itermae.ReadRecord or None
         :return: the string for the report
         :rtype: str
         """
 
         if output_seq is None:
-            output_seq = SeqRecord.SeqRecord('X',
-                id='ERROR',
-                letter_annotations={'phred_quality':[0]})
+            output_seq = ReadRecord('ERROR','','X','!')
 
         try:
             output_string = ( str(output_seq.id)+"\",\""+
                 str(output_seq.seq)+"\",\""+
-                phred_number_array_to_joined_string(
-                    output_seq.letter_annotations['phred_quality']) )
+                output_seq.quality )
         except:
             output_string = "*,*,*"
 
         return ( "\""+label+"\",\""+
             str(self.seqs['input'].id)+"\",\""+
             str(self.seqs['input'].seq)+"\",\""+
-            phred_number_array_to_joined_string(self.seqs['input'].letter_annotations['phred_quality'])+"\",\""+
+            self.seqs['input'].quality+"\",\""+
             output_string+"\",\""+
             "-".join([ i+"_"+self.group_stats[i].flatten() 
                         for i in self.group_stats ] )+
             "\"" ) # See group_stats method for what these are (start stop len)
 
     def chop(self):
-        """This executes the intended purpose of the `SeqRecord` object, and is
-        called once. It uses the configured object to apply each match
-        operation as best it can with the sequences it is given or can generate,
-        then writes the outputs in the specified formats to specified places
-        as configured.
+        """This executes the intended purpose of the `SeqHolder` object, and is
+        called once. It uses the configured object to apply the match
+        operations as best it can with the sequences it is given or can 
+        generate, then writes the outputs in the specified formats to 
+        specified places as configured. Unless there's a report to write, 
+        matches are only applied when an output needs them, see 
+        `write_outputs`.
         """
+        if self.configuration.report_writer is not None:
+            self.apply_matches()
+        self.write_outputs()
+
+    def apply_matches(self, which=None):
+        """This applies the match operations of the configuration in order,
+        as best it can with the sequences it is given or can generate. This is
+        the first half of `chop`, split out so that the `regex` searching
+        can be run on a pool of threads (see `Configuration.chop_records`).
+        Matches that have already been applied to this read are skipped, so
+        this can be called again for each output with the matches it needs.
+
+        :param which: indices of the matches in `matches_array` to apply,
+            in order, or None (the default) for all of them
+        :type which: list of int, optional
+        :return: self
+        :rtype: itermae.SeqHolder
+        """
+
+        if self.matches_applied is None:
+            self.matches_applied = set()
     
-        # If qualities are missing, add them as just 40
-        if 'phred_quality' not in self.seqs['input'].letter_annotations.keys():
-            self.seqs['input'].letter_annotations['phred_quality'] = [40]*len(self.seqs['input'])
-    
+            # If qualities are missing, add them as just 40
+            if self.seqs['input'].quality is None:
+                self.seqs['input'].quality = 'I'*len(self.seqs['input'])
+        
+                if self.configuration.verbosity >= 2:
+                    print("\n["+str(time.time())+"] : adding missing qualities of 40 "+
+                        "to sequence.", file=sys.stderr)
+        
+            # For chop grained self.configuration.verbosity, report
             if self.configuration.verbosity >= 2:
-                print("\n["+str(time.time())+"] : adding missing qualities of 40 "+
-                    "to sequence.", file=sys.stderr)
-    
-        # For chop grained self.configuration.verbosity, report
-        if self.configuration.verbosity >= 2:
-            print("\n["+str(time.time())+"] : starting to process : "+
-                self.seqs['input'].id+"\n  "+self.seqs['input'].seq+"\n  "+ 
-                phred_number_array_to_joined_string(self.seqs['input'].letter_annotations['phred_quality']),
-                file=sys.stderr)
-    
-        # This should fail if you didn't specify anything taking from input stream!
-        assert self.configuration.matches_array[0]['input'] == "input", (
-            "can't find the sequence named `input`, rather we see `"+
-            self.configuration.matches_array[0]['input']+"` in the holder, so breaking. You should "+
-            "have the first operation start with `input` as a source." )
+                print("\n["+str(time.time())+"] : starting to process : "+
+                    self.seqs['input'].id+"\n  "+self.seqs['input'].seq+"\n  "+ 
+                    self.seqs['input'].quality,
+                    file=sys.stderr)
+        
+            # This should fail if you didn't specify anything taking from input stream!
+            assert self.configuration.matches_array[0]['input'] == "input", (
+                "can't find the sequence named `input`, rather we see `"+
+                self.configuration.matches_array[0]['input']+"` in the holder, so breaking. You should "+
+                "have the first operation start with `input` as a source." )
+
+            if self.configuration.collapse == 'matches':
+                self.apply_collapsed_matches()
+
+        if which is None:
+            which = range(len(self.configuration.matches_array))
+
+        run_stats = self.configuration.run_stats
     
         # Next, iterate through the matches, applying each one
-        for operation_number, operation in enumerate(self.configuration.matches_array):
-    
-            self.apply_operation( 'match_'+str(operation_number),
-                    operation['input'], operation['regex'] )
-    
-        # Now self should have a lot of matches, match scores and group stats,
-        # and matched sequences groups. All these values allow us to apply filters
-        # We unpack matches and scores into an internal environment for the filters
-        self.build_context()
+        for operation_number in which:
+
+            if operation_number in self.matches_applied:
+                continue
+            self.matches_applied.add(operation_number)
+            operation = self.configuration.matches_array[operation_number]
+            match_id = 'match_'+str(operation_number)
     
-        # Then we eval the filters and build outputs, for each output
+            if run_stats is not None:
+                start = time.perf_counter()
+            self.apply_operation( match_id,
+                    operation['input'], operation['regex'], 
+                    operation.get('prefilter') )
+            if run_stats is not None:
+                run_stats.add_time(('match',match_id),
+                    time.perf_counter()-start)
+
+        return self
+
+    def apply_collapsed_matches(self):
+        """For `collapse` of 'matches', this applies all the matches once
+        for each distinct input sequence. The results of the first read with
+        a sequence are saved in the configuration's `collapsed_matches`, and
+        reads after that with the same sequence reuse them. Each read still 
+        gets its own slices (with its own qualities) and is filtered on its
+        own.
+        """
+        seq = self.seqs['input'].seq
+        results = self.configuration.collapsed_matches.get(seq)
+        run_stats = self.configuration.run_stats
+        for operation_number, operation in \
+                enumerate(self.configuration.matches_array):
+            match_id = 'match_'+str(operation_number)
+            if run_stats is not None:
+                start = time.perf_counter()
+            if results is None:
+                self.apply_operation( match_id,
+                    operation['input'], operation['regex'], 
+                    operation.get('prefilter') )
+            else:
+                self.record_match( match_id, operation['input'], 
+                    results[operation_number] )
+            if run_stats is not None:
+                run_stats.add_time(('match',match_id),
+                    time.perf_counter()-start)
+        if results is None:
+            self.configuration.collapsed_matches[seq] = [ 
+                self.match_results['match_'+str(i)] 
+                for i in range(len(self.configuration.matches_array)) ]
+        self.matches_applied.update(range(len(self.configuration.matches_array)))
+
+    def write_outputs(self):
+        """This is the second half of `chop`. It filters and builds each 
+        output, then writes these in the specified formats to specified 
+        places as configured.
+
+        Each output first applies the matches it needs (see 
+        `Configuration.plan_outputs`), that haven't been applied yet. If a
+        group its filter can't do without is missing, the filter fails 
+        without trying, and it's only built if the filter passes (and the
+        groups it's built from are there). If there's a report to write,
+        then all the matches are applied and all the outputs are built, so 
+        that the report has all the details. For a `SummaryReport`, all the
+        matches are applied, but outputs are still only built if they pass,
+        and the same for writing per-read statistics with `MatchStatsWriter`.
+        """
+
+        full_report = self.configuration.report_writer is not None
+        summary_report = self.configuration.summary_report
+        stats_writer = self.configuration.stats_writer
+        run_stats = self.configuration.run_stats
+        all_matches = full_report or summary_report is not None or \
+            stats_writer is not None
+
         output_records = []
         for each_output in self.configuration.outputs_array:
+
+            self.apply_matches( None if all_matches else 
+                each_output.get('matches') )
+
+            if run_stats is not None:
+                start = time.perf_counter()
+
+            missing = [ i for i in each_output.get('required_groups',[]) 
+                if i not in self.seqs ]
+            if missing and not full_report:
+                if self.configuration.verbosity >= 3:
+                    print("\n["+str(time.time())+"] : This read "+
+                        self.seqs['input'].id+" is missing group(s) "+
+                        ", ".join(missing)+" so fails the filter of output "+
+                        each_output['name'], file=sys.stderr)
+                filter_result = False
+            else:
+                filter_result = self.evaluate_filter_of_output(each_output)
+
+            if run_stats is not None:
+                filtered = time.perf_counter()
+                run_stats.add_time(('filter',each_output['name']),
+                    filtered-start)
+                run_stats.count(('filter',each_output['name']), 
+                    bool(filter_result))
+
+            if full_report:
+                output = self.build_output(each_output)
+            elif not filter_result:
+                output = None
+            elif any( i not in self.seqs 
+                    for i in each_output.get('build_groups',[]) ):
+                if self.configuration.verbosity >= 3:
+                    print("\n["+str(time.time())+"] : This read "+
+                        self.seqs['input'].id+" passed the filter, but is "+
+                        "missing group(s) to build output "+
+                        each_output['name'], file=sys.stderr)
+                output = None
+            else:
+                output = self.build_output(each_output)
+
             output_records.append( { 
                     'name': each_output['name'],
-                    'filter_result': self.evaluate_filter_of_output(each_output), 
-                    'output': self.build_output(each_output) 
+                    'filter_result': filter_result, 
+                    'output': output
                 } )
+
+            if run_stats is not None:
+                run_stats.add_time(('build',each_output['name']),
+                    time.perf_counter()-filtered)
+                if filter_result:
+                    run_stats.count(('build',each_output['name']), 
+                        output is not None)
+
+        if summary_report is not None:
+            summary_report.add_read(self, output_records)
+        if stats_writer is not None:
+            stats_writer.add_read(self, output_records)
+
+        if run_stats is not None:
+            run_stats.count_read()
+            start = time.perf_counter()
     
         # This is just if we pass all the filters provided
         passed_filters = not any( 
                 [ i['filter_result'] == False for i in output_records ] )
     
         # Then we can make the report CSV if asked for (mainly for debugging/tuning)
-        if self.configuration.report_fh != None:
+        if self.configuration.report_writer != None:
             for output_record in output_records:
                 if output_record['filter_result']:
-                    print( self.format_report( 
+                    self.configuration.report_writer.write( self.format_report( 
                             "PassedFilterFor_"+output_record['name'], 
-                            output_record['output'] ) ,file=self.configuration.report_fh)
+                            output_record['output'] )+"\n" )
                 else:
-                    print( self.format_report( 
+                    self.configuration.report_writer.write( self.format_report( 
                             "FailedFilterFor_"+output_record['name'], 
-                            output_record['output'] ) ,file=self.configuration.report_fh)
+                            output_record['output'] )+"\n" )
     
+        # When demultiplexing, the outputs go to the file for this read's 
+        # sample
+        sample_index = self.configuration.sample_index
+        if sample_index is not None:
+            index_group = self.seqs.get(self.configuration.demultiplex_group)
+            self.configuration.output_writer.select( sample_index.assign( 
+                None if index_group is None else index_group.seq, 
+                self.reads ) )
+
         # Finally, write all the outputs, to main stream if passed, otherwise to
         # the failed output (if provided)
         for output_record in output_records:
             if output_record['filter_result'] and output_record['output'] is not None:
-                write_out_seq(output_record['output'], self.configuration.output_fh, self.configuration.output_format, 
-                    output_record['name'])
+                # Counting needs to know how many reads a collapsed record 
+                # is, writing just writes the record
+                if isinstance(self.configuration.output_writer, CountWriter):
+                    self.configuration.output_writer.write_record(
+                        output_record['output'], output_record['name'],
+                        self.reads)
+                else:
+                    self.configuration.output_writer.write_record(
+                        output_record['output'], output_record['name'])
                 if self.configuration.verbosity >= 3:
                     print("\n["+str(time.time())+"] : wrote out output '"+
                         output_record['name']+"' for this input",
                         file=sys.stderr)
-            elif self.configuration.failed_fh != None:
-                write_out_seq(self.seqs['input'], self.configuration.failed_fh, self.configuration.input_format, 
-                    output_record['name'])
+            elif self.configuration.failed_writer != None:
+                self.configuration.failed_writer.write_record(
+                    self.seqs['input'], output_record['name'])
                 if self.configuration.verbosity >= 3:
                     print("\n["+str(time.time())+"] : output "+
                         output_record['name']+" failed, written to fail file\n",
                         file=sys.stderr)
+
+        if run_stats is not None:
+            run_stats.add_time(('write','output'), time.perf_counter()-start)
+
+
+class _NotVectorizable(Exception):
+    """Raised by `BatchChopper` when a filter can't be worked out over a 
+    whole chunk at once, so it's done read by read instead."""
+
+
+class _BatchChunk:
+    """What `BatchChopper` knows about one chunk of reads. `groups` has the
+    arrays of each group made so far (and the `input`), as a tuple of 
+    whether it's there, the start and end in what was searched, and the 
+    start and end in the read. `scores` has the arrays of each match, as a
+    tuple of whether it matched and the substitutions, insertions and 
+    deletions. `match_data` has the same as lists, by match, for filling in
+    a `SeqHolder` for a read.
+
+    :param reads: the reads in this chunk
+    :type reads: list of itermae.ReadRecord
+    :param numpy: the numpy module
+    :type numpy: module
+    """
+
+    def __init__(self, reads, numpy):
+        self.reads = reads
+        self.n = len(reads)
+        self.numpy = numpy
+        lengths = numpy.array([ len(i.seq) for i in reads ], dtype=numpy.int64)
+        zeros = numpy.zeros(self.n, dtype=numpy.int64)
+        self.groups = { 'input': ( numpy.ones(self.n, dtype=bool), 
+            zeros, lengths, zeros, lengths ) }
+        self.scores = {}
+        self.match_data = {}
+        self.group_seqs = {}
+        self.group_qualities = {}
+        self.qualities = None
+
+    def group(self, name):
+        """The arrays for a group, with it not being there for any read if
+        no match has made it.
+        """
+        try:
+            return self.groups[name]
+        except KeyError:
+            zeros = self.numpy.zeros(self.n, dtype=self.numpy.int64)
+            return ( self.numpy.zeros(self.n, dtype=bool), 
+                zeros, zeros, zeros, zeros )
+
+    def strings(self, name, which='seq'):
+        """The sequence (or qualities) of a group for each read, as an
+        object array of strings, with '' where the group isn't there.
+        """
+        cache = self.group_seqs if which == 'seq' else self.group_qualities
+        if name not in cache:
+            present, _, _, starts, ends = self.group(name)
+            cache[name] = self.numpy.array( [ 
+                    getattr(read,which)[start:end] if here else ''
+                    for read, here, start, end in zip( self.reads, 
+                        present.tolist(), starts.tolist(), ends.tolist() ) ],
+                dtype=object )
+        return cache[name]
+
+    def quality_sums(self):
+        """The cumulative sums of the quality letters of the whole chunk, 
+        joined together, and where each read starts and ends in that.
+        """
+        if self.qualities is None:
+            numpy = self.numpy
+            joined = "".join( i.quality for i in self.reads ).encode('ascii')
+            ends = numpy.cumsum([ len(i.quality) for i in self.reads ],
+                dtype=numpy.int64)
+            starts = ends - numpy.array([ len(i.quality) for i in self.reads ],
+                dtype=numpy.int64)
+            sums = numpy.zeros(len(joined)+1, dtype=numpy.int64)
+            numpy.cumsum(numpy.frombuffer(joined, dtype=numpy.uint8), 
+                out=sums[1:])
+            self.qualities = ( sums, starts, ends )
+        return self.qualities
+
+
+class BatchChopper:
+    """This chops reads a chunk at a time for `batch_engine`, instead of one
+    `SeqHolder` at a time. Each match is run across the whole chunk, and 
+    what it found is kept in NumPy arrays - if it matched, the errors, and 
+    the start and end of each group (in what it searched, and in the read).
+    Filters made of simple parts are worked out as masks over the chunk,
+    these parts being:
+
+    - comparing numbers, like `barcode.length >= 20` or 
+      `match_0.substitutions == 0`, and adding etc. them together
+    - comparing a group to a sequence, like `sampleIndex == 'GCTTC'`
+    - the quality and sequence functions, like `mean_quality(barcode)`,
+      and `statistics.mean(barcode.quality)` or `.median` of that
+    - `and`, `or`, and `not` of those
+
+    Anything else means that filter is done read by read, with a `SeqHolder`
+    filled in from the arrays. Outputs are built only for the reads that
+    pass, with the same generated functions, and each chunk's outputs are 
+    written at once. The `SeqHolder` path is still the reference, and this 
+    should write exactly the same. Some things need every read to go 
+    through a `SeqHolder`, see `unsupported`.
+
+    :param configuration: the configuration to chop with
+    :type configuration: itermae.Configuration
+    :raises ImportError: if `numpy` isn't there
+    """
+
+    # The quality and sequence functions, that are worked out per read on 
+    # the strings of a group, unless there's a vectorized version
+    read_functions = { 'median_quality': ('quality', median_quality),
+        'min_quality': ('quality', min_quality), 
+        'expected_errors': ('quality', expected_errors),
+        'n_count': ('seq', n_count), 'gc_fraction': ('seq', gc_fraction),
+        'mean_quality': ('quality', mean_quality) }
+
+    comparisons = { ast.Lt: lambda a, b: a < b, ast.LtE: lambda a, b: a <= b,
+        ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b,
+        ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b }
+
+    arithmetic = { ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b,
+        ast.Mult: lambda a, b: a * b, ast.Div: lambda a, b: a / b,
+        ast.FloorDiv: lambda a, b: a // b, ast.Mod: lambda a, b: a % b }
+
+    def __init__(self, configuration):
+        try:
+            import numpy
+        except ImportError as error:
+            raise ImportError(repr(error)+" : The batch engine needs numpy, "
+                "so install that or turn off batch_engine.")
+        self.numpy = numpy
+        self.configuration = configuration
+        matches_array = configuration.matches_array
+        self.group_names = configuration.list_group_names()
+        self.match_ids = [ 'match_'+str(i) for i in range(len(matches_array)) ]
+        self.matches = sorted({ index 
+            for each in configuration.outputs_array
+            for index in each.get('matches', range(len(matches_array))) })
+        if self.matches:
+            assert matches_array[0]['input'] == "input", (
+                "can't find the sequence named `input`, rather we see `"+
+                matches_array[0]['input']+"` in the holder, so breaking. "+
+                "You should have the first operation start with `input` "+
+                "as a source." )
+        # Only the groups the outputs use are put in a `SeqHolder`
+        self.used_names = set()
+        for each in configuration.outputs_array:
+            for tree in [ ast.parse(each[i][0], mode='eval') 
+                    for i in ['filter','id','seq','description'] ]:
+                for node in ast.walk(tree):
+                    if isinstance(node, ast.Name):
+                        self.used_names.add(node.id)
+                        if node.id.endswith('_quality'):
+                            self.used_names.add(node.id[:-len('_quality')])
+        self.filters = []
+        for each in configuration.outputs_array:
+            try:
+                self.filters.append( self.vectorize(
+                    ast.parse(each['filter'][0], mode='eval').body ) )
+            except _NotVectorizable:
+                self.filters.append(None)
+        self.holder = None
+
+    @staticmethod
+    def unsupported(configuration):
+        """Says why a configuration can't be chopped by `BatchChopper`, or 
+        None if it can.
+
+        :param configuration: the configuration to check
+        :type configuration: itermae.Configuration
+        :return: the reason, or None
+        :rtype: str or None
+        """
+        if configuration.report is not None:
+            return "the report needs every output of every read"
+        if configuration.report_summary is not None:
+            return "the summary report looks at each read"
+        if configuration.output_stats is not None:
+            return "the per-read statistics look at each read"
+        if configuration.collapse == 'matches':
+            return "collapsing matches is done read by read"
+        if configuration.threads > 1:
+            return "matching threads work on SeqHolders"
+        if configuration.whitelist is not None:
+            return "correcting a group with the whitelist is done read by read"
+        if configuration.verbosity >= 2:
+            return "that verbosity reports on each read"
+        if any( i['input'] == 'dummyspacer' 
+                for i in configuration.matches_array ):
+            return "a match uses the dummyspacer"
+        return None
+
+    def vectorize(self, node):
+        """Turns part of a filter expression into a function that works it 
+        out for a whole chunk, or raises `_NotVectorizable`.
+
+        :param node: the part of the filter expression
+        :type node: ast.AST
+        :return: the kind ('num', 'str', 'group', or 'bool') of what it 
+            makes, and the function that takes a `_BatchChunk` and returns 
+            the values (an array, or just one value for all) and a mask of 
+            the reads where it would have raised an exception (or None for 
+            none)
+        :rtype: tuple
+        """
+        numpy = self.numpy
+
+        if isinstance(node, ast.Constant) and \
+                type(node.value) in (bool, int, float, str):
+            value = node.value
+            return ( 'str' if isinstance(value,str) else 'num', 
+                lambda chunk: (value, None) )
+
+        if isinstance(node, ast.Name) and node.id in self.group_names:
+            name = node.id
+            return 'group', lambda chunk: ( chunk.strings(name), 
+                ~chunk.group(name)[0] )
+
+        if isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name):
+            name, attribute = node.value.id, node.attr
+            if name in self.group_names:
+                which = { 'start': 1, 'end': 2, 'absolute_start': 3, 
+                    'absolute_end': 4, 'length': None }
+                if attribute in which:
+                    def group_attribute(chunk):
+                        group = chunk.group(name)
+                        if attribute == 'length':
+                            return group[2] - group[1], ~group[0]
+                        return group[which[attribute]], ~group[0]
+                    return 'num', group_attribute
+            elif name in self.match_ids:
+                which = { 'substitutions': 1, 'insertions': 2, 'deletions': 3 }
+                if attribute in which:
+                    def match_attribute(chunk):
+                        scores = chunk.scores[name]
+                        return scores[which[attribute]], ~scores[0]
+                    return 'num', match_attribute
+
+        if isinstance(node, ast.Call) and not node.keywords:
+            return self.vectorize_call(node)
+
+        if isinstance(node, ast.UnaryOp):
+            kind, function = self.vectorize(node.operand)
+            if isinstance(node.op, ast.Not):
+                return 'bool', lambda chunk: self.not_of(kind, function, chunk)
+            if kind == 'num' and isinstance(node.op, (ast.USub, ast.UAdd)):
+                sign = -1 if isinstance(node.op, ast.USub) else 1
+                def signed(chunk):
+                    value, error = function(chunk)
+                    return sign*value, error
+                return 'num', signed
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self.arithmetic:
+            left_kind, left = self.vectorize(node.left)
+            right_kind, right = self.vectorize(node.right)
+            if left_kind == right_kind == 'num':
+                operator = self.arithmetic[type(node.op)]
+                dividing = isinstance(node.op, (ast.Div,ast.FloorDiv,ast.Mod))
+                def arithmetic(chunk):
+                    left_value, left_error = left(chunk)
+                    right_value, right_error = right(chunk)
+                    error = self.either(left_error, right_error)
+                    if dividing:
+                        error = self.either(error, 
+                            numpy.asarray(right_value) == 0)
+                    return operator(left_value, right_value), error
+                return 'num', arithmetic
+
+        if isinstance(node, ast.Compare) and \
+                all( type(i) in self.comparisons for i in node.ops ):
+            return 'bool', self.vectorize_compare(node)
+
+        if isinstance(node, ast.BoolOp):
+            parts = [ self.vectorize(i) for i in node.values ]
+            if isinstance(node.op, ast.And):
+                return 'bool', lambda chunk: self.and_of(parts, chunk)
+            return 'bool', lambda chunk: self.or_of(parts, chunk)
+
+        raise _NotVectorizable(ast.dump(node))
+
+    def vectorize_call(self, node):
+        """Vectorizes a call of one of the quality or sequence functions, 
+        or of `statistics.mean` or `.median` of a group's `.quality`.
+        """
+        numpy = self.numpy
+        function = node.func
+        arguments = node.args
+        if isinstance(function, ast.Attribute) and \
+                isinstance(function.value, ast.Name) and \
+                function.value.id == 'statistics' and \
+                function.attr in ('mean','median') and \
+                'statistics' not in self.group_names+self.match_ids and \
+                len(arguments) == 1 and \
+                isinstance(arguments[0], ast.Attribute) and \
+                arguments[0].attr == 'quality':
+            name = function.attr+'_quality'
+            arguments = [ arguments[0].value ]
+        elif isinstance(function, ast.Name) and \
+                function.id not in self.group_names+self.match_ids:
+            name = function.id
+        else:
+            raise _NotVectorizable(ast.dump(node))
+        if not ( arguments and isinstance(arguments[0], ast.Name) and
+                arguments[0].id in self.group_names ):
+            raise _NotVectorizable(ast.dump(node))
+        group = arguments[0].id
+        extra = []
+        for each in arguments[1:]:
+            if not ( isinstance(each, ast.Constant) and 
+                    type(each.value) in (int, float) ):
+                raise _NotVectorizable(ast.dump(node))
+            extra.append(each.value)
+
+        if name == 'mean_quality' and not extra:
+            def mean(chunk):
+                present, _, _, group_starts, group_ends = chunk.group(group)
+                sums, read_starts, read_ends = chunk.quality_sums()
+                # Like slicing, this can't go past the end of the qualities
+                starts = numpy.minimum(read_starts+group_starts, read_ends)
+                ends = numpy.minimum(read_starts+group_ends, read_ends)
+                lengths = ends - starts
+                here = present & (lengths > 0) & (group_starts >= 0)
+                starts = numpy.where(here, starts, 0)
+                ends = numpy.where(here, ends, 0)
+                lengths = numpy.where(here, lengths, 1)
+                return ( (sums[ends]-sums[starts]-33*lengths)/lengths, ~here )
+            return 'num', mean
+
+        if name == 'fraction_below' and len(extra) == 1:
+            which, read_function = 'quality', \
+                lambda letters: fraction_below(letters, *extra)
+        elif name in self.read_functions and not extra:
+            which, read_function = self.read_functions[name]
+        else:
+            raise _NotVectorizable(ast.dump(node))
+
+        def per_read(chunk):
+            present = chunk.group(group)[0]
+            values = numpy.zeros(chunk.n)
+            error = ~present
+            strings = chunk.strings(group, which)
+            for i in numpy.flatnonzero(present).tolist():
+                try:
+                    values[i] = read_function(strings[i])
+                except Exception:
+                    error[i] = True
+            return values, error
+        return 'num', per_read
+
+    def vectorize_compare(self, node):
+        """Vectorizes a comparison, which might be chained like 
+        `10 < barcode.length <= 20`.
+        """
+        parts = [ self.vectorize(i) for i in [node.left]+node.comparators ]
+        # Numbers compare with numbers, and sequences can be checked for 
+        # being equal (a group is equal to its sequence), but a GroupStats
+        # can't be ordered
+        numeric = [ i[0] in ('num','bool') for i in parts ]
+        for ( left_kind, _ ), op, ( right_kind, _ ) in \
+                zip(parts, node.ops, parts[1:]):
+            if not ( isinstance(op, (ast.Eq, ast.NotEq)) or 
+                    ( left_kind in ('num','bool') and 
+                        right_kind in ('num','bool') ) or 
+                    left_kind == right_kind == 'str' ):
+                raise _NotVectorizable(ast.dump(node))
+        operators = [ self.comparisons[type(i)] for i in node.ops ]
+
+        def compare(chunk):
+            numpy = self.numpy
+            left_value, error = parts[0][1](chunk)
+            error = self.full(False if error is None else error, chunk.n)
+            result = numpy.ones(chunk.n, dtype=bool)
+            for index, operator in enumerate(operators):
+                # Like python, the next part of a chain is only tried if the
+                # last comparison was true
+                going = result & ~error
+                right_value, right_error = parts[index+1][1](chunk)
+                if right_error is not None:
+                    error |= going & right_error
+                if numeric[index] != numeric[index+1]:
+                    # A sequence is never equal to a number
+                    compared = isinstance(node.ops[index], ast.NotEq)
+                else:
+                    compared = operator(left_value, right_value)
+                result &= self.full(compared, chunk.n)
+                left_value = right_value
+            return result & ~error, error
+        return compare
+
+    def full(self, value, n):
+        """Makes a value (an array, or just one value) into an array of `n`
+        booleans.
+        """
+        return self.numpy.broadcast_to( 
+            self.numpy.asarray(value, dtype=bool), (n,) ).copy()
+
+    def truth(self, kind, value, n):
+        """Whether each value is true, like python's `bool` would say. A 
+        GroupStats is always true, even if the sequence is empty."""
+        if kind == 'group':
+            return self.numpy.ones(n, dtype=bool)
+        if kind == 'str':
+            return self.full(bool(value), n)
+        return self.full(value, n)
+
+    @staticmethod
+    def either(first, second):
+        """The union of two error masks, either of which can be None."""
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return first | second
+
+    def not_of(self, kind, function, chunk):
+        value, error = function(chunk)
+        return ~self.truth(kind, value, chunk.n), error
+
+    def and_of(self, parts, chunk):
+        """Like python's `and`, this stops at the first part that's false
+        (or raises) for each read.
+        """
+        result = self.numpy.ones(chunk.n, dtype=bool)
+        error = self.numpy.zeros(chunk.n, dtype=bool)
+        for kind, function in parts:
+            value, part_error = function(chunk)
+            truth = self.truth(kind, value, chunk.n)
+            if part_error is not None:
+                error |= result & part_error
+                truth &= ~part_error
+            result &= truth
+        return result, error
+
+    def or_of(self, parts, chunk):
+        """Like python's `or`, this stops at the first part that's true 
+        (or raises) for each read.
+        """
+        result = self.numpy.zeros(chunk.n, dtype=bool)
+        error = self.numpy.zeros(chunk.n, dtype=bool)
+        for kind, function in parts:
+            going = ~result & ~error
+            value, part_error = function(chunk)
+            truth = self.truth(kind, value, chunk.n)
+            if part_error is not None:
+                error |= going & part_error
+                truth &= ~part_error
+            result |= going & truth
+        return result, error
+
+    def match_chunk(self, chunk):
+        """Applies each match that's needed across the whole chunk, filling
+        in the arrays of `chunk`.
+
+        :param chunk: the chunk of reads
+        :type chunk: itermae.BatchChopper._BatchChunk
+        """
+        numpy = self.numpy
+        configuration = self.configuration
+        match_cache = configuration.match_cache
+        run_stats = configuration.run_stats
+        n = chunk.n
+        for index in self.matches:
+            if run_stats is not None:
+                start = time.perf_counter()
+            operation = configuration.matches_array[index]
+            match_id = 'match_'+str(index)
+            compiled = operation['regex']
+            prefilter = operation.get('prefilter')
+            names = list(compiled.groupindex)
+            matched = [False]*n
+            scores = [ [-1]*n, [-1]*n, [-1]*n ]
+            spans = { name: ( [0]*n, [0]*n ) for name in names }
+            present, _, _, input_starts, input_ends = \
+                chunk.group(operation['input'])
+            input_starts = input_starts.tolist()
+            input_ends = input_ends.tolist()
+            reads = chunk.reads
+            for i in numpy.flatnonzero(present).tolist():
+                # Note that the input is made uppercase!
+                input_seq = reads[i].seq[input_starts[i]:input_ends[i]].upper()
+                if prefilter is not None and \
+                        not prefilter.could_match(input_seq):
+                    continue
+                if match_cache is None:
+                    result = MatchCache.MISSING
+                else:
+                    result = match_cache.get(match_id, input_seq)
+                if result is MatchCache.MISSING:
+                    fuzzy_match = compiled.search(input_seq)
+                    if fuzzy_match is None:
+                        result = None
+                    else:
+                        result = ( fuzzy_match.fuzzy_counts, 
+                            [ ( match_name, fuzzy_match.span(match_name) ) 
+                                for match_name in fuzzy_match.groupdict() ] )
+                    if match_cache is not None:
+                        match_cache.put(match_id, input_seq, result)
+                if result is None:
+                    continue
+                matched[i] = True
+                scores[0][i], scores[1][i], scores[2][i] = result[0]
+                for name, ( group_start, group_end ) in result[1]:
+                    spans[name][0][i] = group_start
+                    spans[name][1][i] = group_end
+
+            matched_array = numpy.array(matched, dtype=bool)
+            chunk.scores[match_id] = ( matched_array, 
+                *[ numpy.array(i, dtype=numpy.int64) for i in scores ] )
+            group_lists = {}
+            for name in names:
+                starts = numpy.array(spans[name][0], dtype=numpy.int64)
+                ends = numpy.array(spans[name][1], dtype=numpy.int64)
+                base = chunk.groups[operation['input']][3] \
+                    if operation['input'] in chunk.groups else 0
+                group = ( matched_array, starts, ends, base+starts, base+ends )
+                if name in chunk.groups:
+                    # A group made again is only replaced where it matched
+                    group = ( matched_array | chunk.groups[name][0], *[ 
+                        numpy.where(matched_array, new, old) for new, old in 
+                            zip(group[1:], chunk.groups[name][1:]) ] )
+                    chunk.group_seqs.pop(name, None)
+                    chunk.group_qualities.pop(name, None)
+                chunk.groups[name] = group
+                group_lists[name] = ( spans[name][0], spans[name][1], 
+                    (base+starts).tolist(), (base+ends).tolist() )
+            chunk.match_data[index] = ( match_id, matched, scores, 
+                group_lists )
+
+            if run_stats is not None:
+                passed = int(matched_array.sum())
+                run_stats.count_many(('match',match_id), passed, n-passed)
+                run_stats.add_time(('match',match_id),
+                    time.perf_counter()-start)
+
+    def fill_holder(self, chunk, i):
+        """Fills in the reused `SeqHolder` for read `i` of the chunk from the
+        arrays, as if it had applied the matches itself. Groups that no 
+        output uses are left out.
+
+        :return: the holder
+        :rtype: itermae.SeqHolder
+        """
+        read = chunk.reads[i]
+        if self.holder is None:
+            self.holder = SeqHolder(read, configuration=self.configuration)
+        holder = self.holder.reset(read)
+        holder.matches_applied = set(self.matches)
+        for index in self.matches:
+            match_id, matched, scores, group_lists = chunk.match_data[index]
+            if not matched[i]:
+                holder.match_scores[match_id] = MatchScores(None,None,None)
+                continue
+            holder.match_scores[match_id] = MatchScores( 
+                scores[0][i], scores[1][i], scores[2][i] )
+            for name, ( starts, ends, read_starts, read_ends ) in \
+                    group_lists.items():
+                if name not in self.used_names:
+                    continue
+                span = ReadSpan(read, read_starts[i], read_ends[i])
+                holder.seqs[name] = span
+                holder.group_stats[name] = GroupStats(starts[i], ends[i], 
+                    seq=span)
+        return holder
+
+    def chop_chunk(self, reads):
+        """Matches, filters, builds, and writes the outputs of a chunk of 
+        reads.
+
+        :param reads: the chunk of input ReadRecords
+        :type reads: list of itermae.ReadRecord
+        """
+        numpy = self.numpy
+        configuration = self.configuration
+        run_stats = configuration.run_stats
+        outputs_array = configuration.outputs_array
+
+        # If qualities are missing, add them as just 40
+        for read in reads:
+            if read.quality is None:
+                read.quality = 'I'*len(read.seq)
+
+        chunk = _BatchChunk(reads, numpy)
+        self.match_chunk(chunk)
+
+        # Filters that can be, are done over the whole chunk at once
+        masks = []
+        for each_output, function in zip(outputs_array, self.filters):
+            if run_stats is not None:
+                start = time.perf_counter()
+            possible = numpy.ones(chunk.n, dtype=bool)
+            for name in each_output.get('required_groups',[]):
+                possible &= chunk.group(name)[0]
+            if function is None:
+                masks.append(possible)
+                continue
+            kind, function = function
+            with numpy.errstate(all='ignore'):
+                value, error = function(chunk)
+            passed = self.truth(kind, value, chunk.n) & possible
+            if error is not None:
+                passed &= ~error
+            masks.append(passed)
+            if run_stats is not None:
+                run_stats.add_time(('filter',each_output['name']),
+                    time.perf_counter()-start)
+                count = int(passed.sum())
+                run_stats.count_many(('filter',each_output['name']),
+                    count, chunk.n-count)
+        masks = [ i.tolist() for i in masks ]
+
+        # Then the outputs are built and formatted, read by read, and when
+        # demultiplexing they're kept separate for each read's sample
+        output_texts = []
+        failed_texts = []
+        sample_index = configuration.sample_index
+        if sample_index is not None:
+            sample_texts = {}
+            index_seqs = chunk.strings(configuration.demultiplex_group)
+            index_present = chunk.group(configuration.demultiplex_group
+                )[0].tolist()
+        output_format = configuration.output_writer.format
+        counting = isinstance(configuration.output_writer, CountWriter)
+        failed_writer = configuration.failed_writer
+        collapsed = configuration.collapse == 'reads'
+        for i, read in enumerate(reads):
+            holder = None
+            read_count = collapsed_read_count(read.id) if collapsed else 1
+            if sample_index is not None:
+                output_texts = sample_texts.setdefault( sample_index.assign(
+                    index_seqs[i] if index_present[i] else None, read_count ),
+                    [] )
+            for each_output, function, mask in \
+                    zip(outputs_array, self.filters, masks):
+                passed = mask[i]
+                if function is None and passed:
+                    if run_stats is not None:
+                        start = time.perf_counter()
+                    holder = holder or self.fill_holder(chunk, i)
+                    passed = bool(holder.evaluate_filter_of_output(each_output))
+                    if run_stats is not None:
+                        run_stats.add_time(('filter',each_output['name']),
+                            time.perf_counter()-start)
+                if function is None and run_stats is not None:
+                    run_stats.count(('filter',each_output['name']), passed)
+                output_seq = None
+                if passed:
+                    if run_stats is not None:
+                        start = time.perf_counter()
+                    holder = holder or self.fill_holder(chunk, i)
+                    output_seq = holder.build_output(each_output)
+                    if run_stats is not None:
+                        run_stats.add_time(('build',each_output['name']),
+                            time.perf_counter()-start)
+                        run_stats.count(('build',each_output['name']),
+                            output_seq is not None)
+                if output_seq is not None:
+                    if counting:
+                        configuration.output_writer.write_record(output_seq,
+                            each_output['name'], read_count)
+                    else:
+                        output_texts.append( format_record(output_seq, 
+                            output_format, each_output['name']) )
+                elif failed_writer is not None:
+                    failed_texts.append( format_record(read, 
+                        failed_writer.format, each_output['name']) )
+
+        # And each output's chunk is written in one go
+        if run_stats is not None:
+            run_stats.count_read(chunk.n)
+            start = time.perf_counter()
+        if sample_index is not None:
+            configuration.output_writer.write({ sample: "".join(texts) 
+                for sample, texts in sample_texts.items() })
+        elif output_texts:
+            configuration.output_writer.write("".join(output_texts))
+        if failed_texts:
+            failed_writer.write("".join(failed_texts))
+        if run_stats is not None:
+            run_stats.add_time(('write','output'), time.perf_counter()-start)
+
+    def chop_records(self, records):
+        """Chops the input records, `batch_size` at a time.
+
+        :param records: an iterable of input ReadRecords
+        :type records: iterable of itermae.ReadRecord
+        """
+        records = iter(records)
+        while True:
+            reads = list(itertools.islice(records, 
+                self.configuration.batch_size))
+            if not reads:
+                break
+            self.chop_chunk(reads)
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""Benchmarks for itermae, with a synthetic read generator.
+
+There's two sub-commands. ``generate`` writes a FASTQ of synthetic reads,
+like the BarSeq amplicons in ``itermae/data/tests/test_inputs``, or a version
+of those with no repeated sequences (so every read has a new UMI and
+barcode), or long PacBio-ish reads like ``pacbio_small_test.fastq``. These are
+made from a seeded random generator, so the same seed and number of reads
+always gives the same file::
+
+    python3 profiling_tests/benchmark.py generate --kind barseq \\
+        --reads 1000000 --output barseq_1M.fastq
+
+``run`` times each stage of chopping (parsing, matching, filtering and
+building outputs, and writing in each format) and then the whole thing, for
+the same configurations as the test matrix in ``tests/test_itermae.py``, plus
+the PacBio example. Each benchmark is run in a fresh process, so that the
+peak memory (RSS) of each is measured on its own. Results are printed as
+JSON, and can be saved as a baseline or compared to one::
+
+    python3 profiling_tests/benchmark.py run --save-baseline
+    python3 profiling_tests/benchmark.py run --compare
+
+Comparing exits with status 1 if any benchmark is slower, or uses more
+memory, than the baseline by more than the tolerance. The baseline is only
+meaningful on the machine that made it, so it isn't kept in the repository
+(it's ignored by git). Make one first (with ``make benchmark-baseline``)
+before working on something.
+"""
+
+import argparse
+import concurrent.futures
+import gc
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import itermae
+
+here = pathlib.Path(__file__).resolve().parent
+default_baseline = here / 'benchmark_baseline.json'
+
+#### Synthetic reads
+
+bases = 'ACGT'
+
+barseq_up_prime = 'GTCCTCGAGGTCTCT'
+barseq_down_prime = 'CGTACGCTG'
+barseq_pre_umi = 'CAGGTCGAC'
+barseq_umi = 'NGNANGNGNGN'
+barseq_tail = 'GATGTG'
+barseq_read_length = 75
+
+pacbio_primer = 'TAGTTTTAAAACACCAGAACTTAGTTTCGA'
+pacbio_pre_orf = 'AAAGTTGGCACC'
+pacbio_post_orf = 'TGCCAACTTTCTTGTA'
+pacbio_pre_barcode = 'ACTATACGAACGGTA'
+pacbio_post_barcode = 'TGAGACATATCAGAT'
+
+def random_seq(rng, length):
+    return ''.join(rng.choices(bases, k=length))
+
+def fill_ns(rng, pattern):
+    return ''.join( rng.choice(bases) if i == 'N' else i for i in pattern )
+
+def add_errors(rng, seq, rate):
+    """Puts substitutions, insertions, and deletions into a sequence, at
+    about `rate` per base. The distance between errors is drawn from an
+    exponential, instead of a coin-flip per base, because that's a lot
+    faster for long reads and low rates.
+
+    :param rng: the random number generator to use
+    :type rng: random.Random
+    :param seq: sequence to mess up
+    :type seq: str
+    :param rate: errors per base
+    :type rate: float
+    :return: the messed up sequence
+    :rtype: str
+    """
+    if rate <= 0:
+        return seq
+    pieces = []
+    last = 0
+    position = int(rng.expovariate(rate))
+    while position < len(seq):
+        pieces.append(seq[last:position])
+        kind = rng.random()
+        if kind < 0.8: # substitution
+            pieces.append(rng.choice(bases.replace(seq[position],'')))
+            last = position+1
+        elif kind < 0.9: # insertion
+            pieces.append(rng.choice(bases))
+            last = position
+        else: # deletion
+            last = position+1
+        position += 1+int(rng.expovariate(rate))
+    pieces.append(seq[last:])
+    return ''.join(pieces)
+
+class QualityMaker:
+    """Makes quality strings by slicing from one long random string, since
+    making a new random string for each read is slow.
+
+    :param rng: the random number generator to use
+    :type rng: random.Random
+    :param letters: quality letters to draw from
+    :type letters: str
+    :param weights: how often to draw each letter
+    :type weights: list of float
+    """
+    def __init__(self, rng, letters, weights, pool_length=1000003):
+        self.rng = rng
+        self.pool = ''.join(rng.choices(letters, weights=weights,
+            k=pool_length))
+    def __call__(self, length):
+        start = self.rng.randrange(len(self.pool)-length)
+        return self.pool[start:start+length]
+
+def barseq_reads(rng, reads, library_size=20000, unique=False,
+        error_rate=0.004):
+    """Generates BarSeq amplicon reads like those in the tests, as a
+    sample index, the upstream primer, a barcode of 18-22 bases, the
+    downstream primer, then an interspersed UMI. Reads are cut to 75 bases,
+    like the real ones. Barcodes are drawn from a library where a few are
+    very common, like a real pool, and a few percent of reads are primer
+    dimers or junk that shouldn't match.
+
+    :param rng: the random number generator to use
+    :type rng: random.Random
+    :param reads: how many reads
+    :type reads: int
+    :param library_size: how many different barcodes
+    :type library_size: int
+    :param unique: if True, every read gets a new barcode and UMI, so that
+        there's no repeated sequences (that caches or collapsing can use)
+    :type unique: bool
+    :param error_rate: sequencing errors per base
+    :type error_rate: float
+    :return: generator of (id, description, seq, quality) tuples
+    :rtype: generator
+    """
+    # the first few are from the real reads, the tests filter on 'GCTTC'
+    sample_indices = ['TTCAC','GCTTC','CTACT','TAAGT'] + \
+        [ random_seq(rng, 5) for i in range(20) ]
+    library = [ random_seq(rng, rng.randint(18,22))
+        for i in range(library_size) ]
+    library_weights = list(itertools.accumulate(
+        1/(i+1) for i in range(library_size) ))
+    umis = [ fill_ns(rng, barseq_umi) for i in range(64) ]
+    quality = QualityMaker(rng, 'EEA/<6', [90,6,2,1,0.5,0.5])
+    for i in range(reads):
+        sample_index = rng.choice(sample_indices)
+        junk = rng.random()
+        if junk < 0.02: # primer dimer
+            seq = sample_index+barseq_up_prime+barseq_down_prime+ \
+                barseq_pre_umi+fill_ns(rng, barseq_umi)+barseq_tail+ \
+                random_seq(rng, 20)
+        elif junk < 0.03: # something else entirely
+            seq = random_seq(rng, barseq_read_length)
+        else:
+            if unique:
+                barcode = random_seq(rng, rng.randint(18,22))
+                umi = fill_ns(rng, barseq_umi)
+            else:
+                barcode = rng.choices(library, cum_weights=library_weights)[0]
+                umi = rng.choice(umis)
+            seq = sample_index+barseq_up_prime+barcode+barseq_down_prime+ \
+                barseq_pre_umi+umi+barseq_tail
+        seq = add_errors(rng, seq, error_rate)[:barseq_read_length]
+        yield ( 'SYNTH:barseq:'+str(i+1), '1:N:0:', seq,
+            'AAAAA'+quality(len(seq)-5) )
+
+def pacbio_reads(rng, reads, library_size=2000, error_rate=0.01):
+    """Generates long reads like the PacBio example, of a primer, then an ORF
+    (from a library of these) flanked by fixed sequences, then a 20-40 base
+    barcode flanked by fixed sequences, with random sequence on either end.
+    About a tenth of reads are missing a piece.
+
+    :param rng: the random number generator to use
+    :type rng: random.Random
+    :param reads: how many reads
+    :type reads: int
+    :param library_size: how many different ORFs
+    :type library_size: int
+    :param error_rate: sequencing errors per base
+    :type error_rate: float
+    :return: generator of (id, description, seq, quality) tuples
+    :rtype: generator
+    """
+    orfs = [ 'ATG'+random_seq(rng, 3*rng.randint(150,500))
+        for i in range(library_size) ]
+    quality = QualityMaker(rng, 'KJIHGFE@;5-',
+        [30,20,15,10,8,6,4,3,2,1,1])
+    for i in range(reads):
+        pieces = [ random_seq(rng, rng.randint(100,400)), pacbio_primer,
+            pacbio_pre_orf, rng.choice(orfs), pacbio_post_orf,
+            pacbio_pre_barcode, random_seq(rng, rng.randint(20,40)),
+            pacbio_post_barcode, random_seq(rng, rng.randint(100,400)) ]
+        if rng.random() < 0.1:
+            del pieces[rng.randrange(1,len(pieces)-1)]
+        seq = add_errors(rng, ''.join(pieces), error_rate)
+        yield ( 'SYNTH:pacbio:'+str(i+1), 'np:i:3', seq, quality(len(seq)) )
+
+read_kinds = {
+    'barseq': lambda rng, reads: barseq_reads(rng, reads),
+    'umi': lambda rng, reads: barseq_reads(rng, reads, unique=True),
+    'pacbio': lambda rng, reads: pacbio_reads(rng, reads),
+    }
+
+# PacBio reads are about thirty times longer and much slower to chop, so
+# there's fewer of them for the same `--reads`
+read_kind_scale = { 'barseq': 1, 'umi': 1, 'pacbio': 1/20 }
+
+def generate(kind, reads, seed, fh):
+    """Writes `reads` synthetic reads of `kind` as FASTQ to `fh`.
+
+    :param kind: a key of `read_kinds`
+    :type kind: str
+    :param reads: how many reads
+    :type reads: int
+    :param seed: seed for the random number generator
+    :type seed: int
+    :param fh: where to write to
+    :type fh: file handle
+    """
+    rng = random.Random(str(seed)+kind)
+    buffer = []
+    for read_id, description, seq, quality in read_kinds[kind](rng, reads):
+        buffer.append('@'+read_id+' '+description+'\n'+seq+'\n+\n'+
+            quality+'\n')
+        if len(buffer) >= 10000:
+            fh.write(''.join(buffer))
+            buffer = []
+    fh.write(''.join(buffer))
+
+def generated_file(data_dir, kind, reads, seed):
+    """Generates a file of reads, unless it's already there from last time.
+
+    :return: path to the FASTQ file
+    :rtype: pathlib.Path
+    """
+    path = pathlib.Path(data_dir) / (kind+'_'+str(reads)+'_'+str(seed)+
+        '.fastq')
+    if not path.exists():
+        partial = path.with_suffix('.partial')
+        with open(partial, 'w') as f:
+            generate(kind, reads, seed, f)
+        partial.rename(path)
+    return path
+
+#### Configurations
+
+def load_test_matrix():
+    """Loads the `match_yaml_blocks` and `output_yaml_blocks` from the tests,
+    so the benchmarks stay the same as what's tested.
+    """
+    spec = importlib.util.spec_from_file_location('test_itermae',
+        here.parent / 'tests' / 'test_itermae.py')
+    test_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(test_module)
+    return test_module.match_yaml_blocks, test_module.output_yaml_blocks
+
+pacbio_yaml = """matches:
+    -   use: input
+        pattern: TAGTTTTAAAACACCAGAACTTAGTTTCGA+
+        marking: AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAB
+        marked_groups:
+            A:
+                allowed_errors: 5
+            B:
+                name: postprimer
+    -   use: postprimer
+        pattern: AAAGTTGGCACCATG+TGCCAACTTTCTTGTA+
+        marking: AAAAAAAAAAAABBBBCCCCCCCCCCCCCCCCD
+        marked_groups:
+            A:
+                allowed_errors: 3
+            B:
+                name: orf
+            C:
+                allowed_errors: 3
+            D:
+                name: rest
+    -   use: rest
+        pattern: ACTATACGAACGGTANTGAGACATATCAGAT
+        marking: AAAAAAAAAAAAAAABCCCCCCCCCCCCCCC
+        marked_groups:
+            A:
+                allowed_errors: 3
+            B:
+                name: barcode
+                repeat_min: 20
+                repeat_max: 40
+            C:
+                allowed_errors: 3
+output_list:
+    -   name: orf_with_barcode
+        filter: 'orf.length >= 3'
+        id: id+"_barcode="+barcode
+        seq: orf
+"""
+
+def benchmark_configs():
+    """The configurations to benchmark, as a dict of name to the kind of
+    reads and the YAML for the matches and outputs. The 'matrix' ones are
+    every pairing of the match and output blocks of the test matrix, named
+    like 'matrix_12' for the second match block and third output block.
+    """
+    match_yaml_blocks, output_yaml_blocks = load_test_matrix()
+    configs = {}
+    for i, j in itertools.product(range(len(match_yaml_blocks)),
+            range(len(output_yaml_blocks))):
+        configs['matrix_'+str(i)+str(j)] = ( 'barseq',
+            match_yaml_blocks[i]+"\n"+output_yaml_blocks[j] )
+    last = len(match_yaml_blocks)-1
+    configs['matrix_'+str(last)+str(last)+'_unique'] = ( 'umi',
+        match_yaml_blocks[last]+"\n"+output_yaml_blocks[last] )
+    configs['pacbio'] = ( 'pacbio', pacbio_yaml )
+    return configs
+
+output_formats = ['sam','fastq','fasta','txt']
+
+def configure(config_yaml, input_path, output_format='sam',
+        output_to=os.devnull):
+    """Makes an `itermae.Configuration` from YAML, like the command-line
+    does, but with the input and output set.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = pathlib.Path(tmp) / 'config.yml'
+        config_file.write_text(
+            'input_from: '+str(input_path)+'\n'+
+            'input_format: fastq\n'+
+            'output_to: '+output_to+'\n'+
+            'output_format: '+output_format+'\n'+
+            config_yaml )
+        configuration = itermae.Configuration()
+        configuration.config_from_file(str(config_file))
+    return configuration
+
+#### Benchmarks, each run in its own process
+
+def read_records(input_path):
+    with open(input_path) as f:
+        return list(itermae.read_fastq_file(f))
+
+def matched_holders(configuration, records):
+    return [ itermae.SeqHolder(i, configuration=configuration).apply_matches()
+        for i in records ]
+
+def built_outputs(configuration, holders):
+    built = []
+    for holder in holders:
+        for each_output in configuration.outputs_array:
+            if any( i not in holder.seqs
+                    for i in each_output.get('required_groups',[]) ):
+                continue
+            if not holder.evaluate_filter_of_output(each_output):
+                continue
+            if any( i not in holder.seqs
+                    for i in each_output.get('build_groups',[]) ):
+                continue
+            built.append( ( holder.build_output(each_output),
+                each_output['name'] ) )
+    return built
+
+def peak_rss_mb():
+    """Peak RSS of this process, in megabytes. On Linux this is read from
+    `/proc`, because `ru_maxrss` carries over the parent's peak through the
+    `exec` of a spawned process.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # that's in bytes, elsewhere it's kilobytes
+        peak_rss /= 1024
+    return peak_rss/1024
+
+def run_benchmark(stage, config_yaml, input_path, output_format, repeat,
+        min_seconds=0.2):
+    """Runs one benchmark, and returns the best time of `repeat` tries, with
+    the peak RSS of this process. Each try runs the stage at least once, and
+    for at least `min_seconds`. Everything a stage needs is set up before
+    the timing starts, so that only that stage is timed. Stages are:
+
+    - 'parse' reads the FASTQ into records
+    - 'match' makes a `SeqHolder` of each read and applies all the matches
+    - 'outputs' evaluates the filter of each output, and builds it if passed
+    - 'write' writes the built outputs in `output_format`
+    - 'end_to_end' runs `Configuration.reader`, like the command-line does
+
+    :return: seconds, reads per second, and peak RSS in megabytes
+    :rtype: dict
+    """
+    reads = sum( 1 for i in open(input_path) ) // 4
+    if stage in ('match','outputs','write'):
+        configuration = configure(config_yaml, input_path)
+        records = read_records(input_path)
+    if stage in ('outputs','write'):
+        holders = matched_holders(configuration, records)
+    if stage == 'write':
+        built = built_outputs(configuration, holders)
+
+    def once():
+        if stage == 'end_to_end':
+            fresh = configure(config_yaml, input_path, output_format)
+        else: # like `timeit`, so collections of earlier garbage don't count
+            gc.collect()
+            gc.disable()
+        start = time.perf_counter()
+        if stage == 'parse':
+            read_records(input_path)
+        elif stage == 'match':
+            matched_holders(configuration, records)
+        elif stage == 'outputs':
+            built_outputs(configuration, holders)
+        elif stage == 'write':
+            with open(os.devnull, 'w') as f:
+                writer = itermae.OutputWriter(f, output_format)
+                for record, name in built:
+                    writer.write_record(record, name)
+                writer.flush()
+        elif stage == 'end_to_end':
+            fresh.reader()
+        seconds = time.perf_counter()-start
+        gc.enable()
+        return seconds
+
+    # Quick stages are run over and over, until they've taken at least
+    # `min_seconds`, so that timer noise doesn't swamp them
+    times = []
+    for i in range(repeat):
+        total = 0
+        loops = 0
+        while total < min_seconds:
+            total += once()
+            loops += 1
+        times.append(total/loops)
+    peak_rss = peak_rss_mb()
+    seconds = min(times)
+    return { 'seconds': round(seconds, 4),
+        'reads_per_second': round(reads/seconds, 1),
+        'peak_rss_mb': round(peak_rss, 1) }
+
+def planned_benchmarks(configs, selected=None):
+    """Lists what to run, as (name, stage, config name, output format).
+    """
+    planned = []
+    for kind in sorted(set( i[0] for i in configs.values() )):
+        config_name = [ i for i, j in configs.items() if j[0] == kind ][0]
+        planned.append( ( 'parse/'+kind, 'parse', config_name, None ) )
+    for config_name in configs:
+        planned.append( ( 'match/'+config_name, 'match', config_name, None ) )
+        planned.append( ( 'outputs/'+config_name, 'outputs', config_name,
+            None ) )
+        for output_format in output_formats:
+            planned.append( ( 'write/'+config_name+'/'+output_format,
+                'write', config_name, output_format ) )
+        for output_format in output_formats:
+            planned.append( ( 'end_to_end/'+config_name+'/'+output_format,
+                'end_to_end', config_name, output_format ) )
+    if selected:
+        planned = [ i for i in planned
+            if any( j in i[0] for j in selected ) ]
+    return planned
+
+def run_all(args):
+    configs = benchmark_configs()
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='itermae_benchmark_')
+    os.makedirs(data_dir, exist_ok=True)
+    results = { 'reads': args.reads, 'seed': args.seed,
+        'repeat': args.repeat, 'benchmarks': {} }
+    spawn = multiprocessing.get_context('spawn')
+    for name, stage, config_name, output_format in \
+            planned_benchmarks(configs, args.only):
+        kind, config_yaml = configs[config_name]
+        input_path = generated_file(data_dir, kind,
+            max(1, int(args.reads*read_kind_scale[kind])), args.seed)
+        # A new process each time, so the peak RSS is just this benchmark's
+        with concurrent.futures.ProcessPoolExecutor(1,
+                mp_context=spawn) as pool:
+            result = pool.submit(run_benchmark, stage, config_yaml,
+                str(input_path), output_format, args.repeat).result()
+        results['benchmarks'][name] = result
+        print(name.ljust(36)+str(result['reads_per_second']).rjust(12)+
+            ' reads/s'+str(result['peak_rss_mb']).rjust(10)+' MB',
+            file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    """Compares results to a baseline, and returns a list of what's worse
+    by more than the tolerances (as fractions).
+    """
+    regressions = []
+    if baseline.get('reads') != results['reads']:
+        print("Baseline was run with "+str(baseline.get('reads'))+
+            " reads, but this was "+str(results['reads'])+
+            ", so the comparison is rough.", file=sys.stderr)
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        if result['reads_per_second'] < \
+                before['reads_per_second']*(1-tolerance):
+            regressions.append(name+" is slower: "+
+                str(result['reads_per_second'])+" reads/s, was "+
+                str(before['reads_per_second']))
+        if result['peak_rss_mb'] > before['peak_rss_mb']*(1+memory_tolerance):
+            regressions.append(name+" uses more memory: "+
+                str(result['peak_rss_mb'])+" MB, was "+
+                str(before['peak_rss_mb']))
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for itermae, with synthetic reads.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_generate = subparsers.add_parser('generate',
+        help="Write synthetic reads as FASTQ.")
+    parser_generate.add_argument('--kind', choices=sorted(read_kinds),
+        default='barseq')
+    parser_generate.add_argument('--reads', type=int, default=10000)
+    parser_generate.add_argument('--seed', type=int, default=1)
+    parser_generate.add_argument('-o','--output', default='STDOUT',
+        help="File to write to, default is 'STDOUT'.")
+
+    parser_run = subparsers.add_parser('run', help="Run the benchmarks.")
+    parser_run.add_argument('--reads', type=int, default=10000,
+        help="How many reads of each kind to benchmark with.")
+    parser_run.add_argument('--seed', type=int, default=1)
+    parser_run.add_argument('--repeat', type=int, default=3,
+        help="Take the fastest of this many tries of each.")
+    parser_run.add_argument('--only', action='append',
+        help="Only run benchmarks with this in the name, like 'match'.")
+    parser_run.add_argument('--data-dir',
+        help="Where to keep generated reads, to re-use them next time. "
+            "Default is a new temporary directory.")
+    parser_run.add_argument('--output',
+        help="Write the JSON results to this file, instead of STDOUT.")
+    parser_run.add_argument('--save-baseline', action='store_true',
+        help="Save the results as the baseline.")
+    parser_run.add_argument('--compare', action='store_true',
+        help="Compare to the baseline, exit with status 1 if worse.")
+    parser_run.add_argument('--baseline', default=str(default_baseline))
+    parser_run.add_argument('--tolerance', type=float, default=0.25,
+        help="How much slower than the baseline is allowed, as a fraction.")
+    parser_run.add_argument('--memory-tolerance', type=float, default=0.2,
+        help="How much more memory than the baseline is allowed.")
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        if args.output.upper() == 'STDOUT':
+            generate(args.kind, args.reads, args.seed, sys.stdout)
+        else:
+            with open(args.output, 'w') as f:
+                generate(args.kind, args.reads, args.seed, f)
+        sys.exit(0)
+
+    if args.compare and not os.path.exists(args.baseline):
+        print("There's no baseline at "+args.baseline+", so make one "
+            "first on this machine with `make benchmark-baseline`.",
+            file=sys.stderr)
+        sys.exit(2)
+
+    results = run_all(args)
+    results_json = json.dumps(results, indent=2)+'\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results_json)
+    else:
+        print(results_json, end='')
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(results_json)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance,
+            args.memory_tolerance)
+        for i in regressions:
+            print("REGRESSION: "+i, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against "+args.baseline, file=sys.stderr)
@@ -13,8 +13,19 @@ from Bio import SeqIO, Seq, SeqRecord
 import itertools
 # Required for full-file input/output testing
 import subprocess
+# For reading the run statistics
+import json
 # For checking
 import re
+# For checking the quality functions for filters against the slow way
+import statistics
+# For checking that helpers come back fresh out of a worker
+import pickle
+# For reading the output records and a gzipped whitelist
+import io
+import gzip
+# For counting the expected outputs
+import collections
 
 #### Ye Tests
 
@@ -215,6 +226,46 @@ def test_groupstats_flatten(groupstats):
 def test_groupstats_repr(groupstats):
     assert type(repr(groupstats)) == type(str())
 
+def test_groupstats_quality_string(groupstats):
+    assert groupstats.quality_string == 'E'*10
+
+# Given the letters from a ReadRecord, the numbers are only made when asked
+def test_groupstats_from_letters():
+    stats = itermae.GroupStats(2,6,itermae.ReadRecord('r','','ACGT','!+5I'))
+    assert stats.quality_string == '!+5I'
+    assert stats._quality is None
+    assert stats.quality == [0,10,20,40]
+
+def test_phred_bulk_conversions():
+    letters = ''.join( chr(i) for i in range(33,127) )
+    numbers = itermae.phred_joined_string_to_number_array(letters)
+    assert numbers == [ itermae.phred_letter_to_number(i) for i in letters ]
+    assert itermae.phred_number_array_to_joined_string(numbers) == letters
+
+# The quality functions for filters should agree with doing it the slow way
+@pytest.mark.parametrize("letters", ['I', '#+5?', 'IIIII#', '!!~I:%'])
+def test_filter_quality_functions(letters):
+    stats = itermae.GroupStats(0,len(letters),
+        itermae.ReadRecord('r','','ACGN'*5,'')[:len(letters)],
+        quality_string=letters)
+    numbers = stats.quality
+    assert itermae.mean_quality(stats) == statistics.mean(numbers)
+    assert itermae.median_quality(stats) == statistics.median(numbers)
+    assert itermae.min_quality(stats) == min(numbers)
+    assert itermae.fraction_below(stats,20) == \
+        len([ i for i in numbers if i < 20 ]) / len(numbers)
+    assert itermae.expected_errors(stats) == \
+        pytest.approx(sum( 10**(-i/10) for i in numbers ))
+    assert itermae.mean_quality(numbers) == itermae.mean_quality(letters)
+
+def test_filter_sequence_functions():
+    record = itermae.ReadRecord('r','','ACGGNnTc','IIIIIIII')
+    assert itermae.n_count(record) == 2
+    assert itermae.gc_fraction(record) == 0.5
+    assert itermae.gc_fraction(itermae.GroupStats(0,8,record)) == 0.5
+    with pytest.raises(ZeroDivisionError):
+        itermae.mean_quality('')
+
 
 # Setup inputs
 # I'm not testing BioPython SeqIO, I assume that's good.
@@ -223,6 +274,213 @@ def test_groupstats_repr(groupstats):
 def fastqfile():
     return SeqIO.parse("itermae/data/tests/test_inputs/barseq.fastq","fastq")
 
+# The native readers should read the same as SeqIO does, with the ID taken
+# out of the description
+def test_read_fastq_file(fastqfile):
+    with open("itermae/data/tests/test_inputs/barseq.fastq") as fh:
+        records = list(itermae.read_fastq_file(fh))
+    expected = list(fastqfile)
+    assert len(records) == len(expected) == 1000
+    for record, seqrecord in zip(records,expected):
+        assert record.id == seqrecord.id
+        assert record.seq == str(seqrecord.seq)
+        assert ( record.letter_annotations['phred_quality'] == 
+            seqrecord.letter_annotations['phred_quality'] )
+        assert record.description == \
+            seqrecord.description.replace(seqrecord.id,"").lstrip()
+
+def test_read_fasta_file():
+    with open("itermae/data/tests/test_inputs/barseq.fasta") as fh:
+        records = list(itermae.read_fasta_file(fh))
+    expected = list(SeqIO.parse(
+        "itermae/data/tests/test_inputs/barseq.fasta","fasta"))
+    assert len(records) == len(expected) == 1000
+    for record, seqrecord in zip(records,expected):
+        assert record.id == seqrecord.id
+        assert record.seq == str(seqrecord.seq)
+        assert record.quality is None
+
+def test_read_fastq_file_wrapped():
+    import io
+    records = list(itermae.read_fastq_file(io.StringIO(
+        "@read1 some description\nACGT\nAC\n+\n@@II\nII\n\n"
+        "@read2\nAAA\n+read2\n@@@\n" )))
+    assert [ (i.id, i.description, i.seq, i.quality) for i in records ] == [
+        ('read1','some description','ACGTAC','@@IIII'),
+        ('read2','','AAA','@@@') ]
+    with pytest.raises(ValueError):
+        list(itermae.read_fastq_file(io.StringIO("@read1\nACGT\n+\nII\n")))
+
+def test_iterate_lines_small_blocks():
+    import io
+    text = "first line\nsecond\n\nfourth, no newline"
+    assert ( list(itermae.iterate_lines(io.StringIO(text),block_size=3)) ==
+        [ "first line", "second", "", "fourth, no newline" ] )
+
+def test_threaded_gzip_reader():
+    import io
+    import gzip
+    text = "".join( "line "+str(i)+"\n" for i in range(10000) )
+    # Two gzip members, then some padding, like BGZF or `cat a.gz b.gz`
+    compressed = ( gzip.compress(text[:20000].encode()) + 
+        gzip.compress(text[20000:].encode()) + b'\x00'*10 )
+    reader = io.TextIOWrapper( io.BufferedReader( itermae.ThreadedGzipReader(
+            io.BytesIO(compressed), block_size=1000, queue_size=2 ) ),
+        encoding='ascii' )
+    assert reader.read() == text
+    # Cut short, which should complain
+    reader = io.TextIOWrapper( io.BufferedReader( itermae.ThreadedGzipReader(
+            io.BytesIO(compressed[:5000]), block_size=1000 ) ) )
+    with pytest.raises(EOFError):
+        reader.read()
+
+# Gzipped input on STDIN, without saying so, should be the same as a file
+def test_gzipped_stdin():
+    command = ( "itermae --input-format fastq -os 'rest' "
+        "-m '(?P<sampleIndex>[ATCGN]{5,5})(?P<rest>GTCCTCGAGGTCTCT.+){e<=1}' " )
+    from_file = subprocess.run( command+
+            "-i itermae/data/tests/test_inputs/barseq.fastq",
+        shell=True, capture_output=True, encoding='utf-8' )
+    from_stdin = subprocess.run( command+
+            "< itermae/data/tests/test_inputs/barseq.fastq.gz",
+        shell=True, capture_output=True, encoding='utf-8' )
+    assert from_stdin.returncode == 0
+    assert len(from_file.stdout) > 0 and from_file.stdout == from_stdin.stdout
+
+def test_read_sam_file():
+    import io
+    records = list(itermae.read_sam_file(io.StringIO(
+        "@HD\tVN:1.6\n"
+        "@CO\tsome comment\n"
+        "read1\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tII#I\n"
+        "read2\t4\t*\t0\t0\t*\t*\t0\t0\tAC\t*\tRG:Z:a\tBC:Z:b\n" )))
+    assert [ (i.id, i.description, i.seq, i.quality) for i in records ] == [
+        ('read1','','ACGT','II#I'),
+        ('read2','RG:Z:a\tBC:Z:b','AC',None) ]
+    with open("itermae/data/tests/test_inputs/barseq.sam") as fh:
+        assert len(list(itermae.read_sam_file(fh))) == 1000
+    with pytest.raises(ValueError):
+        list(itermae.read_sam_file(io.StringIO("read1\t4\t*\n")))
+
+def test_read_txt_file():
+    import io
+    records = list(itermae.read_txt_file(io.StringIO("ACGT\n\nTTTT")))
+    assert [ (i.id, i.seq) for i in records ] == [ ('ACGT','ACGT'), 
+        ('TTTT','TTTT') ]
+
+def test_readrecord_slice_add():
+    record = itermae.ReadRecord('read1','desc','ACGTAC','!#%\'+I')
+    assert record[1:3].seq == 'CG'
+    assert record[1:3].quality == '#%'
+    assert record[1:3].id == 'read1'
+    joined = record[0:2] + record[4:6]
+    assert ( joined.seq, joined.quality ) == ( 'ACAC', '!#+I' )
+    assert record.letter_annotations['phred_quality'] == [0,2,4,6,10,40]
+    assert len(record) == 6
+    assert str(record.to_seqrecord().seq) == 'ACGTAC'
+    roundtrip = itermae.ReadRecord.from_seqrecord(record.to_seqrecord())
+    assert roundtrip.quality == record.quality
+
+# Spans point into the original read, even when taken of other spans
+def test_readspan():
+    record = itermae.ReadRecord('read1','desc','ACGTACGT','!#%\'+5?I')
+    span = itermae.ReadSpan.of(record,2,7)
+    assert span._seq is None
+    inner = itermae.ReadSpan.of(span,1,4)
+    assert ( inner.read is record, inner.start, inner.end ) == ( True, 3, 6 )
+    assert ( inner.seq, inner.quality, len(inner) ) == ( 'TAC', "'+5", 3 )
+    assert ( inner.id, inner.description ) == ( 'read1', 'desc' )
+    assert span[1:4].seq == inner.seq and span[-2:].seq == 'CG'
+    joined = span + record[0:1]
+    assert type(joined) is itermae.ReadRecord
+    assert ( joined.seq, joined.quality ) == ( 'GTACGA', "%'+5?!" )
+    assert itermae.ReadSpan.of(itermae.ReadRecord('r','','ACGT'),1,3
+        ).quality is None
+
+def test_groupstats_absolute_offsets():
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ 
+        {'input':'input', 'regex':regex.compile('(?P<first>AC)(?P<rest>.+)')},
+        {'input':'rest', 'regex':regex.compile('(?P<second>GT)(?P<tail>.+)')} ]
+    seq_holder = itermae.SeqHolder(
+        itermae.ReadRecord('read','','ACGTTTA','IIII#II'),
+        configuration=configuration).apply_matches()
+    tail = seq_holder.group_stats['tail']
+    assert ( tail.start, tail.end ) == ( 2, 5 )
+    assert ( tail.absolute_start, tail.absolute_end ) == ( 4, 7 )
+    assert ( tail.seq.seq, tail.quality_string ) == ( 'TTA', '#II' )
+
+# The native formatting should write the same as SeqIO does
+def test_format_record_like_seqio(fastqfile):
+    import io
+    for seqrecord in itertools.islice(fastqfile,20):
+        record = itermae.ReadRecord.from_seqrecord(seqrecord)
+        record.description = seqrecord.description.replace(seqrecord.id,"").lstrip()
+        record.seq = record.seq*2 # long enough to wrap the FASTA
+        record.quality = record.quality*2
+        for format in ['fastq','fasta']:
+            handle = io.StringIO()
+            SeqIO.write(record.to_seqrecord(),handle,format)
+            assert itermae.format_record(record,format,'x') == handle.getvalue()
+    record = itermae.ReadRecord('read1','desc','ACGT','II#I')
+    assert itermae.format_record(record,'txt','x') == "ACGT\n"
+    assert itermae.format_record(record,'sam','x') == \
+        "read1\t0\t*\t0\t255\t*\t=\t0\t0\tACGT\tII#I\tIE:Z:x\n"
+    # falling back to SeqIO for formats I don't write myself
+    assert itermae.format_record(record,'tab','x') == "read1\tACGT\n"
+
+def test_output_writer_buffers():
+    import io
+    handle = io.StringIO()
+    writer = itermae.OutputWriter(handle,'txt',buffer_size=10)
+    writer.write_record(itermae.ReadRecord('a','','ACGT'),'x')
+    assert handle.getvalue() == "" # still in the buffer
+    writer.write_record(itermae.ReadRecord('b','','TTTTTT'),'x')
+    assert handle.getvalue() == "ACGT\nTTTTTT\n" # flushed once it was full
+    writer.write("CCC\n")
+    writer.flush()
+    assert handle.getvalue() == "ACGT\nTTTTTT\nCCC\n"
+
+def test_compressed_file_writer(tmp_path):
+    import gzip
+    from Bio import bgzf
+    text = "".join( "read "+str(i)+"\tACGT\n" for i in range(50000) )
+    for compression in ['gzip','bgzf']:
+        path = str(tmp_path / ('out.'+compression))
+        writer = itermae.CompressedFileWriter(open(path,'ab'), compression,
+            threads=2)
+        for i in range(0,len(text),5000):
+            writer.write(text[i:i+5000])
+        writer.close()
+        with gzip.open(path,'rt') as fh:
+            assert fh.read() == text
+    # BGZF blocks should be the right size, and end with the empty block
+    with open(path,'rb') as fh:
+        blocks = list(bgzf.BgzfBlocks(fh))
+    assert all( i[3] <= itermae.CompressedFileWriter.BGZF_BLOCK_SIZE 
+        for i in blocks )
+    assert blocks[-1][3] == 0
+    with pytest.raises(ValueError):
+        itermae.CompressedFileWriter(open(path,'ab'),'zip')
+
+def test_compressed_output(tmp_path):
+    import gzip
+    command = ( "itermae -i itermae/data/tests/test_inputs/barseq.fastq "
+        "-m '(?P<sampleIndex>[ATCGN]{5,5})(?P<rest>GTCCTCGAGGTCTCT.+){e<=1}' "
+        "-os 'rest' " )
+    plain = subprocess.run( command+"-f "+str(tmp_path / 'failed.fq'),
+        shell=True, capture_output=True, encoding='utf-8' )
+    compressed = subprocess.run( command+"--output-compression bgzf "+
+            "-o "+str(tmp_path / 'out.sam')+" "+
+            "-f "+str(tmp_path / 'failed.fq.bgz'),
+        shell=True, capture_output=True, encoding='utf-8' )
+    assert compressed.returncode == 0
+    with gzip.open(str(tmp_path / 'out.sam'),'rt') as fh:
+        assert fh.read() == plain.stdout
+    with gzip.open(str(tmp_path / 'failed.fq.bgz'),'rt') as fh:
+        with open(str(tmp_path / 'failed.fq')) as plain_fh:
+            assert fh.read() == plain_fh.read()
+
 ## SeqHolder Tests
 
 # Test that SeqHolder can apply_operation, then since we're there testing
@@ -336,6 +594,34 @@ def test_seqholder_match_filter(fastqfile,configuration_yaml):
         else:
             assert seq_targets == ( built_output.id, built_output.seq ) 
 
+# A holder reset for another read shouldn't keep anything from the last one,
+# including the contexts for `eval`
+def test_seqholder_reset():
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ {'input':'input',
+        'regex':regex.compile('(?P<first>AC)(?P<rest>.+)')} ]
+    output = { 'name':'test' , **{ i: [ j, compile(j,'<string>','eval') ] 
+        for i, j in [ ('filter','rest.length > 1'), ('id','id+"_"+rest'),
+            ('seq','rest'), ('description','description') ] } }
+    seq_holder = itermae.SeqHolder(
+        itermae.ReadRecord('read1','','ACGTT','IIIII'),
+        configuration=configuration).apply_matches()
+    assert seq_holder.evaluate_filter_of_output(output)
+    assert seq_holder.build_output(output).id == 'read1_GTT'
+    seqs = seq_holder.seqs
+    assert seq_holder.reset(itermae.ReadRecord('read2','','TTTT','IIII')
+        ) is seq_holder
+    assert seq_holder.seqs is seqs
+    assert set(seq_holder.seqs) == {'dummyspacer','input'}
+    assert seq_holder.seqs['dummyspacer'] is itermae.DUMMYSPACER
+    assert seq_holder.group_stats == {} and seq_holder.match_scores == {}
+    seq_holder.apply_matches()
+    assert not seq_holder.evaluate_filter_of_output(output)
+    assert seq_holder.build_output(output) is None
+    seq_holder.reset(itermae.ReadRecord('read3','','ACAAA','IIIII'))
+    seq_holder.apply_matches()
+    assert seq_holder.build_output(output).id == 'read3_AAA'
+
 # Buncha tests, defining dicts and lists first, then running with it
 
 input_dicts = [
@@ -453,12 +739,26 @@ output_args_blocks = [
 """
 ]
 
+def compare_to_expected_file(stdout,filename,ordered=True):
+    with open(filename,'r') as f:
+        expected_file = [ i.rstrip('\n') for i in f.readlines() ]
+    observed = stdout.split('\n')
+    if not ordered: # then just the same lines, in any order
+        observed = sorted(observed[:len(expected_file)])
+        expected_file = sorted(expected_file)
+    for i,j in zip(observed,expected_file):
+        assert str(i) == str(j)
+
 def making_a_full_test_yaml(config_file_path, 
-        which_input, which_matches, which_output, which_outputs ):
+        which_input, which_matches, which_output, which_outputs,
+        extra_yaml="", ordered=True, output_yaml_block=None ):
+    # `output_yaml_block` swaps in a different spelling of the outputs, that
+    # should still give the expected file of `which_outputs`
     this_input_dict = input_dicts[which_input]
     this_match_yaml_block = match_yaml_blocks[which_matches]
     this_output_dict = output_dicts[which_output]
-    this_output_yaml_block = output_yaml_blocks[which_outputs]
+    this_output_yaml_block = output_yaml_blocks[which_outputs] \
+        if output_yaml_block is None else output_yaml_block
     config_file = config_file_path / "config.yml"
     config_file.write_text(
         'input_from: '+this_input_dict['input_from']+"\n"+
@@ -467,6 +767,7 @@ def making_a_full_test_yaml(config_file_path,
         this_match_yaml_block+"\n"+
         'output_to: '+this_output_dict['output_to']+"\n"+
         'output_format: '+this_output_dict['output_format']+"\n"+
+        extra_yaml+
         this_output_yaml_block
     )
     results = subprocess.run(
@@ -483,10 +784,7 @@ def making_a_full_test_yaml(config_file_path,
 #        f.write(config_file.read_text())
 #    with open(filename,'w') as f:
 #        f.write(results.stdout)
-    with open(filename,'r') as f:
-        expected_file = f.readlines()
-    for i,j in zip(results.stdout.split('\n'),expected_file):
-        assert str(i) == str(j.rstrip('\n'))
+    compare_to_expected_file(results.stdout,filename,ordered)
 
 def test_full_0000_yaml(tmp_path):
     making_a_full_test_yaml(tmp_path,0,0,0,0)
@@ -562,7 +860,8 @@ def test_full_3131_yaml(tmp_path):
 
 
 def making_a_full_test_args(
-        which_input, which_matches, which_output, which_outputs ):
+        which_input, which_matches, which_output, which_outputs,
+        extra_args="", ordered=True ):
     this_input_dict = input_dicts[which_input]
     this_match_args_block = match_args_blocks[which_matches]
     this_output_dict = output_dicts[which_output]
@@ -574,6 +873,7 @@ def making_a_full_test_args(
         this_match_args_block+" "+
         '--output '+this_output_dict['output_to']+" "+
         '--output-format '+this_output_dict['output_format']+" "+
+        extra_args+" "+
         this_output_args_block
         )
     with open('tmp','w') as f:
@@ -590,10 +890,7 @@ def making_a_full_test_args(
         '.'+this_output_dict['output_format'])
 #    with open(filename,'w') as f:
 #        f.write(results.stdout)
-    with open(filename,'r') as f:
-        expected_file = f.readlines()
-    for i,j in zip(results.stdout.split('\n'),expected_file):
-        assert str(i) == str(j.rstrip('\n'))
+    compare_to_expected_file(results.stdout,filename,ordered)
 
 def test_full_0000_args():
     making_a_full_test_args(0,0,0,0)
@@ -666,3 +963,862 @@ def test_full_2131_args():
     making_a_full_test_args(2,1,3,1)
 def test_full_3131_args():
     making_a_full_test_args(3,1,3,1)
+
+# Same full-file tests, but chopped by a pool of worker processes, in small
+# batches so that there are many of them to put back in order
+def test_full_1111_yaml_processes(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,1,1,
+        extra_yaml="processes: 3\nbatch_size: 7\n")
+def test_full_2121_args_processes():
+    making_a_full_test_args(2,1,2,1,extra_args="--processes 3 --batch-size 7")
+def test_full_0101_args_processes_unordered():
+    making_a_full_test_args(0,1,0,1,
+        extra_args="--processes 3 --batch-size 7 --unordered",ordered=False)
+
+def test_configuration_pickles(configuration_yaml):
+    import pickle
+    unpickled = pickle.loads(pickle.dumps(configuration_yaml))
+    assert ( [ i['filter'][0] for i in unpickled.outputs_array ] ==
+        [ i['filter'][0] for i in configuration_yaml.outputs_array ] )
+    assert ( eval(unpickled.outputs_array[1]['seq'][1],{},{'sampleIndex':'A'})
+        == 'A' )
+    assert 'build_function' in unpickled.outputs_array[1]
+
+# The generated output functions should do what eval'ing the expressions does
+def test_compile_output_functions():
+    record = itermae.ReadRecord('read1','read1 extra','AACCGGTT','ABCDEFGH')
+    seqholder = itermae.SeqHolder(record,configuration=itermae.Configuration())
+    seqholder.apply_operation('match_0','input',
+        regex.compile('(?P<first>AA)(?P<middle>CCGG)(?P<last>TT)'))
+    seqholder.build_context()
+    for filter_string, id_string, seq_string in [
+            ( 'middle.length == 4', 'id+"_"+first', 'first+dummyspacer+last' ),
+            ( 'match_0.substitutions == 0 and first == "AA"', 
+                'first_quality', 'input' ),
+            ( 'statistics.mean(last.quality) > 38', 'description', 
+                'middle[1:3]+first' ),
+            ( 'nothere.length > 1', 'id+nothere', 'nothere' ) ]:
+        output = {'name':'test','description':['description'],
+            'filter':[filter_string],'id':[id_string],'seq':[seq_string] }
+        filter_function, build_function = itermae.compile_output_functions(
+            output, ['first','middle','last','nothere'], ['match_0'] )
+        output_seq = None
+        try:
+            output_seq = eval(seq_string,vars(itermae),seqholder.context_seq)
+            assert ( filter_function(seqholder.seqs, seqholder.group_stats,
+                    seqholder.match_scores) ==
+                eval(filter_string,vars(itermae),seqholder.context_filter) )
+            built = build_function(seqholder.seqs, seqholder.group_stats,
+                seqholder.match_scores)
+        except NameError:
+            # A group that didn't match this read, so these should fail too
+            with pytest.raises(KeyError):
+                build_function(seqholder.seqs, seqholder.group_stats,
+                    seqholder.match_scores)
+            continue
+        assert built.id == eval(id_string,vars(itermae),seqholder.context_id)
+        assert ( built.seq, built.quality ) == \
+            ( output_seq.seq, output_seq.quality )
+
+# Outputs should only apply the matches they need
+def test_plan_outputs():
+    import argparse
+    import ast
+    import io
+    configuration = itermae.Configuration()
+    args = argparse.Namespace(verbose=None,
+        match=['input > (?P<first>AA)(?P<rest>.+)', 
+            'rest > (?P<second>CC)(?P<down>.+)', 'down > (?P<third>GG)'],
+        output_seq=['second','input'], output_id=['id','id+first_quality'],
+        output_filter=['True'],
+        output_description=[], input=None, input_format=None, gzipped=None, 
+        output=None, output_format=None, failed=None, report=None)
+    configuration.config_from_args(args)
+    assert ( [ i['matches'] for i in configuration.outputs_array ] == 
+        [ [0,1], [0] ] )
+    # The filter doesn't use any groups, so only the building can fail
+    assert ( [ i['required_groups'] for i in configuration.outputs_array ] == 
+        [ [], [] ] )
+    assert ( [ i['build_groups'] for i in configuration.outputs_array ] == 
+        [ ['second'], ['first'] ] )
+    handle = io.StringIO()
+    configuration.output_writer = itermae.OutputWriter(handle,'txt')
+    configuration.run_stats = itermae.RunStats()
+    # Nothing uses the third match, so it's never applied
+    for seq in ['TTCCGG','AACCGG']:
+        seqholder = itermae.SeqHolder(
+            itermae.ReadRecord('read1','',seq), configuration=configuration)
+        seqholder.chop()
+        assert seqholder.matches_applied == {0,1}
+    configuration.output_writer.flush()
+    assert handle.getvalue() == "CC\nAACCGG\n"
+    # Both reads pass both filters, like going through every output, but 
+    # the first can't be built
+    assert { key: value for key, value in 
+            configuration.run_stats.counts.items() if key[0] != 'match' } \
+        == { ('filter','untitled_output_0'): [2,0],
+            ('filter','untitled_output_1'): [2,0],
+            ('build','untitled_output_0'): [1,1],
+            ('build','untitled_output_1'): [1,1] }
+    # Names that might not be looked up aren't required
+    assert itermae._required_names( ast.parse(
+        'first.length > 1 and third == "G" or match_2.substitutions == 0'
+        ) ) == {'first'}
+
+# The prefilter should only turn away reads that the regex can't match
+def test_prefilter():
+    prefilter = itermae.Prefilter.from_groups( [
+        ( 'N', (5,5), {} ),
+        ( 'GTCCTCGAGGTCTCT', None, {'allowed_errors':2} ),
+        ( 'N', (18,22), {} ),
+        ( 'CGTACGCTG', None, {'allowed_deletions':1} ),
+        ( '+', None, {} ) ] )
+    assert prefilter.min_length == 5+13+18+8+1
+    assert prefilter.kmer_sets == [ ['GTCCT','CGAGG','TCTCT'], ['CGTA','CGCT'] ]
+    compiled = regex.compile( "(?<a>[ATCGN]{5,5})(?<b>GTCCTCGAGGTCTCT){e<=2}"
+        "(?<c>[ATCGN]{18,22})(?<d>CGTACGCTG){d<=1}(?<e>.+)",
+        regex.BESTMATCH )
+    for seq in [ 'AAAAAGTCCTCGAGGTCTCTAAAAACCCCCGGGGGTTTCGTACGCTGA', 
+            'AAAAAGTACTCGTGGTCTCTAAAAACCCCCGGGGGTTTCGTACCTGA',
+            'AAAAAGTCATCGTGGTCACTAAAAACCCCCGGGGGTTTCGTACGCTGA',
+            'AAAAAGTCCTCGAGGTCTCTAAAAACCCCCGGGGGTTTCGTTCCTGA',
+            'AAAAAGTCCTCGAGGTCTCTCGTACGCTGA' ]:
+        if compiled.search(seq):
+            assert prefilter.could_match(seq)
+    assert not prefilter.could_match(
+        'AAAAAGTCATCGTGGTCACTAAAAACCCCCGGGGGTTTCGTACGCTGA')
+    assert not prefilter.could_match('AAAAAGTCCTCGAGGTCTCTCGTACGCTGA')
+    assert prefilter.could_match(
+        'AAAAAGTACTCGTGGTCTCTAAAAACCCCCGGGGGTTTCGTACCTGA')
+    # Nothing to filter on
+    assert itermae.Prefilter.from_groups( [ ('*', None, {}) ] ) is None
+
+# The match cache should forget the least recently used, and count hits
+def test_match_cache():
+    import pickle
+    cache = itermae.MatchCache(2)
+    assert cache.get('match_0','AAA') is itermae.MatchCache.MISSING
+    cache.put('match_0','AAA',None)
+    cache.put('match_0','CCC',((0,0,0),[('a',(0,1))]))
+    assert cache.get('match_0','AAA') is None
+    cache.put('match_1','AAA',None) # so CCC is forgotten
+    assert cache.get('match_0','CCC') is itermae.MatchCache.MISSING
+    assert cache.get('match_1','AAA') is None
+    assert cache.take_stats() == {'match_0':[1,2],'match_1':[1,0]}
+    assert cache.stats == {}
+    unpickled = pickle.loads(pickle.dumps(cache))
+    assert unpickled.size == 2 and len(unpickled.results) == 0
+    unpickled.add_stats({'match_0':[3,1]})
+    assert "match_0: 3 of 4 (75.0%)" in unpickled.summary()
+
+# Full tests again, remembering matches
+def test_full_1111_yaml_match_cache(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,1,1,
+        extra_yaml="match_cache_size: 50\n")
+def test_full_2121_args_match_cache_processes():
+    making_a_full_test_args(2,1,2,1,
+        extra_args="--match-cache-size 50 --processes 2 --batch-size 7")
+
+# Collapsing identical sequences
+def test_full_1131_yaml_collapse_matches(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,3,1,
+        extra_yaml="collapse: matches\n")
+def test_full_2121_args_collapse_matches():
+    making_a_full_test_args(2,1,2,1,extra_args="--collapse matches")
+
+def test_collapse_reads():
+    configuration = itermae.Configuration()
+    configuration.input_seqs = iter([ 
+        itermae.ReadRecord('read1','','ACGT','IIII'),
+        itermae.ReadRecord('read2','','TTTT','IIII'),
+        itermae.ReadRecord('read3','','ACGT','####') ])
+    configuration.collapse_input_seqs()
+    assert [ ( i.id, i.seq, i.quality ) for i in configuration.input_seqs ] == [
+        ('read1;size=2','ACGT','IIII'), ('read2;size=1','TTTT','IIII') ]
+
+def test_collapse_matches_reuses_results():
+    configuration = itermae.Configuration()
+    configuration.collapse = 'matches'
+    configuration.matches_array = [ {'input':'input',
+        'regex':regex.compile('(?P<first>AC)(?P<rest>.+)')} ]
+    seqholders = [ itermae.SeqHolder(itermae.ReadRecord(i,'','ACGT',quality),
+            configuration=configuration).apply_matches()
+        for i, quality in [ ('read1','IIII'), ('read2','####') ] ]
+    assert list(configuration.collapsed_matches.keys()) == ['ACGT']
+    # The second read has the same groups, but with its own qualities
+    assert seqholders[1].seqs['rest'].seq == 'GT'
+    assert seqholders[1].seqs['rest'].quality == '##'
+    assert seqholders[1].group_stats['first'].quality == [2,2]
+
+# And with a pool of threads doing the matching
+def test_full_1131_yaml_threads(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,3,1,
+        extra_yaml="threads: 3\nbatch_size: 7\n")
+def test_full_0111_args_threads():
+    making_a_full_test_args(0,1,1,1,extra_args="--threads 3 --batch-size 7")
+def test_full_3121_args_threads_processes():
+    making_a_full_test_args(3,1,2,1,
+        extra_args="--threads 2 --processes 2 --batch-size 7")
+
+# The synthetic reads for benchmarking should be the same for a seed, and
+# chop like the real ones
+def test_benchmark_synthetic_reads(tmp_path):
+    generate = 'python3 profiling_tests/benchmark.py generate --reads 200 '
+    first = subprocess.run(generate+'--seed 3',
+        shell=True,capture_output=True,encoding='utf-8').stdout
+    assert first == subprocess.run(generate+'--seed 3',
+        shell=True,capture_output=True,encoding='utf-8').stdout
+    assert first != subprocess.run(generate+'--seed 4',
+        shell=True,capture_output=True,encoding='utf-8').stdout
+    (tmp_path / 'reads.fastq').write_text(first)
+    config_file = tmp_path / "config.yml"
+    config_file.write_text(
+        'input_from: '+str(tmp_path / 'reads.fastq')+"\n"+
+        match_yaml_blocks[1]+"\n"+
+        'output_format: fasta'+"\n"+
+        'output_list:\n    -   seq: barcode\n' )
+    results = subprocess.run('itermae --config '+str(config_file),
+        shell=True,capture_output=True,encoding='utf-8')
+    assert 150 < results.stdout.count('>') < 200
+
+# Run statistics, as JSON
+def test_run_stats():
+    import pickle
+    run_stats = itermae.RunStats()
+    run_stats.count(('match','match_0'),True)
+    run_stats.count(('match','match_0'),False)
+    run_stats.add_time(('match','match_0'),0.5)
+    run_stats.count_read()
+    assert list(run_stats.timed_iter(['a','b'])) == ['a','b']
+    assert ('parse','input') in run_stats.seconds
+    unpickled = pickle.loads(pickle.dumps(run_stats))
+    assert unpickled.reads == 0 and unpickled.counts == {}
+    unpickled.add_stats(run_stats.take_stats())
+    assert run_stats.counts == {}
+    unpickled.add_stats( (1, {('match','match_0'):0.25}, 
+        {('match','match_0'):[3,0]}) )
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ {'input':'input'} ]
+    summary = unpickled.summary(configuration, 2.0)
+    assert summary['reads'] == 2 and summary['reads_per_second'] == 1.0
+    assert summary['matches'] == { 'match_0': {'input':'input',
+        'matched':4, 'failed':1, 'seconds':0.75} }
+
+def test_full_1111_yaml_stats_json(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,1,1,
+        extra_yaml="stats_json: "+str(tmp_path / 'stats.json')+"\n")
+    with open(tmp_path / 'stats.json') as f:
+        stats = json.load(f)
+    assert stats['reads'] == 1000
+    assert [ i['input'] for i in stats['matches'].values() ] == \
+        ['input','rest','downstream']
+    for each in stats['matches'].values():
+        assert each['matched'] + each['failed'] == 1000
+    assert len(stats['outputs']) == 3
+
+def test_stats_json_processes(tmp_path):
+    counts = []
+    for extra_args in ['','--processes 2 --batch-size 7']:
+        subprocess.run('itermae -i itermae/data/tests/test_inputs/barseq.fastq.gz '
+            +match_args_blocks[1]+output_args_blocks[1]+
+            ' --stats-json '+str(tmp_path / 'stats.json')+' '+extra_args,
+            shell=True,capture_output=True,encoding='utf-8')
+        with open(tmp_path / 'stats.json') as f:
+            stats = json.load(f)
+        counts.append( ( stats['reads'],
+            { i: (j['matched'], j['failed']) 
+                for i, j in stats['matches'].items() },
+            { i: (j['passed'], j['failed']) 
+                for i, j in stats['outputs'].items() } ) )
+    assert counts[0] == counts[1]
+
+# Progress, and metrics from a thread on the side
+def test_progress_reporter(tmp_path):
+    import urllib.request, urllib.error
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ {'input':'input'} ]
+    configuration.outputs_array = [ {'name':'some "output"'} ]
+    configuration.metrics_file = str(tmp_path / 'itermae.prom')
+    configuration.metrics_port = 0
+    configuration.progress = 60
+    configuration.run_stats = itermae.RunStats()
+    reporter = itermae.ProgressReporter(configuration)
+    reporter.start()
+    for passed in [True,True,False]:
+        configuration.run_stats.count_read()
+        configuration.run_stats.count(('match','match_0'),True)
+        configuration.run_stats.count(('filter','some "output"'),passed)
+    reporter.update(report=False)
+    url = 'http://127.0.0.1:'+str(reporter.server.server_address[1])
+    with urllib.request.urlopen(url+'/metrics') as response:
+        served = response.read().decode()
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(url+'/else')
+    reporter.stop()
+    assert 'itermae_reads_total 3\n' in served
+    written = (tmp_path / 'itermae.prom').read_text()
+    assert 'itermae_reads_total 3\n' in written
+    assert ('itermae_output_reads_total{output="some \\"output\\"",'
+        'result="passed"} 2\n') in written
+    assert 'itermae_match_reads_total{match="match_0",result="failed"} 0\n' \
+        in written
+
+def test_full_1111_args_progress(tmp_path):
+    making_a_full_test_args(1,1,1,1,
+        extra_args="--progress 0.01 --metrics-file "+
+            str(tmp_path / 'itermae.prom'))
+    assert 'itermae_reads_total 1000\n' in \
+        (tmp_path / 'itermae.prom').read_text()
+
+# A summary report, instead of a line per read
+def test_summary_report():
+    import pickle
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ {'input':'input',
+        'regex':regex.compile('(?P<first>AC){e<=1}(?P<rest>.+)')} ]
+    summary_report = itermae.SummaryReport(samples=2)
+    for i, seq in enumerate(['ACGT','TCGTT','GGGGG','ACGTA','TTT']):
+        seq_holder = itermae.SeqHolder(
+            itermae.ReadRecord('read'+str(i),'',seq,'I'*len(seq)),
+            configuration=configuration).apply_matches()
+        passed = 'rest' in seq_holder.seqs
+        summary_report.add_read(seq_holder, [ {'name':'out',
+            'filter_result': passed, 
+            'output': seq_holder.seqs['rest'] if passed else None } ])
+    summary = summary_report.summary()
+    assert summary['reads'] == 5
+    assert summary['outputs'] == {'out': {'passed':3,'failed':2,
+        'build_failed':0}}
+    assert summary['matches']['match_0']['substitutions'] == {'0':2,'1':1}
+    assert summary['groups']['rest']['lengths'] == {'2':1,'3':2}
+    assert summary['groups']['rest']['mean_quality'] == {'40':3}
+    assert len(summary['examples']['PassedFilterFor_out']) == 2
+    assert [ i['id'] for i in summary['examples']['FailedFilterFor_out'] ] \
+        == ['read2','read4']
+    # Merging the numbers of another, like from a worker process
+    merged = pickle.loads(pickle.dumps(summary_report))
+    assert merged.reads == 0
+    merged.add_stats(summary_report.take_stats())
+    merged.add_stats(pickle.loads(pickle.dumps(merged)).take_stats())
+    assert merged.summary()['outputs'] == summary['outputs']
+    assert len(merged.summary()['examples']['PassedFilterFor_out']) == 2
+
+# Each worker process picks its example reads with its own random numbers
+def worker_reservoir_draw():
+    return itermae._worker_configuration.summary_report.random.random()
+
+def test_summary_report_workers_draw_independently():
+    import multiprocessing
+    configuration = itermae.Configuration()
+    configuration.summary_report = itermae.SummaryReport(samples=2)
+    draws = []
+    for i in range(2):
+        with multiprocessing.get_context('spawn').Pool(1,
+                initializer=itermae._initialize_worker, 
+                initargs=(configuration,)) as pool:
+            draws.append(pool.apply(worker_reservoir_draw))
+    assert draws[0] != draws[1]
+    assert configuration.summary_report.random.random() not in draws
+
+# The faster quality functions give the same as `statistics` in the filters
+def test_full_1111_yaml_quality_functions(tmp_path):
+    output_yaml_block = output_yaml_blocks[1].replace(
+        'statistics.median(barcode.quality)','median_quality(barcode)')
+    assert 'median_quality' in output_yaml_block
+    making_a_full_test_yaml(tmp_path,1,1,1,1,
+        output_yaml_block=output_yaml_block)
+
+def test_full_1111_yaml_report_summary(tmp_path):
+    making_a_full_test_yaml(tmp_path,1,1,1,1,
+        extra_yaml="output_report_summary: "+str(tmp_path / 'summary.json')+
+            "\nreport_samples: 3\n")
+    with open(tmp_path / 'summary.json') as f:
+        summary = json.load(f)
+    assert summary['reads'] == 1000
+    assert len(summary['matches']) == 3
+    for each in summary['matches'].values():
+        assert each['matched'] + each['failed'] == 1000
+    assert all( len(i) <= 3 for i in summary['examples'].values() )
+
+# Per-read statistics, in a columnar binary format
+def match_stats_reads(stats_writer):
+    configuration = itermae.Configuration()
+    configuration.matches_array = [ {'input':'input',
+        'regex':regex.compile('(?P<first>AC){e<=1}(?P<rest>.+)')} ]
+    for i, seq in enumerate(['ACGT','TCGTT','GGGGG','ACGTA','TTT']):
+        seq_holder = itermae.SeqHolder(
+            itermae.ReadRecord('read'+str(i),'',seq,'I'*len(seq)),
+            configuration=configuration).apply_matches()
+        stats_writer.add_read(seq_holder, [ {'name':'out',
+            'filter_result': 'rest' in seq_holder.seqs, 'output': None } ])
+
+def check_match_stats(stats):
+    assert list(stats['id']) == ['read0','read1','read2','read3','read4']
+    assert list(stats['match_0_substitutions']) == [0,1,-1,0,-1]
+    assert list(stats['rest_start']) == [2,2,-1,2,-1]
+    assert list(stats['rest_length']) == [2,3,-1,3,-1]
+    assert list(stats['passed_out']) == [True,True,False,True,False]
+
+def test_match_stats_writer_npz(tmp_path):
+    import pickle
+    stats_writer = itermae.MatchStatsWriter(str(tmp_path / 'stats'),
+        ['match_0'], ['first','rest'], ['out'], chunk_size=2)
+    match_stats_reads(stats_writer)
+    stats_writer.close()
+    assert len(list((tmp_path / 'stats').iterdir())) == 3
+    check_match_stats(itermae.read_match_stats(str(tmp_path / 'stats')))
+    # Or the rows come from a "worker", like with processes
+    stats_writer = itermae.MatchStatsWriter(str(tmp_path / 'from_worker'),
+        ['match_0'], ['first','rest'], ['out'], chunk_size=2)
+    worker = pickle.loads(pickle.dumps(stats_writer))
+    assert worker.path is None
+    match_stats_reads(worker)
+    stats_writer.add_rows(worker.take_rows())
+    stats_writer.close()
+    check_match_stats(itermae.read_match_stats(str(tmp_path / 'from_worker')))
+
+def test_match_stats_writer_arrow(tmp_path):
+    pytest.importorskip('pyarrow')
+    for name in ['stats.arrow','stats.parquet']:
+        stats_writer = itermae.MatchStatsWriter(str(tmp_path / name),
+            ['match_0'], ['first','rest'], ['out'], chunk_size=2)
+        match_stats_reads(stats_writer)
+        stats_writer.close()
+        check_match_stats(itermae.read_match_stats(str(tmp_path / name)))
+
+def test_full_2121_args_output_stats(tmp_path):
+    for extra_args in ['','--processes 2 --batch-size 7']:
+        making_a_full_test_args(2,1,2,1,
+            extra_args="--output-stats "+str(tmp_path / 'stats')+" "+
+                extra_args)
+        stats = itermae.read_match_stats(str(tmp_path / 'stats'))
+        assert len(stats['id']) == 1000
+        assert list(stats['id'][:2]) == [
+            'NB501157:100:H5J5LBGX2:1:11101:10000:10043',
+            'NB501157:100:H5J5LBGX2:1:11101:10000:10138' ]
+        matched = stats['barcode_length'] >= 0
+        assert ( stats['barcode_end'] - stats['barcode_start'] == 
+            stats['barcode_length'] )[matched].all()
+        assert ( stats['match_1_substitutions'] >= 0 )[matched].all()
+
+# More rows than a chunk in one batch, so a worker process that wrote chunks
+# itself would clash with the ones written by the main process
+def test_full_args_output_stats_processes_past_a_chunk(tmp_path):
+    import random
+    generator = random.Random(1)
+    with open(tmp_path / 'reads.fastq','w') as f:
+        for i in range(70000):
+            f.write('@read'+str(i)+'\n'+
+                ''.join( generator.choice('ACGT') for j in range(30) )+
+                '\n+\n'+'I'*30+'\n')
+    subprocess.run("itermae -i "+str(tmp_path / 'reads.fastq')+" "
+            "-m 'input > (?P<first>[ACGT]{5})(?P<rest>.+)' -os 'first' "
+            "--output-stats "+str(tmp_path / 'stats')+" "
+            "--processes 2 --batch-size 70000 > /dev/null", 
+        shell=True, check=True)
+    stats = itermae.read_match_stats(str(tmp_path / 'stats'))
+    assert len(stats['id']) == 70000
+    assert list(stats['id'][-2:]) == ['read69998','read69999']
+    assert ( stats['first_length'] == 5 ).all()
+
+# The batch engine should write exactly what going read by read does, with
+# the filters it can do over a whole chunk or not
+def test_batch_engine_filters():
+    pytest.importorskip('numpy')
+    import argparse
+    import io
+    filters = [ 'True', 'barcode.length < 20 and match_1.substitutions == 0',
+        'sampleIndex == "GCTTC" or not barcode.length > 19',
+        '15 <= barcode.length < 21', 'mean_quality(barcode) >= 35',
+        'statistics.median(barcode.quality) > 35.5',
+        'fraction_below(barcode,30) < 0.1 and n_count(barcode) == 0',
+        '(barcode.absolute_start - barcode.start)//5 == 4 and barcode != 5',
+        'barcode.length / match_0.substitutions > 10 or sampleIndex',
+        'expected_errors(upPrime) < 0.01 or gc_fraction(barcode) > 0.5',
+        'len(barcode.quality) == 20', 'barcode < "C"', 'barcode + 1' ]
+    args = argparse.Namespace(verbose=None,
+        match=['input > (?P<sampleIndex>[ATCGN]{5,5})'
+                '(?P<rest>GTCCTCGAGGTCTCT.+){e<=1}',
+            'rest > (?P<upPrime>GTCCTCGAGGTCTCT){e<=1}'
+                '(?P<barcode>[ATCGN]{18,22})(?P<downPrime>CGTACGCTG){e<=1}'],
+        output_seq=['barcode']*len(filters), 
+        output_id=[ 'id+"_"+str('+str(i)+')' for i in range(len(filters)) ],
+        output_filter=filters, output_description=[], input=None, 
+        input_format=None, gzipped=None, output=None, output_format=None, 
+        failed=None, report=None)
+    configuration = itermae.Configuration()
+    configuration.config_from_args(args)
+    configuration.batch_size = 97
+    with open("itermae/data/tests/test_inputs/barseq.fastq") as fh:
+        reads = list(itermae.read_fastq_file(fh))
+    written = []
+    for batch_engine in [False, True]:
+        configuration.batch_engine = batch_engine
+        configuration.output_writer = itermae.OutputWriter(io.StringIO(),'sam')
+        configuration.failed_writer = itermae.OutputWriter(io.StringIO(),
+            'fastq')
+        configuration.chop_records( itermae.ReadRecord(i.id, i.description,
+            i.seq, i.quality) for i in reads )
+        configuration.output_writer.flush()
+        configuration.failed_writer.flush()
+        written.append( ( configuration.output_writer.fh.getvalue(),
+            configuration.failed_writer.fh.getvalue() ) )
+    assert written[0] == written[1]
+    assert all( len(i[0]) > 1000 and len(i[1]) > 1000 for i in written )
+    # The last three can't be done over the whole chunk
+    assert [ i is None for i in configuration.batch_chopper.filters ] == \
+        [False]*(len(filters)-3) + [True]*3
+
+def test_batch_engine_unsupported():
+    configuration = itermae.Configuration()
+    assert itermae.BatchChopper.unsupported(configuration) is None
+    configuration.report = 'report.csv'
+    assert 'report' in itermae.BatchChopper.unsupported(configuration)
+
+def test_full_1131_yaml_batch_engine(tmp_path):
+    pytest.importorskip('numpy')
+    making_a_full_test_yaml(tmp_path,1,1,3,1,
+        extra_yaml="batch_engine: true\nbatch_size: 7\n")
+def test_full_0111_args_batch_engine():
+    pytest.importorskip('numpy')
+    making_a_full_test_args(0,1,1,1,extra_args="--batch-engine")
+def test_full_3121_args_batch_engine_processes():
+    pytest.importorskip('numpy')
+    making_a_full_test_args(3,1,2,1,
+        extra_args="--batch-engine --processes 2 --batch-size 7")
+
+# Demultiplexing, with a sample sheet
+def test_sample_index():
+    sample_index = itermae.SampleIndex( 
+        {'AAAA':'one', 'AAAT':'two', 'CCCC':'three', 'GGGG':'three'}, 
+        mismatches=1)
+    assert [ sample_index.assign(i) for i in 
+            ['AAAA','aaat','CCCA','GGGN','AACC','TTTT','AAA',None] ] == \
+        ['one','two','three','three','unassigned','unassigned','unassigned',
+            'unassigned']
+    # AAAC is one away from both AAAA and AAAT
+    assert sample_index.assign('AAAC') == 'unassigned'
+    assert sample_index.summary() == { 'one': 1, 'two': 1, 'three': 2, 
+        'unassigned': 4, 'ambiguous': 1 }
+    worker = pickle.loads(pickle.dumps(sample_index))
+    assert worker.assign('AAAA') == 'one'
+    sample_index.add_stats(worker.take_stats())
+    assert sample_index.summary()['one'] == 2
+    assert worker.summary()['one'] == 0
+    assert len(list(itermae.hamming_neighbours('ACG',2))) == 3*4 + 3*4*4
+
+def test_sample_sheet(tmp_path):
+    sheet = tmp_path / 'sheet.csv'
+    sheet.write_text("index,sample\n# a comment\nACGT,a\n\nTTTT\tb\n")
+    assert itermae.SampleIndex.from_sample_sheet(str(sheet)).samples == \
+        {'ACGT':'a', 'TTTT':'b'}
+    for bad in ["ACGT,a\nACGT,b\n", "ACGT,a\nAC-T,b\n", "ACGT\n", 
+            "ACGT,unassigned\n", "index,sample\n"]:
+        sheet.write_text(bad)
+        with pytest.raises(ValueError):
+            itermae.SampleIndex.from_sample_sheet(str(sheet))
+
+def test_full_args_demultiplex(tmp_path):
+    (tmp_path / 'sheet.tsv').write_text("ATACC\tfirst\nCATAA\tsecond\n"
+        "AGGAG\tsecond\nGTGCC\tthird\n")
+    command = ( "itermae -i itermae/data/tests/test_inputs/barseq.fastq "
+        "-m 'input > (?P<sampleIndex>[ATCGN]{5,5})(?P<rest>GTCCTCGAGGTCTCT.+)"
+        "{e<=1}' -os 'rest' -oi 'id+\"_\"+sampleIndex' --output-format txt " )
+    everything = subprocess.run(command, shell=True, capture_output=True,
+        encoding='utf-8').stdout.split()
+    for extra_args in ['', '--processes 2 --batch-size 37']:
+        output_dir = tmp_path / ('out'+str(len(extra_args)))
+        output_dir.mkdir()
+        results = subprocess.run( command+"-v -o "+str(output_dir)+
+                "/{sample}.txt --sample-sheet "+str(tmp_path / 'sheet.tsv')+
+                " --demultiplex-group sampleIndex --demultiplex-mismatches 1 "+
+                "--stats-json "+str(output_dir / 'stats.json')+" "+
+                extra_args, shell=True, capture_output=True, encoding='utf-8')
+        assert "Reads demultiplexed to each sample:" in results.stderr
+        assert sorted( i.name for i in output_dir.iterdir() ) == [ 
+            'first.txt', 'second.txt', 'stats.json', 'third.txt', 
+            'unassigned.txt' ]
+        written = {}
+        for sample in ['first','second','third','unassigned']:
+            written[sample] = \
+                (output_dir / (sample+'.txt')).read_text().split()
+        assert sorted(sum(written.values(),[])) == sorted(everything)
+        # Each line is the rest, and the ID isn't written in txt, so check 
+        # the counts instead
+        with open(output_dir / 'stats.json') as f:
+            counts = json.load(f)['demultiplex']
+        assert counts['first'] == len(written['first']) == 55
+        assert counts['second'] == len(written['second'])
+        assert sum(counts.values()) == 1000
+
+# A configuration only from a YAML file demultiplexes too
+def test_demultiplex_config_from_file(tmp_path):
+    (tmp_path / 'sheet.tsv').write_text("ATACC\tfirst\nCATAA\tsecond\n")
+    yaml_text = ( "input_from: itermae/data/tests/test_inputs/barseq.fastq\n"
+        "output_to: "+str(tmp_path)+"/{sample}.txt\n"
+        "output_format: txt\n"
+        "sample_sheet: "+str(tmp_path / 'sheet.tsv')+"\n"
+        "demultiplex_group: sampleIndex\n"
+        "matches:\n"
+        "    - use: input\n"
+        "      pattern: NGTCCTCGAGGTCTCT\n"
+        "      marking: iuuuuuuuuuuuuuuu\n"
+        "      marked_groups:\n"
+        "          i:\n"
+        "              name: sampleIndex\n"
+        "              repeat: 5\n"
+        "          u:\n"
+        "              name: upPrime\n"
+        "              allowed_errors: 1\n"
+        "output_list:\n"
+        "    - seq: 'sampleIndex'\n" )
+    (tmp_path / 'config.yml').write_text(yaml_text)
+    configuration = itermae.Configuration()
+    configuration.config_from_file(str(tmp_path / 'config.yml'))
+    configuration.reader()
+    assert configuration.sample_index.summary()['first'] == 55
+    assert set((tmp_path / 'first.txt').read_text().split()) == {'ATACC'}
+    assert (tmp_path / 'unassigned.txt').exists()
+    # And it's checked like from the arguments
+    (tmp_path / 'config.yml').write_text(
+        yaml_text.replace("sample_sheet: ","# sample_sheet: ") )
+    configuration = itermae.Configuration()
+    configuration.config_from_file(str(tmp_path / 'config.yml'))
+    with pytest.raises(ValueError, match="both a sample sheet"):
+        configuration.reader()
+
+# Correcting a group with a whitelist
+def test_edit_distance():
+    assert itermae.edit_distance('KITTEN','SITTING',5) == 3
+    assert itermae.edit_distance('KITTEN','SITTING',2) == 3
+    assert itermae.edit_distance('ACGT','ACGT',0) == 0
+    assert itermae.edit_distance('ACGT','ACGTTT',1) == 2
+    assert itermae.deletion_neighbours('AAC',1) == {'AAC','AA','AC'}
+    assert len(itermae.deletion_neighbours('ACGT',2)) == 1 + 4 + 6
+
+def test_corrected_quality():
+    assert itermae._corrected_quality('ACGT','ABCD','ACTT') == 'ABCD'
+    assert itermae._corrected_quality('ACGT',None,'ACG') is None
+    # A deleted base gets the lower quality either side of it
+    assert itermae._corrected_quality('ACT','AFB','ACGT') == 'AFBB'
+    # An inserted base's quality is dropped
+    assert itermae._corrected_quality('ACCGT','ABCDE','ACGT') in \
+        ['ACDE','BCDE']
+
+def test_whitelist(tmp_path):
+    whitelist = itermae.Whitelist(['AAAAAAAA','AAAAAAAC','CCCCGGGG'], 1)
+    assert [ whitelist.correct(i) for i in ['AAAAAAAA','CCCCGGGT',
+            'cccggggg','CCCCAGGGG','AAAAAAAG','TTTTTTTT'] ] == [
+        ('AAAAAAAA',0,'exact'), ('CCCCGGGG',1,'corrected'), 
+        ('CCCCGGGG',1,'corrected'), ('CCCCGGGG',1,'corrected'), 
+        (None,1,'ambiguous'), (None,None,'unmatched') ]
+    assert whitelist.summary() == { 'exact': 1, 'corrected': 3, 
+        'ambiguous': 1, 'unmatched': 1 }
+    worker = pickle.loads(pickle.dumps(whitelist))
+    assert worker.summary()['corrected'] == 0
+    worker.correct('CCCCGGGA')
+    whitelist.add_stats(worker.take_stats())
+    assert whitelist.summary()['corrected'] == 4
+    assert itermae.Whitelist(['AAAAAAAA','CCCCGGGG'], 0).lookup(
+        'CCCCGGGT') == (None,None,'unmatched')
+    # Only the least recently used result is forgotten when it's full
+    whitelist.memo_size = 2
+    whitelist.memo.clear()
+    for seq in ['AAAAAAAT','CCCCGGGT','AAAAAAAT','TTTTTTTT']:
+        whitelist.correct(seq)
+    assert list(whitelist.memo) == ['AAAAAAAT','TTTTTTTT']
+    # Read from a file, with a header and a second column, or gzipped
+    path = tmp_path / 'whitelist.txt'
+    path.write_text("barcode,count\nAAAAAAAA,3\n\n# a comment\nccccgggg\n")
+    assert itermae.Whitelist.from_file(str(path)).barcodes == \
+        ['AAAAAAAA','CCCCGGGG']
+    gzipped_path = tmp_path / 'whitelist.txt.gz'
+    with gzip.open(gzipped_path,'wt') as f:
+        f.write("AAAAAAAA\nCCCCGGGG\n")
+    assert itermae.Whitelist.from_file(str(gzipped_path)).barcodes == \
+        ['AAAAAAAA','CCCCGGGG']
+    for bad in ["AAAAAAAA\nAA-AAAAA\n", "barcode\n"]:
+        path.write_text(bad)
+        with pytest.raises(ValueError):
+            itermae.Whitelist.from_file(str(path))
+
+def test_full_args_whitelist(tmp_path):
+    command = ( "itermae -i itermae/data/tests/test_inputs/barseq.fastq "
+        "-m 'input > (?P<barcode>[ATCGN]{18,22})"
+            "(?P<downPrime>CGTACGCTGCAGGTC){e<=1}' "
+        "-os 'barcode' --output-format fastq " )
+    uncorrected = { record.id: str(record.seq) 
+        for record in SeqIO.parse( io.StringIO( subprocess.run(command, 
+            shell=True, capture_output=True, encoding='utf-8').stdout ),
+        'fastq') }
+    observed = sorted(set(uncorrected.values()))[:3]
+    # Exact, one substitution, and one deletion away
+    whitelist = [ observed[0], observed[1][:3]+
+            ('A' if observed[1][3] != 'A' else 'C')+observed[1][4:],
+        observed[2][:5]+observed[2][6:] ]
+    (tmp_path / 'whitelist.txt').write_text("\n".join(whitelist)+"\n")
+    command += ( "-oi 'id+\"_\"+barcode_correction' "
+        "-of 'barcode.correction_distance is not None' -v "
+        "--whitelist-group barcode "
+        "--whitelist "+str(tmp_path / 'whitelist.txt')+" " )
+    results = subprocess.run(command, shell=True, capture_output=True,
+        encoding='utf-8')
+    assert "Reads by how the group 'barcode' was corrected" in results.stderr
+    records = list(SeqIO.parse(io.StringIO(results.stdout),'fastq'))
+    expected = { read_id: ( whitelist[observed.index(barcode)],
+            'exact' if barcode == observed[0] else 'corrected' )
+        for read_id, barcode in uncorrected.items() if barcode in observed }
+    assert { record.id.rsplit('_',1)[0]: ( str(record.seq), 
+            record.id.rsplit('_',1)[1] ) for record in records } == expected
+    for record in records:
+        assert len(record.letter_annotations['phred_quality']) == \
+            len(record.seq)
+    in_processes = subprocess.run(command+"--processes 2 --batch-size 50 "
+            "--stats-json "+str(tmp_path / 'stats.json'), 
+        shell=True, capture_output=True, encoding='utf-8')
+    assert in_processes.stdout == results.stdout
+    with open(tmp_path / 'stats.json') as f:
+        counts = json.load(f)['whitelist']
+    assert counts['exact'] + counts['corrected'] == len(records)
+    assert sum(counts.values()) == len(uncorrected)
+
+def test_whitelist_configuration(tmp_path):
+    (tmp_path / 'whitelist.txt').write_text("ACGTACGT\n")
+    for extra_args, message in [ 
+            ("--whitelist-group barcode", "both a whitelist"),
+            ("--whitelist-group nope --whitelist "+
+                str(tmp_path / 'whitelist.txt'), "isn't made by any match"),
+            ("--whitelist-group barcode --whitelist-distance -1 "
+                "--whitelist "+str(tmp_path / 'whitelist.txt'), 
+                "can't be negative") ]:
+        results = subprocess.run( "itermae -i "
+                "itermae/data/tests/test_inputs/barseq.fastq "
+                "-m 'input > (?P<barcode>[ATCGN]{18,22})' -os barcode "+
+                extra_args, shell=True, capture_output=True, encoding='utf-8')
+        assert message in results.stderr
+
+    # A configuration only from a YAML file corrects the group too
+    yaml_text = ( "input_from: itermae/data/tests/test_inputs/barseq.fastq\n"
+        "output_to: "+str(tmp_path / 'out.txt')+"\n"
+        "output_format: txt\n"
+        "whitelist: "+str(tmp_path / 'whitelist.txt')+"\n"
+        "whitelist_group: barcode\n"
+        "matches:\n"
+        "    - use: input\n"
+        "      pattern: N\n"
+        "      marking: b\n"
+        "      marked_groups:\n"
+        "          b:\n"
+        "              name: barcode\n"
+        "              repeat: 8\n"
+        "output_list:\n"
+        "    - seq: 'barcode'\n" )
+    (tmp_path / 'config.yml').write_text(yaml_text)
+    configuration = itermae.Configuration()
+    configuration.config_from_file(str(tmp_path / 'config.yml'))
+    configuration.reader()
+    assert sum(configuration.whitelist_index.summary().values()) == 1000
+    (tmp_path / 'config.yml').write_text(
+        yaml_text.replace("whitelist: ","# whitelist: ") )
+    configuration = itermae.Configuration()
+    configuration.config_from_file(str(tmp_path / 'config.yml'))
+    with pytest.raises(ValueError, match="both a whitelist"):
+        configuration.reader()
+
+# Counting the output sequences
+def test_pack_sequence():
+    for seq in ['', 'A', 'AAAA', 'ACGT', 'TTTTT', 'ACGTACGTACGTACGTACGTACGTACGTACGTAC',
+            'GATTACA'*11]:
+        assert isinstance(itermae.pack_sequence(seq), int)
+        assert itermae.unpack_sequence(itermae.pack_sequence(seq)) == seq
+    for seq in ['ACGN', 'acgt', 'X', '0123']:
+        assert itermae.pack_sequence(seq) == seq
+        assert itermae.unpack_sequence(seq) == seq
+    assert len({ itermae.pack_sequence(i) for i in ['A','AA','AAA','C'] }) == 4
+
+def test_count_writer():
+    records = [ itermae.ReadRecord('read','',seq) for seq in 
+        ['ACGT','ACGT','ACGN','TTTT','A','ACGT','acgt','TTTT'] ]
+    tables = []
+    for memory in [1024, 0.0001]:
+        fh = io.StringIO()
+        writer = itermae.CountWriter(fh, memory)
+        for i, record in enumerate(records):
+            writer.write_record(record, 'second' if i % 3 else 'first')
+        writer.close()
+        tables.append(fh.getvalue())
+        assert writer.summary()['records'] == len(records)
+        assert ( writer.summary()['spilled_runs'] > 0 ) == ( memory < 1 )
+    assert tables[0] == tables[1] == ( "output\tsequence\tcount\n"
+        "first\tACGT\t1\nfirst\tTTTT\t1\nfirst\tacgt\t1\n"
+        "second\tA\t1\nsecond\tACGN\t1\nsecond\tACGT\t2\nsecond\tTTTT\t1\n" )
+    # The counts from workers add on, and workers don't spill to disk
+    worker = itermae.CountWriter(None, 0.0001)
+    worker.write_record(records[0], 'first')
+    worker.write_record(records[2], 'first')
+    assert worker.summary()['spilled_runs'] == 0
+    fh = io.StringIO()
+    writer = itermae.CountWriter(fh)
+    writer.write(pickle.loads(pickle.dumps(worker.getvalues())))
+    writer.write_record(records[1], 'first')
+    writer.close()
+    assert worker.getvalues() == {}
+    assert fh.getvalue() == ( "output\tsequence\tcount\n"
+        "first\tACGN\t1\nfirst\tACGT\t2\n" )
+
+def test_full_args_count(tmp_path):
+    command = ( "itermae -i itermae/data/tests/test_inputs/barseq.fastq "
+        "-m 'input > (?P<sampleIndex>[ATCGN]{5,5})"
+            "(?P<upPrime>GTCCTCGAGGTCTCT){e<=1}(?P<barcode>[ATCGN]{18,22})"
+            "(?P<downPrime>CGTACGCTGCAGGTC){e<=1}' "
+        "-os 'sampleIndex+barcode' -os 'sampleIndex' " )
+    lines = subprocess.run(command+"--output-format txt", shell=True, 
+        capture_output=True, encoding='utf-8').stdout.split()
+    expected = collections.Counter( 
+        ( 'untitled_output_'+str(i % 2), seq ) for i, seq in enumerate(lines) )
+    for extra_args in ['', '--count-memory 0.005',
+            '--processes 2 --batch-size 37 --count-memory 0.01']:
+        results = subprocess.run( command+"--count -v "+
+                "--stats-json "+str(tmp_path / 'stats.json')+" "+
+                extra_args, shell=True, capture_output=True, encoding='utf-8')
+        table = [ i.split("\t") for i in results.stdout.splitlines() ]
+        assert table[0] == ['output','sequence','count']
+        assert { (name, seq): int(count) for name, seq, count in table[1:] 
+            } == expected
+        assert table[1:] == sorted(table[1:])
+        with open(tmp_path / 'stats.json') as f:
+            counts = json.load(f)['counts']
+        assert counts['records'] == len(lines)
+        assert counts['distinct'] == len(expected)
+        assert ( counts['spilled_runs'] > 0 ) == ( 'memory' in extra_args )
+
+def test_full_args_collapsed_reads_are_counted_as_reads(tmp_path):
+    # Every read twice, so collapsing makes records that stand for two reads
+    (tmp_path / 'reads.fastq').write_text(
+        2*open('itermae/data/tests/test_inputs/barseq.fastq').read() )
+    (tmp_path / 'sheet.tsv').write_text("ATACC\tfirst\nCATAA\tsecond\n")
+    (tmp_path / 'whitelist.txt').write_text("AAAAAAAAAAAAAAAAAAAA\n")
+    command = ( "itermae -i "+str(tmp_path / 'reads.fastq')+" "
+        "-m 'input > (?P<sampleIndex>[ATCGN]{5,5})"
+            "(?P<upPrime>GTCCTCGAGGTCTCT){e<=1}(?P<barcode>[ATCGN]{18,22})"
+            "(?P<downPrime>CGTACGCTGCAGGTC){e<=1}' "
+        "-os 'sampleIndex+barcode' --stats-json STDERR " )
+    def run(extra_args):
+        results = subprocess.run(command+extra_args, shell=True, 
+            capture_output=True, encoding='utf-8')
+        return results.stdout, json.loads(
+            results.stderr[results.stderr.index('{'):] )
+    for extra_args, key in [ ("--count ", 'counts'),
+            ("--output-format txt -o "+str(tmp_path)+"/{sample}.txt "
+                "--sample-sheet "+str(tmp_path / 'sheet.tsv')+" "
+                "--demultiplex-group sampleIndex ", 'demultiplex'),
+            ("--output-format txt --whitelist-group barcode --whitelist "+
+                str(tmp_path / 'whitelist.txt')+" ", 'whitelist') ]:
+        output, stats = run(extra_args)
+        for collapse_args in ["--collapse reads", 
+                "--collapse reads --processes 2 --batch-size 50"]:
+            collapsed_output, collapsed_stats = run(extra_args+collapse_args)
+            assert collapsed_stats[key] == stats[key]
+            if key == 'counts':
+                assert collapsed_output == output
+                assert stats[key]['records'] == 2*stats[key]['distinct']